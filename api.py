@@ -1,20 +1,467 @@
 import datetime
 import os
-import uuid
+import threading
+import time
 from functools import wraps
 
-import jwt
-from flask import Flask, request, jsonify, make_response
-from google.cloud import firestore
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask import Flask, Response, g, has_request_context, request, make_response, stream_with_context
+from werkzeug.routing import BaseConverter
 
+from lib.bulk import chunked, parse_bool, read_csv, read_ndjson, write_csv
+from lib.cache import RecordCache
 from lib.classes import User, RMACase, Product, DistributionCompany
+from lib.companies import CompanyIndex
+from lib.compression import compress_response
+from lib.ean_index import EANIndex
+from lib.events import EventBus, format_event
+from lib.idempotency import IdempotencyStore, KeyInProgress, KeyReused, fingerprint, scoped_key
+from lib.ids import CaseIdAllocator, normalize as normalize_case_id
+from lib import metrics
+from lib.passwords import HasherBusy, hasher
+from lib.search import SearchIndex
+from lib.serialization import ISOJSONEncoder, JSONCodec
+from lib.singleflight import SingleFlight
+from lib.stats import DATE_FIELDS, GROUP_FIELDS, CaseColumnCache, turnaround_stats
+from lib.storage import MAX_BATCH_WRITES, BelowMinimum, Changed, NotFound, create_storage
+from lib.summary import SummaryCounters
+from lib.tokens import CLAIM_FIELDS, InvalidToken, RevocationList, TokenSigner, parse_keys
+from lib.versions import VersionTracker
+from lib.warmup import WarmUp
 
 app = Flask(__name__)
 
+
+class CaseIdConverter(BaseConverter):
+    def to_python(self, value):
+        return normalize_case_id(value)
+
+
+app.url_map.converters['case_id'] = CaseIdConverter
+
 app.config['SECRET_KEY'] = os.getenv('SUKKIRI_SECRET_KEY')
+# 'legacy' tokens only carry the user id; 'claims' tokens also carry the role and name, and come with refresh tokens.
+app.config['TOKEN_FORMAT'] = os.getenv('SUKKIRI_TOKEN_FORMAT', 'legacy')
+app.config['JWT_KEYS'] = parse_keys(os.getenv('SUKKIRI_JWT_KEYS'))
+app.config['LEGACY_TOKEN_TTL'] = int(os.getenv('SUKKIRI_LEGACY_TOKEN_TTL', 86400))
+app.config['ACCESS_TOKEN_TTL'] = int(os.getenv('SUKKIRI_ACCESS_TOKEN_TTL', 900))
+app.config['REFRESH_TOKEN_TTL'] = int(os.getenv('SUKKIRI_REFRESH_TOKEN_TTL', 30 * 86400))
+app.config['REVOCATIONS_RELOAD_INTERVAL'] = int(os.getenv('SUKKIRI_REVOCATIONS_RELOAD_INTERVAL', 30))
+app.config['DEBUG'] = os.getenv('SUKKIRI_DEBUG') == '1'
+app.config['STORAGE_BACKEND'] = os.getenv('SUKKIRI_STORAGE', 'firestore')
+app.config['DATABASE_URI'] = os.getenv('SUKKIRI_DATABASE_URI')
+# Firestore has a change feed, so there the listeners that keep every worker in step with the others' writes are on
+# unless turned off.
+LISTENERS_DEFAULT = '1' if app.config['STORAGE_BACKEND'] == 'firestore' else '0'
+app.config['MAX_PAGE_SIZE'] = int(os.getenv('SUKKIRI_MAX_PAGE_SIZE', 500))
+app.config['MAX_BATCH_SIZE'] = int(os.getenv('SUKKIRI_MAX_BATCH_SIZE', 1000))
+
+app.config['USER_CACHE_SIZE'] = int(os.getenv('SUKKIRI_USER_CACHE_SIZE', 1024))
+app.config['USER_CACHE_TTL'] = int(os.getenv('SUKKIRI_USER_CACHE_TTL', 300))
+app.config['USER_CACHE_LISTENER'] = os.getenv('SUKKIRI_USER_CACHE_LISTENER') == '1'
+
+app.config['PASSWORD_METHOD'] = os.getenv('SUKKIRI_PASSWORD_METHOD', 'pbkdf2:sha256:150000')
+app.config['PASSWORD_WORKERS'] = int(os.getenv('SUKKIRI_PASSWORD_WORKERS', 2))
+app.config['PASSWORD_USER_LIMIT'] = int(os.getenv('SUKKIRI_PASSWORD_USER_LIMIT', 2))
+app.config['PASSWORD_QUEUE_TIMEOUT'] = float(os.getenv('SUKKIRI_PASSWORD_QUEUE_TIMEOUT', 5))
+
+app.config['SINGLE_FLIGHT'] = os.getenv('SUKKIRI_SINGLE_FLIGHT', '1') == '1'
+
+app.config['IDEMPOTENCY_SIZE'] = int(os.getenv('SUKKIRI_IDEMPOTENCY_SIZE', 10000))
+app.config['IDEMPOTENCY_TTL'] = int(os.getenv('SUKKIRI_IDEMPOTENCY_TTL', 86400))
+app.config['IDEMPOTENCY_SHARED'] = os.getenv('SUKKIRI_IDEMPOTENCY_SHARED') == '1'
+app.config['IDEMPOTENCY_WAIT'] = float(os.getenv('SUKKIRI_IDEMPOTENCY_WAIT', 30))
+
+app.config['ETAG_LISTENER'] = os.getenv('SUKKIRI_ETAG_LISTENER', LISTENERS_DEFAULT) == '1'
+# Without the listener, other workers' writes only show once the ETags expire, so they expire sooner.
+app.config['ETAG_TTL'] = int(os.getenv('SUKKIRI_ETAG_TTL', 60 if app.config['ETAG_LISTENER'] else 5))
+
+app.config['EVENTS_HISTORY'] = int(os.getenv('SUKKIRI_EVENTS_HISTORY', 1000))
+app.config['EVENTS_QUEUE_SIZE'] = int(os.getenv('SUKKIRI_EVENTS_QUEUE_SIZE', 100))
+app.config['EVENTS_HEARTBEAT'] = int(os.getenv('SUKKIRI_EVENTS_HEARTBEAT', 15))
+app.config['EVENTS_LISTENER'] = os.getenv('SUKKIRI_EVENTS_LISTENER', LISTENERS_DEFAULT) == '1'
+
+app.config['JSON_ENCODER'] = os.getenv('SUKKIRI_JSON_ENCODER', 'auto')
+# 'http' keeps Flask's dates ("Thu, 01 Aug 2019 10:00:00 GMT"); 'iso' writes ISO 8601, which orjson does faster.
+app.config['JSON_DATES'] = os.getenv('SUKKIRI_JSON_DATES', 'http')
+
+app.config['COMPRESS'] = os.getenv('SUKKIRI_COMPRESS', '1') == '1'
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('SUKKIRI_COMPRESS_MIN_SIZE', 1024))
+app.config['COMPRESS_GZIP_LEVEL'] = int(os.getenv('SUKKIRI_COMPRESS_GZIP_LEVEL', 6))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.getenv('SUKKIRI_COMPRESS_BROTLI_QUALITY', 4))
+
+app.config['LOW_STOCK_THRESHOLD'] = int(os.getenv('SUKKIRI_LOW_STOCK_THRESHOLD', 2))
+
+app.config['COMPANY_INDEX'] = os.getenv('SUKKIRI_COMPANY_INDEX', '1') == '1'
+app.config['COMPANY_INDEX_LISTENER'] = os.getenv('SUKKIRI_COMPANY_INDEX_LISTENER', LISTENERS_DEFAULT) == '1'
+app.config['COMPANY_INDEX_TTL'] = int(os.getenv('SUKKIRI_COMPANY_INDEX_TTL', 30))
+
+app.config['EAN_INDEX'] = os.getenv('SUKKIRI_EAN_INDEX', '1') == '1'
+app.config['EAN_INDEX_LISTENER'] = os.getenv('SUKKIRI_EAN_INDEX_LISTENER', LISTENERS_DEFAULT) == '1'
+app.config['EAN_INDEX_TTL'] = int(os.getenv('SUKKIRI_EAN_INDEX_TTL', 5))
+
+app.config['SEARCH'] = os.getenv('SUKKIRI_SEARCH', '1') == '1'
+app.config['SEARCH_LISTENER'] = os.getenv('SUKKIRI_SEARCH_LISTENER', LISTENERS_DEFAULT) == '1'
+app.config['SEARCH_SNAPSHOT'] = os.getenv('SUKKIRI_SEARCH_SNAPSHOT')
+app.config['SEARCH_SNAPSHOT_INTERVAL'] = int(os.getenv('SUKKIRI_SEARCH_SNAPSHOT_INTERVAL', 300))
+# Workers save a snapshot every interval, so one older than that is left over from before a restart.
+app.config['SEARCH_SNAPSHOT_MAX_AGE'] = int(os.getenv('SUKKIRI_SEARCH_SNAPSHOT_MAX_AGE',
+                                                      app.config['SEARCH_SNAPSHOT_INTERVAL']))
+app.config['SEARCH_MAX_RESULTS'] = int(os.getenv('SUKKIRI_SEARCH_MAX_RESULTS', 100))
+
+app.config['STATS_MAX_AGE'] = int(os.getenv('SUKKIRI_STATS_MAX_AGE', 300))
+app.config['STATS_LISTENER'] = os.getenv('SUKKIRI_STATS_LISTENER', LISTENERS_DEFAULT) == '1'
+
+app.config['COUNTER_SHARDS'] = int(os.getenv('SUKKIRI_COUNTER_SHARDS', 4))
+
+if app.config['JSON_DATES'] == 'iso':
+    app.json_encoder = ISOJSONEncoder
+json_codec = JSONCodec(app.config['JSON_ENCODER'], app.config['JSON_SORT_KEYS'],
+                       app.config['JSONIFY_PRETTYPRINT_REGULAR'] or app.debug, app.config['JSON_DATES'])
+
+
+def jsonify(*args, **kwargs):
+    # Works like flask.jsonify, through the configured encoder.
+    if args and kwargs:
+        raise TypeError('jsonify() behavior undefined when passed both args and kwargs')
+    data = args[0] if len(args) == 1 else args or kwargs
+    return app.response_class(json_codec.dumps(data) + b'\n', mimetype=app.config['JSONIFY_MIMETYPE'])
+
+
+def dumps(data):
+    return json_codec.dumps(data).decode('utf-8')
+
+
+hasher.configure(app.config['PASSWORD_METHOD'], app.config['PASSWORD_WORKERS'],
+                 app.config['PASSWORD_USER_LIMIT'], app.config['PASSWORD_QUEUE_TIMEOUT'])
+
+# Nothing below talks to storage or starts threads on import; that's left to the warm-up, which runs once per
+# worker before it takes requests (see gunicorn.conf.py), or else on the first request.
+warm_up = WarmUp(on_step=lambda step, duration: metrics.startup_duration.set(duration, step))
+watches = []
+
+
+@warm_up.step('password_hasher')
+def start_hasher():
+    # Forks the pool workers before the storage client starts any threads of its own.
+    hasher.start()
+
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or 'none'
+    return 'none'
+
+
+def backend_counts():
+    if has_request_context():
+        return g.get('backend_counts')
+    return None
+
+
+storage = metrics.InstrumentedStorage(create_storage(app.config['STORAGE_BACKEND'], app.config['DATABASE_URI']),
+                                      current_endpoint, backend_counts)
+
+
+@warm_up.step('storage')
+def connect_storage():
+    storage.connect()
+
+
+tokens = TokenSigner(app.config['JWT_KEYS'], app.config['SECRET_KEY'], app.config['ACCESS_TOKEN_TTL'],
+                     app.config['REFRESH_TOKEN_TTL'])
+revocations = RevocationList()
+
+
+def load_revocations():
+    revocations.load(storage.query('revocations', filters=[('expires', '>', time.time())]))
+
+
+def reload_revocations():
+    # Picks up what other workers revoked, and clears out entries nothing can match any more.
+    while True:
+        time.sleep(app.config['REVOCATIONS_RELOAD_INTERVAL'])
+        try:
+            load_revocations()
+            expired = list(storage.query('revocations', filters=[('expires', '<=', time.time())],
+                                         limit=MAX_BATCH_WRITES))
+            for doc in expired:
+                storage.delete('revocations', 'token:' + doc['jti'] if doc.get('jti') else 'user:' + doc['public_id'])
+        except Exception:
+            app.logger.exception('Could not reload the revoked tokens')
+
+
+@warm_up.step('revocations')
+def warm_revocations():
+    load_revocations()
+    threading.Thread(target=reload_revocations, daemon=True).start()
+
+
+def revoke(key, doc):
+    storage.set('revocations', key, doc)
+    revocations.put(doc)
+
+
+def revoke_token(claims):
+    revoke('token:' + claims['jti'], {'jti': claims['jti'], 'expires': claims['exp']})
+
+
+def revoke_user_tokens(public_id, refresh_tokens=False):
+    # Revokes every token the user has been given so far. Access tokens carry the user's role and name, so they
+    # go whenever those change; refresh tokens read the user again, so they only go with the password or the user.
+    now = time.time()
+    entry = storage.get('revocations', 'user:' + public_id) or {'access_before': 0, 'refresh_before': 0}
+    entry = {'public_id': public_id, 'access_before': now,
+             'refresh_before': now if refresh_tokens else entry.get('refresh_before') or 0,
+             'expires': now + max(app.config['LEGACY_TOKEN_TTL'], app.config['ACCESS_TOKEN_TTL'],
+                                  app.config['REFRESH_TOKEN_TTL'])}
+    revoke('user:' + public_id, entry)
+
+
+def token_pair(user):
+    return {'token': tokens.access_token(user), 'refresh_token': tokens.refresh_token(user),
+            'expires_in': app.config['ACCESS_TOKEN_TTL']}
+
+
+flights = SingleFlight()
+
+
+def single_flight(call, key, fn):
+    # Identical lookups that arrive together share one backend call.
+    if not app.config['SINGLE_FLIGHT']:
+        return fn()
+    result, shared = flights.do((call,) + key, fn)
+    if shared:
+        metrics.collapsed_calls.inc(call)
+    return result
+
+
+user_cache = RecordCache(maxsize=app.config['USER_CACHE_SIZE'], ttl=app.config['USER_CACHE_TTL'])
+
+
+def load_user(public_id):
+    return single_flight('load_user', (public_id,), lambda: storage.get('users', public_id))
+
+
+def on_users_changed(changes):
+    for change in changes:
+        user_cache.invalidate(change.key)
+
+
+@warm_up.step('users')
+def warm_user_cache():
+    # Staff accounts are few, so the users behind the tokens in use are all loaded up front.
+    for user in storage.query('users', limit=app.config['USER_CACHE_SIZE']):
+        user_cache.put(user['public_id'], user)
+    if app.config['USER_CACHE_LISTENER']:
+        watches.append(storage.listen('users', on_users_changed))
+
+
+idempotency_store = IdempotencyStore(app.config['IDEMPOTENCY_SIZE'], app.config['IDEMPOTENCY_TTL'],
+                                     storage if app.config['IDEMPOTENCY_SHARED'] else None)
+
+versions = VersionTracker(app.config['ETAG_TTL'])
+
+
+def on_collection_changed(collection):
+    def on_changed(changes):
+        for change in changes:
+            versions.bump(collection, change.key)
+
+    return on_changed
+
+
+@warm_up.step('versions')
+def listen_for_versions():
+    if app.config['ETAG_LISTENER']:
+        for collection in ('rma_cases', 'companies', 'products'):
+            watches.append(storage.listen(collection, on_collection_changed(collection)))
+
 
-db = firestore.Client()
+case_ids = CaseIdAllocator(storage, 'rma_case_id_processes')
+
+events = EventBus(app.config['EVENTS_HISTORY'], app.config['EVENTS_QUEUE_SIZE'])
+
+
+def rma_case_event(rma_case):
+    return {'id': rma_case['id'], 'status': rma_case['status'],
+            'by': rma_case.get(rma_case['status'] + '_by'), 'date': rma_case.get(rma_case['status'] + '_date')}
+
+
+def publish_rma_case_event(kind, rma_case):
+    # With the listener on, every worker hears every change from storage, so the write paths stay quiet. Without it
+    # (the SQL backend has no change feed) a worker only sees its own writes.
+    if not app.config['EVENTS_LISTENER']:
+        events.publish(kind, rma_case_event(rma_case))
+
+
+def on_rma_cases_changed(changes):
+    for change in changes:
+        if change.doc is not None:
+            events.publish('created' if change.kind == 'added' else 'status', rma_case_event(change.doc))
+
+
+@warm_up.step('events')
+def listen_for_events():
+    if app.config['EVENTS_LISTENER']:
+        watches.append(storage.listen('rma_cases', on_rma_cases_changed))
+
+
+case_columns = CaseColumnCache(app.config['STATS_MAX_AGE'])
+
+
+def on_rma_cases_changed_for_stats(changes):
+    for change in changes:
+        if change.doc is not None:
+            case_columns.put(change.key, change.doc)
+
+
+@warm_up.step('stats')
+def listen_for_stats():
+    # The columns themselves are loaded by the first stats request, which keeps the warm-up short.
+    if app.config['STATS_LISTENER']:
+        watches.append(storage.listen('rma_cases', on_rma_cases_changed_for_stats))
+
+
+# Without the listener nothing reports companies other workers delete, so the names expire instead.
+company_index = CompanyIndex(None if app.config['COMPANY_INDEX_LISTENER'] else app.config['COMPANY_INDEX_TTL'])
+
+
+def on_companies_changed(changes):
+    company_index.refresh(storage, [change.key for change in changes])
+
+
+@warm_up.step('companies')
+def warm_company_index():
+    if app.config['COMPANY_INDEX']:
+        company_index.warm(storage)
+        if app.config['COMPANY_INDEX_LISTENER']:
+            watches.append(storage.listen('companies', on_companies_changed))
+
+
+def unknown_company(dist_company_name):
+    # Products and cases may have no company, but one they name has to exist.
+    return bool(dist_company_name) and not company_index.exists(storage, dist_company_name)
+
+
+# Without the listener nothing reports the products other workers change, so what's kept expires instead.
+ean_index = EANIndex(None if app.config['EAN_INDEX_LISTENER'] else app.config['EAN_INDEX_TTL'])
+
+
+def on_products_changed(changes):
+    for change in changes:
+        if change.doc is not None:
+            ean_index.put(change.key, change.doc)
+        else:
+            ean_index.remove(change.key)
+
+
+@warm_up.step('products')
+def warm_ean_index():
+    if app.config['EAN_INDEX']:
+        ean_index.warm(storage)
+        if app.config['EAN_INDEX_LISTENER']:
+            watches.append(storage.listen('products', on_products_changed))
+
+
+search_index = SearchIndex()
+summary = SummaryCounters(app.config['COUNTER_SHARDS'])
+
+
+def on_search_documents_changed(collection):
+    def on_changed(changes):
+        search_index.refresh(storage, collection, [change.key for change in changes])
+
+    return on_changed
+
+
+def save_search_snapshots():
+    while True:
+        time.sleep(app.config['SEARCH_SNAPSHOT_INTERVAL'])
+        try:
+            if search_index.dirty:
+                search_index.save(app.config['SEARCH_SNAPSHOT'])
+            else:
+                # Nothing was written anywhere since the last save, so the snapshot is still current; marking it
+                # so keeps it within the maximum age.
+                os.utime(app.config['SEARCH_SNAPSHOT'])
+        except OSError:
+            app.logger.exception('Could not save the search snapshot')
+
+
+@warm_up.step('search')
+def warm_search_index():
+    if not app.config['SEARCH']:
+        return
+    # A recent snapshot saves reading every product and case from storage on startup.
+    if not (app.config['SEARCH_SNAPSHOT'] and
+            search_index.load(app.config['SEARCH_SNAPSHOT'], app.config['SEARCH_SNAPSHOT_MAX_AGE'])):
+        search_index.warm(storage)
+    # Every worker saves to the same file, so only an index that hears every worker's writes is saved; without the
+    # listener a worker would overwrite the others' writes with its own partial view.
+    if app.config['SEARCH_SNAPSHOT'] and app.config['SEARCH_LISTENER']:
+        threading.Thread(target=save_search_snapshots, daemon=True).start()
+    elif app.config['SEARCH_SNAPSHOT']:
+        app.logger.warning('Not saving search snapshots: they need SUKKIRI_SEARCH_LISTENER=1 on a backend with a '
+                           'change feed')
+    if app.config['SEARCH_LISTENER']:
+        for collection in ('products', 'rma_cases'):
+            watches.append(storage.listen(collection, on_search_documents_changed(collection)))
+
+
+# Endpoints that answer before the warm-up is done: load balancers use them to see whether it is.
+WARM_UP_EXEMPT = ('get_readiness', 'get_metrics')
+
+
+@app.before_request
+def finish_warm_up():
+    if not warm_up.ready and request.endpoint not in WARM_UP_EXEMPT:
+        warm_up.run()
+
+
+@app.before_request
+def start_request_metrics():
+    g.request_start = time.perf_counter()
+    g.backend_counts = [0, 0]
+
+
+@app.after_request
+def record_request_metrics(response):
+    endpoint = current_endpoint()
+    metrics.request_latency.observe(time.perf_counter() - g.request_start, endpoint, request.method)
+    # Streamed responses have no length up front.
+    if response.content_length is not None:
+        metrics.response_size.observe(response.content_length, endpoint, request.method)
+    if response.status_code >= 400:
+        metrics.request_errors.inc(endpoint, request.method, response.status_code)
+    metrics.backend_reads.observe(g.backend_counts[0], endpoint)
+    metrics.backend_writes.observe(g.backend_counts[1], endpoint)
+    return response
+
+
+@app.after_request
+def compress(response):
+    if not app.config['COMPRESS']:
+        return response
+    return compress_response(response, request.accept_encodings, app.config['COMPRESS_MIN_SIZE'],
+                             app.config['COMPRESS_GZIP_LEVEL'], app.config['COMPRESS_BROTLI_QUALITY'])
+
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.exposition(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/ready', methods=['GET'])
+def get_readiness():
+    # A worker nobody warmed up (e.g. the development server) starts warming up when first asked.
+    if not warm_up.ready:
+        warm_up.start()
+    status = warm_up.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
+
+# Endpoints that also take the token as ?token=: a browser's EventSource can't send headers.
+TOKEN_IN_QUERY = ('get_rma_case_events',)
 
 
 def token_required(f):
@@ -24,45 +471,223 @@ def token_required(f):
 
         if 'x-access-token' in request.headers:
             token = request.headers['x-access-token']
+        elif request.endpoint in TOKEN_IN_QUERY:
+            token = request.args.get('token')
 
         if not token:
             return jsonify({'message': 'Token is missing!'}), 401
 
         try:
-            data = jwt.decode(token, app.config['SECRET_KEY'])
-            current_user_doc = db.collection('users').document(data['public_id']).get()
-            current_user = current_user_doc.to_dict()
+            claims = tokens.decode(token)
+            if revocations.is_revoked(claims):
+                raise InvalidToken('Revoked')
+            if 'role' in claims:
+                # The token says who the user is, so nothing has to be loaded.
+                current_user = {field: claims[field] for field in CLAIM_FIELDS}
+            else:
+                current_user = user_cache.get(claims['public_id'], load_user)
+                if current_user is None:
+                    raise KeyError(claims['public_id'])
         except:
             return jsonify({'message': 'Token is invalid!'}), 401
+        g.token_claims = claims
 
+        if request.method in IDEMPOTENT_METHODS and request.headers.get('Idempotency-Key'):
+            return idempotent(f, current_user, *args, **kwargs)
         return f(current_user, *args, **kwargs)
 
     return decorated
 
 
+IDEMPOTENT_METHODS = ('POST', 'PUT', 'DELETE')
+
+
+def idempotent(f, current_user, *args, **kwargs):
+    # A retried write with the same Idempotency-Key gets the first response back instead of being carried out
+    # again.
+    key = request.headers['Idempotency-Key']
+    if len(key) > 255:
+        return jsonify({'message': 'Idempotency-Key can be at most 255 characters'}), 400
+
+    # The body is part of the fingerprint, but uploads are streamed rather than read up front, so they can't take a
+    # key. They don't need one: an import skips the products that already exist, so retrying it is safe.
+    if not request.is_json and (request.content_length or request.headers.get('Transfer-Encoding')):
+        return jsonify({'message': 'Idempotency-Key can only be sent with JSON bodies'}), 400
+    payload = request.get_data()
+
+    def execute():
+        response = make_response(f(current_user, *args, **kwargs))
+        return (response.status_code, [[name, value] for name, value in response.headers if name != 'Content-Length'],
+                response.get_data())
+
+    try:
+        (status, headers, body), outcome = idempotency_store.run(
+            scoped_key(current_user['public_id'], request.method, request.path, key),
+            fingerprint(request.method, request.full_path, payload), execute, app.config['IDEMPOTENCY_WAIT'])
+    except KeyReused:
+        return jsonify({'message': 'That Idempotency-Key was already used for a different request'}), 422
+    except KeyInProgress:
+        return jsonify({'message': 'A request with that Idempotency-Key is still in progress'}), 409
+
+    metrics.idempotent_requests.inc(current_endpoint(), outcome)
+    response = app.response_class(body, status=status, headers=headers)
+    if outcome != 'executed':
+        response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def conditional(collection, key_arg=None):
+    # The ETag is worked out before the handler reads anything, so a write racing with this request
+    # can only make the ETag older than the body, never newer.
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            if key_arg is None:
+                etag = versions.collection_etag(collection, request.query_string)
+            else:
+                etag = versions.document_etag(collection, kwargs[key_arg], request.query_string)
+
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+                response.set_etag(etag)
+                return response
+
+            response = make_response(f(*args, **kwargs))
+            if response.status_code == 200:
+                response.set_etag(etag)
+            return response
+
+        return decorated
+
+    return decorator
+
+
+def coalesced(collection, key_arg):
+    # Concurrent requests for the same document share one handler run, and so one backend call and one serialized
+    # body. A write to the collection from this worker starts a new run, so nobody is handed a body read before
+    # the write they made.
+    def decorator(f):
+        @wraps(f)
+        def decorated(current_user, *args, **kwargs):
+            def load():
+                response = make_response(f(current_user, *args, **kwargs))
+                return response.status_code, response.mimetype, response.get_data()
+
+            key = (kwargs[key_arg], request.query_string, versions.collection_etag(collection))
+            status, mimetype, body = single_flight(f.__name__, key, load)
+            return app.response_class(body, status=status, mimetype=mimetype)
+
+        return decorated
+
+    return decorator
+
+
+def stream_json_array(key, items):
+    # Writes {"<key>": [...]} one element at a time so the whole list is never held in memory.
+    yield '{{"{}":['.format(key).encode('utf-8')
+    first = True
+    for item in items:
+        if not first:
+            yield b','
+        first = False
+        yield json_codec.dumps(item)
+    yield b']}'
+
+
+def stream_ndjson(items):
+    for item in items:
+        yield json_codec.dumps(item) + b'\n'
+
+
+def requested_fields(allowed):
+    if not request.args.get('fields'):
+        return None
+
+    fields = tuple(field.strip() for field in request.args['fields'].split(',') if field.strip())
+    unknown = [field for field in fields if field not in allowed]
+    if unknown:
+        raise ValueError('Unknown fields: ' + ', '.join(unknown))
+    return fields
+
+
+def rma_case_filters():
+    filters = []
+    for field in ('status', 'distribution_company', 'brand'):
+        if request.args.get(field):
+            filters.append((field, '==', request.args[field]))
+
+    date_field = request.args.get('date_field', 'to_be_revised_date')
+    if date_field not in DATE_FIELDS:
+        raise ValueError('Can only filter dates on one of: ' + ', '.join(DATE_FIELDS))
+    try:
+        if request.args.get('from'):
+            filters.append((date_field, '>=', datetime.datetime.strptime(request.args['from'], '%Y-%m-%d')))
+        if request.args.get('to'):
+            filters.append((date_field, '<',
+                            datetime.datetime.strptime(request.args['to'], '%Y-%m-%d') + datetime.timedelta(days=1)))
+    except ValueError:
+        raise ValueError('Dates must be in YYYY-MM-DD format')
+
+    return filters
+
+
 @app.route('/api/rma_cases', methods=['GET'])
 @token_required
 def get_all_rma_cases(current_user):
-    rma_cases = db.collection('rma_cases').get()
+    try:
+        filters = rma_case_filters()
+        fields = requested_fields(RMACase.FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    # Cases are ordered on their id so that `start_after` is a stable cursor. Ids sort by the second they were
+    # created in, so cases created during a walk land after the cursor, bar those from the cursor's own second.
+    # Firestore needs range filters to be ordered on the filtered field, so date-filtered listings page on that date
+    # instead.
+    order_by = next((field for field, op, value in filters if op != '=='), 'id')
+
+    start_after = request.args.get('start_after') or None
+    if start_after and order_by != 'id':
+        try:
+            start_after = datetime.datetime.fromisoformat(start_after)
+        except ValueError:
+            return jsonify({'message': 'Not a valid cursor'}), 400
+
+    # The cursor field has to be read even when it isn't asked for.
+    selected = fields + (order_by,) if fields and order_by not in fields else fields
+    serialize = lambda rma_case: RMACase.serialize(rma_case, fields)
+
+    stream = request.args.get('stream')
+    if stream:
+        rma_cases = (serialize(rma_case)
+                     for rma_case in storage.query('rma_cases', filters=filters, order_by=order_by,
+                                                   start_after=start_after, fields=selected))
+        if stream == 'ndjson':
+            return Response(stream_with_context(stream_ndjson(rma_cases)), mimetype='application/x-ndjson')
+        return Response(stream_with_context(stream_json_array('rma_cases', rma_cases)), mimetype='application/json')
+
+    limit = request.args.get('limit', type=int)
+    if limit is not None:
+        if limit < 1:
+            return jsonify({'message': 'Limit must be a positive number'}), 400
+        limit = min(limit, app.config['MAX_PAGE_SIZE'])
 
     output = []
+    last = None
+
+    for rma_case in storage.query('rma_cases', filters=filters, order_by=order_by, start_after=start_after,
+                                  limit=limit, fields=selected):
+        output.append(serialize(rma_case))
+        last = rma_case
 
-    for rma_case in rma_cases:
-        rma_case = rma_case.to_dict()
-        rma_case_data = {'id': rma_case["id"], 'brand': rma_case["brand"], 'model': rma_case["model"],
-                         'problem': rma_case["problem"], 'serial_number': rma_case["serial_number"],
-                         'distribution_company': rma_case["distribution_company"],
-                         'sent_date': rma_case["sent_date"], 'returned_date': rma_case["sent_date"],
-                         'resolved_date': rma_case["resolved_date"], 'status': rma_case["status"],
-                         'to_be_revised_date': rma_case["to_be_revised_date"],
-                         'unresolved_date': rma_case["unresolved_date"],
-                         'to_be_sent_date': rma_case["to_be_sent_date"],
-                         'to_be_revised_by': rma_case["to_be_revised_by"],
-                         'to_be_sent_by': rma_case["to_be_sent_by"], 'sent_by': rma_case["sent_by"],
-                         'returned_by': rma_case["returned_by"],
-                         'resolved_by': rma_case["resolved_by"], 'unresolved_by': rma_case["unresolved_by"]}
-        output.append(rma_case_data)
-    return jsonify({'rma_cases': output})
+    # A full page means there may be more cases, so hand back the cursor for the next one.
+    next_cursor = None
+    if limit is not None and len(output) == limit:
+        next_cursor = last[order_by]
+        if isinstance(next_cursor, datetime.datetime):
+            next_cursor = next_cursor.isoformat()
+
+    return jsonify({'rma_cases': output, 'next': next_cursor})
 
 
 @app.route('/api/rma_cases', methods=['POST'])
@@ -70,108 +695,235 @@ def get_all_rma_cases(current_user):
 def create_new_rma_case(current_user):
     data = request.get_json()
 
-    new_id = str(uuid.uuid4())[:6]
-    rma_case = db.collection('rma_cases').document(new_id).get().to_dict()
-    while rma_case is not None:
-        new_id = str(uuid.uuid4())[:6]
-        rma_case = db.collection('rma_cases').get().to_dict()
+    if unknown_company(data.get('distribution_company')):
+        return jsonify({'message': 'No distribution company found with that name!'}), 400
+
+    new_id = case_ids.next_id()
 
     new_rma_case = RMACase(case_id=new_id, brand=data['brand'], model=data['model'], problem=data['problem'],
                            serial_number=data['serial_number'], distribution_company=data['distribution_company'],
                            current_user=current_user["first_name"] + ' ' + current_user["last_name"])
+    rma_case = new_rma_case.to_dict()
 
     try:
-        db.collection('rma_cases').document(new_rma_case.id).set(new_rma_case.to_dict())
+        storage.set('rma_cases', new_rma_case.id, rma_case, counters=summary.rma_case(None, rma_case))
+        versions.bump('rma_cases', new_rma_case.id)
+        search_index.put('rma_cases', new_rma_case.id, rma_case)
+        case_columns.put(new_rma_case.id, rma_case)
+        publish_rma_case_event('created', rma_case)
         return jsonify({'message': 'RMA case created successfully!', 'id': new_id})
     except:
-        return jsonify({'message': 'Could not create the RMA case.'})
+        return jsonify({'message': 'Could not create the RMA case.'}), 500
+
+
+@app.route('/api/rma_cases/stats', methods=['GET'])
+@token_required
+def get_rma_case_stats(current_user):
+    try:
+        filters = rma_case_filters()
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
+
+    group_by = request.args.get('group_by', 'distribution_company')
+    if group_by not in GROUP_FIELDS:
+        return jsonify({'message': 'Can only group by one of: ' + ', '.join(GROUP_FIELDS)}), 400
+
+    return jsonify({'stats': turnaround_stats(case_columns.select(storage, filters), group_by)})
+
+
+@app.route('/api/rma_cases/events', methods=['GET'])
+@token_required
+def get_rma_case_events(current_user):
+    subscription = events.subscribe(request.headers.get('Last-Event-ID') or request.args.get('last_event_id'))
+
+    def stream():
+        try:
+            yield 'retry: 3000\n\n'
+            for event in subscription.events(app.config['EVENTS_HEARTBEAT']):
+                yield format_event(event, dumps) if event is not None else ': keep-alive\n\n'
+        finally:
+            events.unsubscribe(subscription)
 
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
-@app.route('/api/rma_cases/<rma_case_id>', methods=['GET'])
+
+@app.route('/api/rma_cases/<case_id:rma_case_id>', methods=['GET'])
 @token_required
+@conditional('rma_cases', 'rma_case_id')
+@coalesced('rma_cases', 'rma_case_id')
 def get_rma_case(current_user, rma_case_id):
-    rma_case = db.collection('rma_cases').document(rma_case_id).get().to_dict()
+    rma_case = storage.get('rma_cases', rma_case_id)
 
     if rma_case is None:
         return jsonify({'message': 'No RMA case found with that id!'})
     else:
-        rma_case_data = {'id': rma_case["id"], 'brand': rma_case["brand"], 'model': rma_case["model"],
-                         'problem': rma_case["problem"], 'serial_number': rma_case["serial_number"],
-                         'distribution_company': rma_case["distribution_company"],
-                         'sent_date': rma_case["sent_date"], 'returned_date': rma_case["sent_date"],
-                         'resolved_date': rma_case["resolved_date"], 'status': rma_case["status"],
-                         'to_be_revised_date': rma_case["to_be_revised_date"],
-                         'unresolved_date': rma_case["unresolved_date"],
-                         'to_be_sent_date': rma_case["to_be_sent_date"],
-                         'to_be_revised_by': rma_case["to_be_revised_by"],
-                         'to_be_sent_by': rma_case["to_be_sent_by"], 'sent_by': rma_case["sent_by"],
-                         'returned_by': rma_case["returned_by"],
-                         'resolved_by': rma_case["resolved_by"], 'unresolved_by': rma_case["unresolved_by"]}
+        return jsonify({'rma_case': RMACase.serialize(rma_case)})
+
+
+# Statuses a case may move to, and the statuses it has to be in for that.
+RMA_TRANSITIONS = {
+    'to_be_sent': ('to_be_revised',),
+    'sent': ('to_be_sent',),
+    'returned': ('sent',),
+    'resolved': ('returned', 'to_be_revised'),
+    'unresolved': ('returned', 'to_be_revised'),
+}
+
+
+def can_modify_rma_cases(current_user):
+    return current_user["role"] in ('admin', 'rma_technician')
+
+
+def rma_case_transition(rma_case, new_status, current_user):
+    if rma_case["status"] not in RMA_TRANSITIONS[new_status]:
+        return None
+
+    return {'status': new_status,
+            new_status + '_by': current_user["first_name"] + ' ' + current_user["last_name"],
+            new_status + '_date': datetime.datetime.now()}
+
 
-        return jsonify({'rma_case': rma_case_data})
+# How often a write that raced another one is read and tried again before giving up.
+WRITE_ATTEMPTS = 3
 
 
-@app.route('/api/rma_cases/<rma_case_id>/<new_status>', methods=['POST'])
+def transition_rma_cases(rma_case_ids, rma_cases, new_status, current_user, messages):
+    # Moves the cases in `rma_cases` (as read) on to `new_status` in one write, which only goes through if none of
+    # them changed status since: otherwise the counters would count the change twice. Cases that did are read
+    # again and checked once more. Returns the updates written, and puts why the other cases weren't in `messages`.
+    for attempt in range(WRITE_ATTEMPTS):
+        updates = dict()
+        for rma_case_id in rma_case_ids:
+            rma_case = rma_cases.get(rma_case_id)
+            if rma_case is None:
+                messages[rma_case_id] = 'No RMA case found'
+                continue
+            updated_info = rma_case_transition(rma_case, new_status, current_user)
+            if updated_info is None:
+                messages[rma_case_id] = 'Not a valid new status'
+                continue
+            messages.pop(rma_case_id, None)
+            updates[rma_case_id] = updated_info
+
+        if not updates:
+            return updates
+        try:
+            storage.update_many('rma_cases', updates, counters=summary.rma_cases(
+                (rma_cases[rma_case_id], dict(rma_cases[rma_case_id], **updated_info))
+                for rma_case_id, updated_info in updates.items()),
+                expected={rma_case_id: {'status': rma_cases[rma_case_id]['status']} for rma_case_id in updates})
+        except (Changed, NotFound):
+            current = storage.get_many('rma_cases', rma_case_ids)
+            for rma_case_id in rma_case_ids:
+                if rma_case_id in current:
+                    rma_cases[rma_case_id] = current[rma_case_id]
+                else:
+                    rma_cases.pop(rma_case_id, None)
+            continue
+
+        for rma_case_id, updated_info in updates.items():
+            rma_cases[rma_case_id].update(updated_info)
+        return updates
+    raise Changed(None)
+
+
+@app.route('/api/rma_cases/<case_id:rma_case_id>/<new_status>', methods=['POST'])
 @token_required
 def modify_rma_case(current_user, rma_case_id, new_status):
-    if current_user["role"] != ('admin' or 'rma_technician'):
+    if not can_modify_rma_cases(current_user):
         return jsonify({'message': 'Not authorized to change a RMA case status.'})
 
-    try:
-        rma_case_doc = db.collection('rma_cases').document(rma_case_id)
-
-        rma_case = rma_case_doc.get().to_dict()
-
-        if new_status not in ['to_be_sent', 'sent', 'returned', 'resolved', 'unresolved']:
-            return jsonify({'message': 'Not a valid status'})
+    if new_status not in RMA_TRANSITIONS:
+        return jsonify({'message': 'Not a valid status'})
 
-        updated_info = dict()
+    try:
+        rma_case = storage.get('rma_cases', rma_case_id)
+        rma_cases = {rma_case_id: rma_case} if rma_case is not None else {}
 
-        if new_status == 'to_be_sent' and rma_case["status"] == 'to_be_revised':
-            updated_info['status'] = 'to_be_sent'
-            updated_info['to_be_sent_by'] = current_user["first_name"] + ' ' + current_user["last_name"]
-            updated_info['to_be_sent_date'] = datetime.datetime.now()
-        elif new_status == 'sent' and rma_case["status"] == 'to_be_sent':
-            updated_info['status'] = 'sent'
-            updated_info['sent_by'] = current_user["first_name"] + ' ' + current_user["last_name"]
-            updated_info['sent_date'] = datetime.datetime.now()
-        elif new_status == 'returned' and rma_case["status"] == 'sent':
-            updated_info['status'] = 'returned'
-            updated_info['returned_by'] = current_user["first_name"] + ' ' + current_user["last_name"]
-            updated_info['returned_date'] = datetime.datetime.now()
-        elif new_status == 'resolved' and rma_case["status"] == ('returned' or 'to_be_revised'):
-            updated_info['status'] = 'resolved'
-            updated_info['resolved_by'] = current_user["first_name"] + ' ' + current_user["last_name"]
-            updated_info['resolved_date'] = datetime.datetime.now()
-        elif new_status == 'unresolved' and rma_case["status"] == ('returned' or 'to_be_revised'):
-            updated_info['status'] = 'unresolved'
-            updated_info['unresolved_by'] = current_user["first_name"] + ' ' + current_user["last_name"]
-            updated_info['unresolved_date'] = datetime.datetime.now()
-        else:
-            return jsonify({'message': 'Not a valid new status'})
+        messages = dict()
+        if not transition_rma_cases([rma_case_id], rma_cases, new_status, current_user, messages):
+            return jsonify({'message': messages[rma_case_id]})
 
-        if updated_info:
-            rma_case_doc.update(updated_info)
+        rma_case = rma_cases[rma_case_id]
+        versions.bump('rma_cases', rma_case_id)
+        search_index.put('rma_cases', rma_case_id, rma_case)
+        case_columns.put(rma_case_id, rma_case)
+        publish_rma_case_event('status', rma_case)
 
         return jsonify({'message': 'RMA case modified successfully!'})
+    except Changed:
+        return jsonify({'message': 'The RMA case kept changing, try again.'}), 409
     except:
         return jsonify({'message': 'No RMA case found'})
 
 
+# Half a write batch, so a chunk's counters fit in the same batch as its cases.
+RMA_CASES_CHUNK = MAX_BATCH_WRITES // 2
+
+
+@app.route('/api/rma_cases/batch/<new_status>', methods=['POST'])
+@token_required
+def modify_rma_cases(current_user, new_status):
+    if not can_modify_rma_cases(current_user):
+        return jsonify({'message': 'Not authorized to change a RMA case status.'})
+
+    if new_status not in RMA_TRANSITIONS:
+        return jsonify({'message': 'Not a valid status'})
+
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('ids'), list):
+        return jsonify({'message': 'Invalid input data'}), 400
+    if len(data['ids']) > app.config['MAX_BATCH_SIZE']:
+        return jsonify({'message': 'Can\'t modify more than {} RMA cases at once'.format(
+            app.config['MAX_BATCH_SIZE'])}), 400
+
+    rma_case_ids = list(dict.fromkeys(normalize_case_id(str(rma_case_id)) for rma_case_id in data['ids']))
+    rma_cases = storage.get_many('rma_cases', rma_case_ids)
+
+    # Written a chunk at a time, each with its own counters. A chunk that fails leaves the ones before it written,
+    # so every case is reported as it ended up and the side effects follow the chunks that made it.
+    messages = dict()
+    modified = set()
+    failed = False
+    for chunk in chunked(rma_case_ids, RMA_CASES_CHUNK):
+        try:
+            updates = transition_rma_cases(chunk, rma_cases, new_status, current_user, messages)
+        except:
+            messages.update((rma_case_id, 'Could not modify the RMA case.') for rma_case_id in chunk)
+            failed = True
+            continue
+
+        modified.update(updates)
+        for rma_case_id in updates:
+            versions.bump('rma_cases', rma_case_id)
+            search_index.put('rma_cases', rma_case_id, rma_cases[rma_case_id])
+            case_columns.put(rma_case_id, rma_cases[rma_case_id])
+            publish_rma_case_event('status', rma_cases[rma_case_id])
+
+    results = [{'id': rma_case_id, 'modified': rma_case_id in modified,
+                'message': 'RMA case modified successfully!' if rma_case_id in modified else messages[rma_case_id]}
+               for rma_case_id in rma_case_ids]
+    if failed:
+        return jsonify({'message': 'Could not modify the RMA cases.', 'results': results}), 500
+
+    return jsonify({'results': results})
+
+
 @app.route('/api/dist_companies', methods=['GET'])
 @token_required
+@conditional('companies')
 def get_all_dist_companies(current_user):
-    dist_companies = db.collection('companies').get()
+    try:
+        fields = requested_fields(DistributionCompany.FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
     output = []
 
-    for dist_company in dist_companies:
-        dist_company = dist_company.to_dict()
-        dist_company_data = {'name': dist_company['name'], 'email': dist_company['email'],
-                             'address': dist_company['address'], 'hours': dist_company['hours'],
-                             'contact_name': dist_company['contact_name'],
-                             'phone': dist_company['phone']}
-        output.append(dist_company_data)
+    for dist_company in storage.query('companies', fields=fields):
+        output.append(DistributionCompany.serialize(dist_company, fields))
     return jsonify({'dist_companies': output})
 
 
@@ -181,7 +933,7 @@ def create_new_dist_company(current_user):
     data = request.get_json()
 
     # Check if product already exists.
-    dist_company = db.collection('companies').document(data['name']).get().to_dict()
+    dist_company = storage.get('companies', data['name'])
 
     if dist_company:
         return jsonify({'message': 'That company already exists'})
@@ -189,69 +941,90 @@ def create_new_dist_company(current_user):
     new_dist_company = DistributionCompany(name=data['name'], email=data['email'], address=data['address'],
                                            hours=data['hours'], contact_name=data['contact_name'],
                                            phone=data['phone'])
+    dist_company = new_dist_company.to_dict()
 
     try:
-        db.collection('companies').document(new_dist_company.name).set(new_dist_company.to_dict())
+        storage.set('companies', new_dist_company.name, dist_company, counters=summary.company(None, dist_company))
+        company_index.put(new_dist_company.name)
+        versions.bump('companies', new_dist_company.name)
         return jsonify({'message': 'Company added successfully!'})
     except:
-        return jsonify({'message': 'Could not add the company'})
+        return jsonify({'message': 'Could not add the company'}), 500
 
 
 @app.route('/api/dist_companies/<dist_company_name>', methods=['GET'])
 @token_required
+@conditional('companies', 'dist_company_name')
+@coalesced('companies', 'dist_company_name')
 def get_dist_company(current_user, dist_company_name):
-    dist_company = db.collection('companies').document(dist_company_name).get().to_dict()
+    dist_company = storage.get('companies', dist_company_name)
 
     if not dist_company:
         return jsonify({'message': 'No distribution company found with that name!'})
 
-    return jsonify({'dist_company': dist_company})
+    return jsonify({'dist_company': DistributionCompany.serialize(dist_company)})
 
 
 @app.route('/api/dist_companies/<dist_company_name>', methods=['PUT'])
 @token_required
 def modify_dist_company(current_user, dist_company_name):
-    dist_company = db.collection('companies').document(dist_company_name)
-
-    if not dist_company:
-        return jsonify({'message': 'No company found with that name!'})
-
     data = request.get_json()
 
     if 'name' in data:
         return jsonify({'message': 'You can\'t change the company name'})
 
-    dist_company.update(data)
+    try:
+        storage.update('companies', dist_company_name, data)
+    except NotFound:
+        return jsonify({'message': 'No company found with that name!'})
+    versions.bump('companies', dist_company_name)
+
     return jsonify({'message': 'Distribution company modified successfully!'})
 
 
+def has_dependents(dist_company_name):
+    # An equality filter on an indexed field with limit=1 is a single index lookup, however big the collection.
+    filters = [('distribution_company', '==', dist_company_name)]
+    return any(any(True for _ in storage.query(collection, filters=filters, fields=[field], limit=1))
+               for collection, field in (('products', 'brand'), ('rma_cases', 'id')))
+
+
 @app.route('/api/dist_companies/<dist_company_name>', methods=['DELETE'])
 @token_required
 def delete_dist_company(current_user, dist_company_name):
-    dist_company = db.collection('companies').document(dist_company_name)
-
-    if not dist_company.get().to_dict():
+    dist_company = storage.get('companies', dist_company_name)
+    if not dist_company:
         return jsonify({'message': 'No company found with that name'})
 
-    dist_company.delete()
+    if has_dependents(dist_company_name):
+        return jsonify({'message': 'The company still has products or RMA cases'}), 409
+
+    storage.delete('companies', dist_company_name, counters=summary.company(dist_company, None))
+    company_index.remove(dist_company_name)
+    versions.bump('companies', dist_company_name)
 
     return jsonify({'message': 'Distribution company deleted successfully!'})
 
 
 @app.route('/api/products', methods=['GET'])
 @token_required
+@conditional('products')
 def get_all_products(current_user):
-    products_docs = db.collection('products').get()
+    filters = []
+    if request.args.get('distribution_company'):
+        filters.append(('distribution_company', '==', request.args['distribution_company']))
+    if request.args.get('stock_under_control'):
+        filters.append(('stock_under_control', '==', parse_bool(request.args['stock_under_control'])))
+
+    try:
+        fields = requested_fields(Product.FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
     output = []
 
-    for product in products_docs:
-        product = product.to_dict()
-        product_data = {'brand': product['brand'], 'model': product['model'],
-                        'description': product['description'], 'stock': product['stock'],
-                        'stock_under_control': product['stock_under_control'],
-                        'distribution_company': product['distribution_company'], 'ean': product['ean']}
-        output.append(product_data)
+    for product in storage.query('products', filters=filters, fields=fields):
+        output.append(Product.serialize(product, fields))
     return jsonify({'products': output})
 
 
@@ -261,7 +1034,7 @@ def create_new_product(current_user):
     data = request.get_json()
 
     # Check if product already exists.
-    product = db.collection('products').document(data['brand'] + ' ' + data['model']).get().to_dict()
+    product = storage.get('products', data['brand'] + ' ' + data['model'])
 
     if product:
         return jsonify({'message': 'That product already exists'})
@@ -280,61 +1053,159 @@ def create_new_product(current_user):
         data['ean'] = ""
     if not data['distribution_company']:
         data['distribution_company'] = ""
+    if unknown_company(data['distribution_company']):
+        return jsonify({'message': 'No distribution company found with that name!'}), 400
 
     new_product = Product(brand=data['brand'], model=data['model'], description=data['description'],
                           stock=data['stock'], stock_under_control=data['stock_under_control'],
                           distribution_company=data['distribution_company'], ean=data['ean'])
+    product = new_product.to_dict()
 
     try:
-        db.collection('products').document(new_product.brand + ' ' + new_product.model).set(new_product.to_dict())
+        storage.set('products', new_product.name, product, counters=summary.product(None, product))
+        ean_index.put(new_product.name, product)
+        search_index.put('products', new_product.name, product)
+        versions.bump('products', new_product.name)
         return jsonify({'message': 'Product added successfully!'})
     except:
-        return jsonify({'message': 'Could not add the product'})
+        return jsonify({'message': 'Could not add the product'}), 500
+
+
+def product_from_row(row):
+    if not row or not row.get('brand') or not row.get('model'):
+        return None
+
+    try:
+        stock = int(row.get('stock') or 0)
+    except (TypeError, ValueError):
+        return None
+
+    return Product(brand=row['brand'], model=row['model'], description=row.get('description') or "",
+                   stock=stock, stock_under_control=parse_bool(row.get('stock_under_control') or False),
+                   distribution_company=row.get('distribution_company') or "", ean=row.get('ean') or "")
+
+
+@app.route('/api/products/import', methods=['POST'])
+@token_required
+def import_products(current_user):
+    if request.args.get('format', 'csv') == 'ndjson' or request.mimetype == 'application/x-ndjson':
+        rows = read_ndjson(request.stream)
+    else:
+        rows = read_csv(request.stream)
+
+    created = 0
+    existing = 0
+    invalid = []
+    row_number = 0
+
+    for chunk in chunked(rows, MAX_BATCH_WRITES):
+        products = []
+        for row in chunk:
+            row_number += 1
+            products.append((row_number, product_from_row(row)))
+
+        # Rows naming a company that doesn't exist are invalid; the chunk's companies are checked all at once.
+        missing = company_index.missing(storage, [product.distribution_company for _, product in products
+                                                  if product is not None and product.distribution_company])
+
+        new_products = dict()
+        for number, product in products:
+            if product is None or product.distribution_company in missing:
+                invalid.append(number)
+                continue
+            if product.name in new_products:
+                existing += 1
+                continue
+            new_products[product.name] = product.to_dict()
+
+        # One existence check per chunk instead of one read per product.
+        for product_name in storage.get_many('products', list(new_products)):
+            del new_products[product_name]
+            existing += 1
+
+        try:
+            storage.set_many('products', new_products,
+                             counters=summary.products((None, product) for product in new_products.values()))
+            for product_name, product in new_products.items():
+                ean_index.put(product_name, product)
+                search_index.put('products', product_name, product)
+                versions.bump('products', product_name)
+        except:
+            return jsonify({'message': 'Could not import the products', 'created': created,
+                            'existing': existing, 'invalid': invalid}), 500
+        created += len(new_products)
+
+    return jsonify({'message': 'Products imported successfully!', 'created': created, 'existing': existing,
+                    'invalid': invalid})
+
+
+@app.route('/api/products/export', methods=['GET'])
+@token_required
+def export_products(current_user):
+    products = storage.query('products')
+
+    if request.args.get('format', 'csv') == 'ndjson':
+        return Response(stream_with_context(stream_ndjson(products)), mimetype='application/x-ndjson')
+
+    return Response(stream_with_context(write_csv(Product.FIELDS, products)), mimetype='text/csv',
+                    headers={'Content-Disposition': 'attachment; filename=products.csv'})
 
 
 @app.route('/api/products/<product_name>', methods=['GET'])
 @token_required
+@conditional('products', 'product_name')
+@coalesced('products', 'product_name')
 def get_product(current_user, product_name):
-    product = db.collection('products').document(product_name).get().to_dict()
+    product = storage.get('products', product_name)
 
     if not product:
         return jsonify({'message': 'No product found!'})
 
-    product_data = {'brand': product['brand'], 'model': product['model'],
-                    'description': product['description'], 'stock': product['stock'],
-                    'stock_under_control': product['stock_under_control'],
-                    'distribution_company': product['distribution_company'], 'ean': product['ean']}
-
-    return jsonify({'product': product_data})
+    return jsonify({'product': Product.serialize(product)})
 
 
 @app.route('/api/products/ean/<ean>', methods=['GET'])
 @token_required
+@coalesced('products', 'ean')
 def get_product_with_ean(current_user, ean):
-    products = db.collection('products').where('ean', '==', ean).get()
+    if app.config['EAN_INDEX']:
+        products = ean_index.lookup(storage, ean)
+    else:
+        products = storage.query('products', filters=[('ean', '==', ean)])
 
     output = []
     for product in products:
-        product = product.to_dict()
-        if not product:
-            return jsonify({'message': 'No product found with that EAN!'})
+        output.append(Product.serialize(product))
 
-        product_data = {'brand': product['brand'], 'model': product['model'],
-                        'description': product['description'], 'stock': product['stock'],
-                        'stock_under_control': product['stock_under_control'],
-                        'distribution_company': product['distribution_company'], 'ean': product['ean']}
+    return jsonify({'products': output})
 
-        output.append(product_data)
 
-    return jsonify({'products': output})
+@app.route('/api/products/ean', methods=['POST'])
+@token_required
+def get_products_with_eans(current_user):
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('eans'), list):
+        return jsonify({'message': 'Invalid input data'}), 400
+    if len(data['eans']) > app.config['MAX_BATCH_SIZE']:
+        return jsonify({'message': 'Can\'t look up more than {} EANs at once'.format(
+            app.config['MAX_BATCH_SIZE'])}), 400
+
+    if app.config['EAN_INDEX']:
+        matches = ean_index.lookup_many(storage, data['eans'])
+    else:
+        matches = {ean: list(storage.query('products', filters=[('ean', '==', ean)])) for ean in data['eans']}
+
+    return jsonify({'products': {ean: [Product.serialize(product) for product in products]
+                                 for ean, products in matches.items()}})
 
 
 @app.route('/api/products/<product_name>', methods=['PUT'])
 @token_required
 def modify_product(current_user, product_name):
-    product_doc = db.collection('products').document(product_name)
+    product = storage.get('products', product_name)
 
-    if not product_doc.get().to_dict():
+    if not product:
         return jsonify({'message': 'No product found!'})
 
     data = request.get_json()
@@ -348,43 +1219,207 @@ def modify_product(current_user, product_name):
     if 'stock_under_control' in data:
         updated_info['stock_under_control'] = data['stock_under_control']
     if 'distribution_company' in data:
+        if unknown_company(data['distribution_company']):
+            return jsonify({'message': 'No distribution company found with that name!'}), 400
         updated_info['distribution_company'] = data['distribution_company']
     if 'ean' in data:
         updated_info['ean'] = data['ean']
     if updated_info:
-        product_doc.update(updated_info)
+        # The counters only move with the company, so a write that moves them checks the company is still the one
+        # they were worked out from.
+        for attempt in range(WRITE_ATTEMPTS):
+            counters = summary.product(product, dict(product, **updated_info))
+            try:
+                storage.update('products', product_name, updated_info, counters=counters,
+                               expected={'distribution_company': product.get('distribution_company')}
+                               if counters else None)
+                break
+            except Changed:
+                product = storage.get('products', product_name)
+            except NotFound:
+                product = None
+            if not product:
+                return jsonify({'message': 'No product found!'})
+        else:
+            return jsonify({'message': 'The product kept changing, try again.'}), 409
+        product.update(updated_info)
+        ean_index.put(product_name, product)
+        search_index.put('products', product_name, product)
+        versions.bump('products', product_name)
 
     return jsonify({'message': 'Product modified successfully!'})
 
 
+def is_quantity(value):
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+STOCK_FIELD_NAMES = {'stock': 'stock', 'reserved': 'reserved stock'}
+
+
+def change_stock(adjustments, strict):
+    # Plain changes are sent as increments and never read the products first; strict ones (and reservations)
+    # run in a transaction so stock can't go below zero.
+    try:
+        if strict:
+            products = storage.adjust('products', adjustments, 0)
+        else:
+            storage.increment('products', adjustments)
+            products = storage.get_many('products', list(adjustments))
+    except NotFound:
+        return jsonify({'message': 'No product found!'}), 404
+    except BelowMinimum as e:
+        # Reserving runs out of stock; releasing runs out of what's reserved.
+        return jsonify({'message': 'Not enough {} for {}'.format(STOCK_FIELD_NAMES.get(e.field, e.field), e.key),
+                        'product': e.key, 'field': e.field}), 409
+
+    output = dict()
+    for product_name, product in products.items():
+        ean_index.put(product_name, product)
+        versions.bump('products', product_name)
+        output[product_name] = {'stock': product['stock'], 'reserved': product.get('reserved', 0),
+                                'low_stock': bool(product.get('stock_under_control')) and
+                                product['stock'] <= app.config['LOW_STOCK_THRESHOLD']}
+
+    return jsonify({'message': 'Stock updated successfully!', 'products': output})
+
+
+@app.route('/api/products/<product_name>/stock', methods=['POST'])
+@token_required
+def change_product_stock(current_user, product_name):
+    data = request.get_json()
+
+    if not data or not is_quantity(data.get('delta')):
+        return jsonify({'message': 'Invalid input data'}), 400
+
+    return change_stock({product_name: {'stock': data['delta']}}, data.get('strict', False))
+
+
+@app.route('/api/products/stock', methods=['POST'])
+@token_required
+def change_products_stock(current_user):
+    data = request.get_json()
+
+    if not data or not isinstance(data.get('items'), list):
+        return jsonify({'message': 'Invalid input data'}), 400
+    if len(data['items']) > MAX_BATCH_WRITES:
+        return jsonify({'message': 'Can\'t change more than {} products at once'.format(MAX_BATCH_WRITES)}), 400
+
+    adjustments = dict()
+    for item in data['items']:
+        if not isinstance(item, dict) or not item.get('product') or not is_quantity(item.get('delta')):
+            return jsonify({'message': 'Invalid input data'}), 400
+        # Several lines for the same product are added up into one change.
+        adjustment = adjustments.setdefault(item['product'], {'stock': 0})
+        adjustment['stock'] += item['delta']
+
+    return change_stock(adjustments, data.get('strict', False))
+
+
+@app.route('/api/products/<product_name>/reserve', methods=['POST'])
+@token_required
+def reserve_product_stock(current_user, product_name):
+    data = request.get_json()
+
+    if not data or not is_quantity(data.get('quantity')) or data['quantity'] < 1:
+        return jsonify({'message': 'Invalid input data'}), 400
+
+    return change_stock({product_name: {'stock': -data['quantity'], 'reserved': data['quantity']}}, True)
+
+
+@app.route('/api/products/<product_name>/release', methods=['POST'])
+@token_required
+def release_product_stock(current_user, product_name):
+    data = request.get_json()
+
+    if not data or not is_quantity(data.get('quantity')) or data['quantity'] < 1:
+        return jsonify({'message': 'Invalid input data'}), 400
+
+    return change_stock({product_name: {'stock': data['quantity'], 'reserved': -data['quantity']}}, True)
+
+
 @app.route('/api/products/<product_name>', methods=['DELETE'])
 @token_required
 def delete_product(current_user, product_name):
-    product_doc = db.collection('products').document(product_name)
-
     try:
-        product_doc.delete()
+        product = storage.get('products', product_name)
+        if not product:
+            return jsonify({'message': 'No product found!'})
+
+        storage.delete('products', product_name, counters=summary.product(product, None))
+        ean_index.remove(product_name)
+        search_index.remove('products', product_name)
+        versions.bump('products', product_name)
         return jsonify({'message': 'Product deleted successfully!'})
     except:
         return jsonify({'message': 'No product found!'})
 
 
+@app.route('/api/summary', methods=['GET'])
+@token_required
+def get_summary(current_user):
+    return jsonify({'summary': summary.read(storage)})
+
+
+@app.route('/api/summary/rebuild', methods=['POST'])
+@token_required
+def rebuild_summary(current_user):
+    if not current_user['role'] == 'admin':
+        return jsonify({'message': 'Invalid permissions'})
+
+    return jsonify({'message': 'Summary rebuilt successfully!', 'summary': summary.rebuild(storage)})
+
+
+SEARCH_TYPES = {'product': 'products', 'rma_case': 'rma_cases'}
+
+
+@app.route('/api/search', methods=['GET'])
+@token_required
+def search(current_user):
+    if not app.config['SEARCH']:
+        return jsonify({'message': 'Search is turned off'}), 503
+
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'message': 'Nothing to search for'}), 400
+
+    types = request.args.get('type')
+    collections = None
+    if types:
+        types = [search_type.strip() for search_type in types.split(',')]
+        unknown = [search_type for search_type in types if search_type not in SEARCH_TYPES]
+        if unknown:
+            return jsonify({'message': 'Unknown types: ' + ', '.join(unknown)}), 400
+        collections = {SEARCH_TYPES[search_type] for search_type in types}
+
+    limit = request.args.get('limit', 20, type=int)
+    if limit < 1:
+        return jsonify({'message': 'Limit must be a positive number'}), 400
+
+    output = []
+    for collection, key, score, doc in search_index.search(query, collections,
+                                                           min(limit, app.config['SEARCH_MAX_RESULTS'])):
+        search_type = 'product' if collection == 'products' else 'rma_case'
+        output.append({'type': search_type, 'id': key, 'score': round(score, 3), search_type: doc})
+
+    return jsonify({'results': output})
+
+
 @app.route('/api/users', methods=['GET'])
 @token_required
 def get_all_users(current_user):
     if not current_user['role'] == 'admin':
         return jsonify({'message': 'Invalid permissions'})
 
-    users = db.collection('users').get()
+    try:
+        fields = requested_fields(User.PUBLIC_FIELDS)
+    except ValueError as e:
+        return jsonify({'message': str(e)}), 400
 
     output = []
 
-    for user in users:
-        user = user.to_dict()
-        user_data = {'public_id': user['public_id'], 'username': user['username'], 'first_name': user['first_name'],
-                     'last_name': user['last_name'], 'email': user['email'],
-                     'role': user['role']}
-        output.append(user_data)
+    for user in storage.query('users', fields=fields):
+        output.append(User.serialize(user, fields))
     return jsonify({'users': output})
 
 
@@ -406,7 +1441,7 @@ def create_new_user(current_user):
                     last_name=data['last_name'] if 'last_name' in data else None,
                     role=data['role'])
 
-    db.collection('users').document(new_user.public_id).set(new_user.to_dict())
+    storage.set('users', new_user.public_id, new_user.to_dict())
 
     return jsonify({'message': 'New user created!'})
 
@@ -417,16 +1452,13 @@ def get_user(current_user, user_public_id):
     if not current_user['role'] == 'admin':
         return jsonify({'message': 'Invalid permissions'})
 
-    user_doc = db.collection('users').document(user_public_id).get()
+    user = storage.get('users', user_public_id)
 
-    try:
-        user = user_doc.to_dict()
-        user_data = {'public_id': user['public_id'], 'username': user['username'], 'first_name': user['first_name'],
-                     'last_name': user['last_name'], 'email': user['email'], 'role': user['role']}
-        return jsonify({'user': user_data})
-    except:
+    if user is None:
         return jsonify({'message': 'No user found!'})
 
+    return jsonify({'user': User.serialize(user)})
+
 
 @app.route('/api/users/<user_public_id>', methods=['PUT'])
 @token_required
@@ -436,8 +1468,6 @@ def modify_user(current_user, user_public_id):
 
     data = request.get_json()
 
-    user_doc = db.collection('users').document(user_public_id)
-
     try:
         updated_info = dict()
         if 'email' in data:
@@ -449,9 +1479,12 @@ def modify_user(current_user, user_public_id):
         if 'role' in data:
             updated_info['role'] = data['role']
         if 'password' in data:
-            updated_info['password'] = generate_password_hash(data['password'], method='SHA256')
+            updated_info['password'] = hasher.hash(data['password'])
         if updated_info:
-            user_doc.update(updated_info)
+            storage.update('users', user_public_id, updated_info)
+            user_cache.invalidate(user_public_id)
+            if set(updated_info) & {'role', 'first_name', 'last_name', 'password'}:
+                revoke_user_tokens(user_public_id, refresh_tokens='password' in updated_info)
     except:
         return jsonify({'message': 'No user found!'})
 
@@ -464,15 +1497,24 @@ def delete_user(current_user, user_public_id):
     if not current_user['role'] == 'admin':
         return jsonify({'message': 'Invalid permissions'})
 
-    user_doc = db.collection('users').document(user_public_id)
-
     try:
-        user_doc.delete()
+        storage.delete('users', user_public_id)
+        user_cache.invalidate(user_public_id)
+        revoke_user_tokens(user_public_id, refresh_tokens=True)
         return jsonify({'message': 'User deleted successfully!'})
     except:
         return jsonify({'message': 'No user found!'})
 
 
+@app.route('/api/users/cache', methods=['GET'])
+@token_required
+def get_user_cache_stats(current_user):
+    if not current_user['role'] == 'admin':
+        return jsonify({'message': 'Invalid permissions'})
+
+    return jsonify({'user_cache': user_cache.stats()})
+
+
 @app.route('/api/auth')
 def login():
     auth = request.authorization
@@ -480,20 +1522,66 @@ def login():
     if not auth or not auth.username or not auth.password:
         return make_response('Could not verify', 401, {'WWW-Authenticate': 'Basic realm="Login Required!"'})
 
-    user_doc = db.collection('users').where('username', '==', auth.username).limit(1).get()
+    user = next(storage.query('users', filters=[('username', '==', auth.username)], limit=1), None)
     try:
-        for user in user_doc:
-            user = user.to_dict()
-        if check_password_hash(user['password'], auth.password):
-            token = jwt.encode(
-                {'public_id': user['public_id'], 'exp': datetime.datetime.utcnow() + datetime.timedelta(hours=24)},
-                app.config['SECRET_KEY'])
-            return jsonify({'token': token.decode('UTF-8')})
+        if hasher.verify(auth.username, user['password'], auth.password):
+            # Hashes made with an older method or cost are upgraded while we have the plain password.
+            if hasher.needs_rehash(user['password']):
+                storage.update('users', user['public_id'], {'password': hasher.hash(auth.password)})
+                user_cache.invalidate(user['public_id'])
+            if app.config['TOKEN_FORMAT'] == 'claims':
+                return jsonify(token_pair(user))
+            return jsonify({'token': tokens.legacy_token(user, app.config['LEGACY_TOKEN_TTL'])})
 
         return make_response('Could not verify', 401, {'WWW-Authenticate': 'Basic realm="Login Required!"'})
+    except HasherBusy:
+        return make_response('Too many login attempts, try again later', 429)
     except:
         return make_response('Could not verify', 401, {'WWW-Authenticate': 'Basic realm="Login Required!"'})
 
 
+@app.route('/api/auth/refresh', methods=['POST'])
+def refresh():
+    data = request.get_json(silent=True) or {}
+
+    try:
+        claims = tokens.decode(data.get('refresh_token') or '', 'refresh')
+    except InvalidToken:
+        return jsonify({'message': 'Token is invalid!'}), 401
+
+    # Refreshing is rare enough to also check storage for revocations other workers haven't passed on yet, and
+    # to read the user again so the new access token has their current role and name.
+    revocations.load(storage.get_many('revocations', ['token:' + claims['jti'],
+                                                      'user:' + claims['public_id']]).values())
+    user = storage.get('users', claims['public_id'])
+    if user is None or revocations.is_revoked(claims):
+        return jsonify({'message': 'Token is invalid!'}), 401
+
+    # A refresh token is good for one refresh; the new one replaces it.
+    revoke_token(claims)
+    return jsonify(token_pair(user))
+
+
+@app.route('/api/auth/logout', methods=['POST'])
+@token_required
+def logout(current_user):
+    # Legacy tokens have no id to revoke them by; they just run out.
+    if 'jti' in g.token_claims:
+        revoke_token(g.token_claims)
+
+    data = request.get_json(silent=True) or {}
+    if data.get('refresh_token'):
+        try:
+            claims = tokens.decode(data['refresh_token'], 'refresh')
+        except InvalidToken:
+            return jsonify({'message': 'Token is invalid!'}), 400
+        if claims['public_id'] == current_user['public_id']:
+            revoke_token(claims)
+
+    return jsonify({'message': 'Logged out successfully!'})
+
+
 if __name__ == '__main__':
-    app.run(debug=True, host="0.0.0.0")
+    # Development server only; see gunicorn.conf.py for serving in production.
+    warm_up.run()
+    app.run(debug=app.config['DEBUG'], host="0.0.0.0")
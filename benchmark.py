@@ -0,0 +1,280 @@
+"""Drives api.py with concurrent in-process clients against a fake Firestore and reports how it held up.
+
+    python3 benchmark.py --clients 16 --duration 20 --latency 8 --mix read=10,list=2,ean=6,transition=2,login=1
+
+Each client is a thread with its own Flask test client, so the numbers measure the app and its backend round
+trips rather than a web server. Backend calls are the Firestore RPCs a request made, counted by the fake.
+"""
+
+import argparse
+import json
+import os
+import random
+import threading
+import time
+from base64 import b64encode
+
+from google.cloud import firestore
+
+from lib.fake_firestore import FakeClient
+from lib.ids import encode as encode_case_id
+
+PASSWORD = 'benchmark'
+STATUSES = ('to_be_revised', 'to_be_sent', 'sent', 'returned', 'resolved')
+NEXT_STATUS = dict(zip(STATUSES, STATUSES[1:]))
+DEFAULT_MIX = 'login=1,read=10,list=2,ean=6,transition=2'
+
+
+def parse_mix(mix):
+    weights = dict()
+    for part in mix.split(','):
+        name, _, weight = part.partition('=')
+        if name not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation: {}'.format(name))
+        weights[name] = float(weight or 1)
+    return weights
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+class Dataset(object):
+    def __init__(self, companies, products, cases, clients):
+        self.companies = ['Company {}'.format(n) for n in range(companies)]
+        self.products = ['Brand{} Model{}'.format(n % 25, n) for n in range(products)]
+        self.eans = ['84{:011d}'.format(n) for n in range(products)]
+        self.cases = dict()
+        self.usernames = ['technician{}'.format(n) for n in range(clients)]
+        self._lock = threading.Lock()
+
+        for n in range(1, cases + 1):
+            self.cases[encode_case_id(n)] = STATUSES[n % len(STATUSES)]
+
+    def load(self, client, password_hash):
+        client.load('companies', {name: {'name': name, 'email': None, 'address': None, 'hours': None,
+                                         'contact_name': None, 'phone': None} for name in self.companies})
+        client.load('products', {name: {'brand': name.split(' ')[0], 'model': name.split(' ')[1],
+                                        'description': 'Benchmark product', 'stock': 10, 'reserved': 0,
+                                        'stock_under_control': n % 2 == 0,
+                                        'distribution_company': self.companies[n % len(self.companies)],
+                                        'ean': self.eans[n]}
+                                 for n, name in enumerate(self.products)})
+        client.load('rma_cases', {case_id: dict({'id': case_id, 'brand': 'Brand1', 'model': 'Model1',
+                                                 'problem': 'Does not turn on', 'serial_number': case_id,
+                                                 'distribution_company': self.companies[0], 'status': status,
+                                                 'to_be_revised_date': None, 'to_be_sent_date': None,
+                                                 'sent_date': None, 'returned_date': None, 'resolved_date': None,
+                                                 'unresolved_date': None},
+                                                **{s + '_by': None for s in STATUSES + ('unresolved',)})
+                                  for case_id, status in self.cases.items()})
+        client.load('users', {username: {'public_id': username, 'username': username, 'password': password_hash,
+                                         'email': None, 'first_name': 'Bench', 'last_name': username,
+                                         'role': 'rma_technician'}
+                              for username in self.usernames})
+
+    def any_case(self, rng):
+        with self._lock:
+            return rng.choice(list(self.cases)) if self.cases else encode_case_id(1)
+
+    def take_case(self, rng):
+        # Hands out a case that can still move on, so two clients never race on the same transition.
+        with self._lock:
+            open_cases = [case_id for case_id, status in self.cases.items() if status in NEXT_STATUS]
+            if not open_cases:
+                return None, None
+            case_id = rng.choice(open_cases)
+            return case_id, self.cases.pop(case_id)
+
+    def return_case(self, case_id, status):
+        with self._lock:
+            self.cases[case_id] = status
+
+
+def auth_headers(username):
+    credentials = b64encode('{}:{}'.format(username, PASSWORD).encode('utf-8')).decode('ascii')
+    return {'Authorization': 'Basic ' + credentials}
+
+
+def do_login(session):
+    response = session.client.get('/api/auth', headers=auth_headers(session.username))
+    if response.status_code == 200:
+        session.headers = {'x-access-token': response.get_json()['token']}
+    return response
+
+
+def do_read(session):
+    data, rng = session.data, session.rng
+    path = rng.choice(('/api/products/' + rng.choice(data.products),
+                       '/api/rma_cases/' + data.any_case(rng),
+                       '/api/dist_companies/' + rng.choice(data.companies)))
+    return session.client.get(path, headers=session.headers)
+
+
+def do_list(session):
+    path = session.rng.choice(('/api/products?distribution_company=' + session.rng.choice(session.data.companies),
+                               '/api/rma_cases?limit=50&status=' + session.rng.choice(STATUSES),
+                               '/api/dist_companies'))
+    return session.client.get(path, headers=session.headers)
+
+
+def do_ean(session):
+    return session.client.get('/api/products/ean/' + session.rng.choice(session.data.eans), headers=session.headers)
+
+
+def do_transition(session):
+    case_id, status = session.data.take_case(session.rng)
+    if case_id is None:
+        return session.client.post('/api/rma_cases', headers=session.headers,
+                                   json={'brand': 'Brand1', 'model': 'Model1', 'problem': 'Does not turn on',
+                                         'serial_number': 'SN', 'distribution_company': session.data.companies[0]})
+
+    new_status = NEXT_STATUS[status]
+    try:
+        response = session.client.post('/api/rma_cases/{}/{}'.format(case_id, new_status), headers=session.headers)
+    except Exception:
+        session.data.return_case(case_id, status)
+        raise
+    modified = response.get_json().get('message') == 'RMA case modified successfully!'
+    session.data.return_case(case_id, new_status if modified else status)
+    return response
+
+
+OPERATIONS = {
+    'login': do_login,
+    'read': do_read,
+    'list': do_list,
+    'ean': do_ean,
+    'transition': do_transition,
+}
+
+
+class Session(object):
+    def __init__(self, app, data, username, seed):
+        self.client = app.test_client()
+        self.data = data
+        self.username = username
+        self.rng = random.Random(seed)
+        self.headers = {}
+
+
+class Results(object):
+    def __init__(self):
+        self.latencies = dict()
+        self.calls = dict()
+        self.errors = dict()
+        self._lock = threading.Lock()
+
+    def record(self, operation, elapsed, calls, ok):
+        with self._lock:
+            self.latencies.setdefault(operation, []).append(elapsed)
+            self.calls.setdefault(operation, []).append(calls)
+            self.errors[operation] = self.errors.get(operation, 0) + (0 if ok else 1)
+
+    def summary(self, duration):
+        rows = dict()
+        for operation in sorted(self.latencies) + ['total']:
+            if operation == 'total':
+                latencies = [value for values in self.latencies.values() for value in values]
+                calls = [value for values in self.calls.values() for value in values]
+                errors = sum(self.errors.values())
+            else:
+                latencies, calls, errors = self.latencies[operation], self.calls[operation], self.errors[operation]
+            rows[operation] = {
+                'requests': len(latencies),
+                'errors': errors,
+                'throughput': len(latencies) / duration,
+                'p50_ms': percentile(latencies, 0.5) * 1000,
+                'p99_ms': percentile(latencies, 0.99) * 1000,
+                'backend_calls': sum(calls) / len(calls) if calls else 0.0,
+            }
+        return rows
+
+
+def run_client(session, fake, weights, deadline, results, failures):
+    names, values = list(weights), list(weights.values())
+    try:
+        do_login(session)
+        while time.perf_counter() < deadline:
+            operation = session.rng.choices(names, values)[0]
+            before = fake.thread_calls()
+            start = time.perf_counter()
+            response = OPERATIONS[operation](session)
+            response.get_data()
+            elapsed = time.perf_counter() - start
+            results.record(operation, elapsed, fake.thread_calls() - before, response.status_code < 400)
+    except Exception as e:
+        failures.append(e)
+
+
+def print_report(rows, calls, duration):
+    print('{:<12} {:>9} {:>7} {:>9} {:>9} {:>9} {:>14}'.format(
+        'operation', 'requests', 'errors', 'req/s', 'p50 ms', 'p99 ms', 'backend/req'))
+    for operation, row in rows.items():
+        print('{:<12} {:>9} {:>7} {:>9.1f} {:>9.2f} {:>9.2f} {:>14.2f}'.format(
+            operation, row['requests'], row['errors'], row['throughput'], row['p50_ms'], row['p99_ms'],
+            row['backend_calls']))
+    print()
+    print('Backend calls in {:.1f}s: {}'.format(duration, ', '.join(
+        '{}={}'.format(name, count) for name, count in sorted(calls.items()))))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--duration', type=float, default=10, help='seconds to run for')
+    parser.add_argument('--latency', type=float, default=5, help='milliseconds added to every backend call')
+    parser.add_argument('--jitter', type=float, default=0, help='up to this many extra random milliseconds')
+    parser.add_argument('--mix', type=parse_mix, default=DEFAULT_MIX,
+                        help='operation weights, from: ' + ', '.join(OPERATIONS))
+    parser.add_argument('--companies', type=int, default=20)
+    parser.add_argument('--products', type=int, default=1000)
+    parser.add_argument('--cases', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true', help='print the results as JSON')
+    args = parser.parse_args()
+
+    # api.py builds its storage client from firestore.Client, so the fake has to be in place first.
+    fake = FakeClient()
+    firestore.Client = lambda *client_args, **client_kwargs: fake
+    os.environ['SUKKIRI_STORAGE'] = 'firestore'
+    os.environ.setdefault('SUKKIRI_SECRET_KEY', 'benchmark')
+    import api
+
+    data = Dataset(args.companies, args.products, args.cases, args.clients)
+    data.load(fake, api.hasher.hash(PASSWORD))
+    api.warm_up.run()
+    fake.reset_calls()
+    fake.latency, fake.jitter = args.latency / 1000.0, args.jitter / 1000.0
+
+    results = Results()
+    failures = []
+    start = time.perf_counter()
+    deadline = start + args.duration
+    threads = [threading.Thread(target=run_client,
+                                args=(Session(api.app, data, username, args.seed + n), fake, args.mix, deadline,
+                                      results, failures))
+               for n, username in enumerate(data.usernames)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    duration = time.perf_counter() - start
+    api.hasher.shutdown()
+
+    if failures:
+        raise failures[0]
+
+    rows = results.summary(duration)
+    if args.json:
+        print(json.dumps({'duration': duration, 'clients': args.clients, 'latency_ms': args.latency,
+                          'operations': rows, 'backend_calls': dict(fake.calls)}, indent=2))
+    else:
+        print_report(rows, fake.calls, duration)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
-from google.cloud import firestore
+import os
 
 from lib.classes import User
+from lib.storage import create_storage
 
 email = input("Admin email:")
 username = input("Admin username:")
@@ -15,7 +16,7 @@ new_user = User(email=email if 'email' in email else None,
                 last_name=last_name if 'last_name' in last_name else None,
                 role="admin")
 
-db = firestore.Client()
-db.collection('users').document(new_user.public_id).set(new_user.to_dict())
+storage = create_storage(os.getenv('SUKKIRI_STORAGE', 'firestore'), os.getenv('SUKKIRI_DATABASE_URI'))
+storage.set('users', new_user.public_id, new_user.to_dict())
 
 print("User created successfully!")
@@ -0,0 +1,67 @@
+# gunicorn.conf.py
+#
+# Production serving: gunicorn -c gunicorn.conf.py api:app
+
+import multiprocessing
+import os
+import sys
+import time
+
+bind = os.getenv('SUKKIRI_BIND', '0.0.0.0:5000')
+workers = int(os.getenv('SUKKIRI_WORKERS', multiprocessing.cpu_count() * 2 + 1))
+
+# gevent workers keep many slow Firestore calls (and idle event streams) in flight per process. 'sync' works
+# too, at one request per worker.
+worker_class = os.getenv('SUKKIRI_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('SUKKIRI_WORKER_CONNECTIONS', 1000))
+
+# Workers are recycled after a while, staggered so they don't all restart at once.
+max_requests = int(os.getenv('SUKKIRI_MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.getenv('SUKKIRI_MAX_REQUESTS_JITTER', 1000))
+
+timeout = int(os.getenv('SUKKIRI_WORKER_TIMEOUT', 30))
+# How long a new worker waits for its warm-up before taking connections. A worker only starts reporting to the
+# arbiter once it takes connections, so this has to stay well under `timeout`: past it, the warm-up goes on in the
+# background, requests wait for it and /ready answers 503 until it's done.
+warm_up_wait = float(os.getenv('SUKKIRI_WARM_UP_WAIT', timeout / 2))
+graceful_timeout = int(os.getenv('SUKKIRI_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('SUKKIRI_KEEPALIVE', 5))
+
+# The app is imported by each worker after the fork: gRPC channels, the password hashing pool and the caches
+# can't be shared across a fork, so every worker builds its own storage client once, in its warm-up.
+preload_app = False
+
+accesslog = os.getenv('SUKKIRI_ACCESS_LOG', '-')
+
+
+def post_fork(server, worker):
+    worker.import_started = time.perf_counter()
+
+    if worker_class == 'gevent':
+        # gRPC has to be switched to gevent's event loop before api.py creates the Firestore client.
+        from gevent import monkey
+        monkey.patch_all()
+
+        import grpc.experimental.gevent
+        grpc.experimental.gevent.init_gevent()
+
+
+def post_worker_init(worker):
+    # Runs after the worker has imported the app and before it accepts its first connection, so requests don't
+    # land on a cold worker during a rolling deploy unless the warm-up takes longer than `warm_up_wait`.
+    import api
+
+    import_duration = time.perf_counter() - worker.import_started
+    api.metrics.startup_duration.set(import_duration, 'import')
+    api.warm_up.start()
+    if not api.warm_up.wait(warm_up_wait):
+        # A failed warm-up is tried again on the worker's first request.
+        worker.log.warning('Taking connections before the warm-up is done: %s', api.warm_up.status())
+    worker.log.info('Worker started: import %.2fs, %s', import_duration,
+                    ', '.join('{} {:.2f}s'.format(step, duration) for step, duration in api.warm_up.durations.items()))
+
+
+def worker_exit(server, worker):
+    api = sys.modules.get('api')
+    if api is not None:
+        api.hasher.shutdown()
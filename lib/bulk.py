@@ -0,0 +1,52 @@
+# lib/bulk.py
+
+import csv
+import io
+import itertools
+import json
+
+
+def chunked(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def read_csv(stream):
+    # The upload is wrapped rather than read, so rows are parsed as they arrive. Spreadsheets often start their CSV
+    # exports with a byte order mark, which would otherwise end up in the first column's name.
+    return csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+
+
+def read_ndjson(stream):
+    for line in io.TextIOWrapper(stream, encoding='utf-8-sig'):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            # Bad lines come through as None so the caller can report them and carry on.
+            yield None
+
+
+def write_csv(fields, rows):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+
+    writer.writeheader()
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+
+def parse_bool(value):
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ('1', 'true', 'yes', 'y')
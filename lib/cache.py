@@ -0,0 +1,51 @@
+# lib/cache.py
+
+import threading
+
+from cachetools import TTLCache
+
+
+class RecordCache(object):
+    def __init__(self, maxsize, ttl):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        with self._lock:
+            record = self._cache.get(key)
+            if record is not None:
+                self.hits += 1
+                return record
+            self.misses += 1
+            generation = self._generation
+
+        # Loading happens outside the lock so a slow backend read doesn't block other keys.
+        record = loader(key)
+        if record is not None:
+            with self._lock:
+                # Don't store a record that was invalidated while we were loading it.
+                if generation == self._generation:
+                    self._cache[key] = record
+        return record
+
+    def put(self, key, record):
+        with self._lock:
+            self._cache[key] = record
+
+    def invalidate(self, key):
+        with self._lock:
+            self._generation += 1
+            self._cache.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._cache),
+                    'maxsize': self._cache.maxsize, 'ttl': self._cache.ttl}
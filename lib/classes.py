@@ -3,41 +3,60 @@
 import datetime
 import uuid
 
-from werkzeug.security import generate_password_hash
+from lib.passwords import hasher
 
 
-class User(object):
+def serialize(doc, fields, defaults=None):
+    # Turns a stored document into a response body by copying just `fields`, without building a model first.
+    if defaults:
+        return {field: doc.get(field, defaults.get(field)) for field in fields}
+    return {field: doc.get(field) for field in fields}
+
+
+class Model(object):
+    __slots__ = ()
+
+    # The stored fields, in the order they're written out. Subclasses use them as their __slots__ too.
+    FIELDS = ()
+    # The fields handed out by the API.
+    PUBLIC_FIELDS = ()
+    # Values for fields that documents stored before the field existed don't have.
+    DEFAULTS = {}
+
+    @classmethod
+    def serialize(cls, doc, fields=None):
+        return serialize(doc, fields or cls.PUBLIC_FIELDS, cls.DEFAULTS)
+
+    def to_dict(self):
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join('{}={}'.format(field, getattr(self, field))
+                                                               for field in self.PUBLIC_FIELDS))
+
+
+class User(Model):
+    FIELDS = ('public_id', 'username', 'password', 'email', 'first_name', 'last_name', 'role')
+    # The password hash is never handed out, so it can't be projected either.
+    PUBLIC_FIELDS = ('public_id', 'username', 'first_name', 'last_name', 'email', 'role')
+    __slots__ = FIELDS
+
     def __init__(self, username, email, first_name, last_name, password, role):
         self.public_id = str(uuid.uuid4())
         self.username = username
         self.email = email
         self.first_name = first_name
         self.last_name = last_name
-        self.password_hash = generate_password_hash(password, method='SHA256')
+        # Only the hash is kept, under the name it's stored with.
+        self.password = hasher.hash(password)
         self.role = role
 
-    def to_dict(self):
-        return {
-            'public_id': self.public_id,
-            'username': self.username,
-            'password': self.password_hash,
-            'email': self.email,
-            'first_name': self.first_name,
-            'last_name': self.last_name,
-            'role': self.role
-        }
-
-    def __repr__(self):
-        return (
-            'User(public_id={}, username={}, email={}, first_name={}, last_name={}, role={})'.format(self.public_id,
-                                                                                                     self.username,
-                                                                                                     self.email,
-                                                                                                     self.first_name,
-                                                                                                     self.last_name,
-                                                                                                     self.role))
 
+class DistributionCompany(Model):
+    FIELDS = ('name', 'email', 'address', 'hours', 'contact_name', 'phone')
+    PUBLIC_FIELDS = FIELDS
+    __slots__ = FIELDS
 
-class DistributionCompany(object):
     def __init__(self, name, email, address, hours, contact_name, phone):
         self.name = name
         self.email = email
@@ -46,28 +65,16 @@ class DistributionCompany(object):
         self.contact_name = contact_name
         self.phone = phone
 
-    def to_dict(self):
-        return {
-            'name': self.name,
-            'email': self.email,
-            'address': self.address,
-            'hours': self.hours,
-            'contact_name': self.contact_name,
-            'phone': self.phone
-        }
-
-    def __repr__(self):
-        return (
-            'Distribution Company(name={}, email={}, address={}, hours={}, contact_name={}, phone={})'.format(
-                self.name,
-                self.email,
-                self.address,
-                self.hours,
-                self.contact_name,
-                self.phone))
 
+class RMACase(Model):
+    DATE_FIELDS = ('to_be_revised_date', 'to_be_sent_date', 'sent_date', 'returned_date', 'resolved_date',
+                   'unresolved_date')
+    BY_FIELDS = ('to_be_revised_by', 'to_be_sent_by', 'sent_by', 'returned_by', 'resolved_by', 'unresolved_by')
+    FIELDS = ('id', 'brand', 'model', 'problem', 'serial_number', 'distribution_company', 'status') + \
+        DATE_FIELDS + BY_FIELDS
+    PUBLIC_FIELDS = FIELDS
+    __slots__ = FIELDS
 
-class RMACase(object):
     def __init__(self, case_id, brand, model, problem, serial_number, distribution_company, current_user):
         self.id = case_id
         self.brand = brand
@@ -89,47 +96,24 @@ class RMACase(object):
         self.resolved_by = None
         self.unresolved_by = None
 
-    def to_dict(self):
-        return {
-            'id': self.id,
-            'brand': self.brand,
-            'model': self.model,
-            'problem': self.problem,
-            'serial_number': self.serial_number,
-            'distribution_company': self.distribution_company,
-            'sent_date': self.sent_date,
-            'returned_date': self.returned_date,
-            'resolved_date': self.resolved_date,
-            'status': self.status,
-            'to_be_revised_date': self.to_be_revised_date,
-            'unresolved_date': self.unresolved_date,
-            'to_be_sent_date': self.to_be_sent_date,
-            'to_be_revised_by': self.to_be_revised_by,
-            'to_be_sent_by': self.to_be_sent_by,
-            'sent_by': self.sent_by,
-            'returned_by': self.returned_by,
-            'resolved_by': self.resolved_by,
-            'unresolved_by': self.unresolved_by
-        }
-
-
-class Product(object):
-    def __init__(self, brand, model, description, stock, stock_under_control, distribution_company, ean):
+
+class Product(Model):
+    FIELDS = ('brand', 'model', 'description', 'stock', 'reserved', 'stock_under_control', 'distribution_company',
+              'ean')
+    PUBLIC_FIELDS = FIELDS
+    DEFAULTS = {'reserved': 0}
+    __slots__ = FIELDS
+
+    def __init__(self, brand, model, description, stock, stock_under_control, distribution_company, ean, reserved=0):
         self.brand = brand
         self.model = model
         self.description = description
         self.stock = stock
+        self.reserved = reserved
         self.stock_under_control = stock_under_control
         self.distribution_company = distribution_company
         self.ean = ean
 
-    def to_dict(self):
-        return {
-            'brand': self.brand,
-            'model': self.model,
-            'description': self.description,
-            'stock': self.stock,
-            'stock_under_control': self.stock_under_control,
-            'distribution_company': self.distribution_company,
-            'ean': self.ean
-        }
+    @property
+    def name(self):
+        return self.brand + ' ' + self.model
@@ -0,0 +1,60 @@
+# lib/companies.py
+
+import threading
+import time
+
+
+class CompanyIndex(object):
+    # The names of every distribution company, so references to them can be checked without a read per write. With
+    # a `ttl`, a name is looked up in storage again once it's been known for `ttl` seconds, which is how companies
+    # other workers deleted get dropped when nothing reports their changes.
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._names = dict()
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def warm(self, storage):
+        names = {company['name'] for company in storage.query('companies', fields=['name'])}
+        now = time.monotonic()
+        with self._lock:
+            self._names = {name: now for name in names}
+            self.ready = True
+
+    def put(self, name):
+        with self._lock:
+            self._names[name] = time.monotonic()
+
+    def remove(self, name):
+        with self._lock:
+            self._names.pop(name, None)
+
+    def refresh(self, storage, names):
+        companies = storage.get_many('companies', names)
+        now = time.monotonic()
+        with self._lock:
+            for name in names:
+                if name in companies:
+                    self._names[name] = now
+                else:
+                    self._names.pop(name, None)
+
+    def _known(self, name, now):
+        known_since = self._names.get(name)
+        return known_since is not None and (self.ttl is None or now - known_since < self.ttl)
+
+    def exists(self, storage, name):
+        return not self.missing(storage, [name])
+
+    def missing(self, storage, names):
+        # The names from `names` that aren't companies. A company another worker just added isn't known here yet,
+        # so names missing from the index, or known for too long, are looked up in storage before they're answered.
+        now = time.monotonic()
+        with self._lock:
+            unknown = [name for name in set(names) if not self._known(name, now)]
+        if not unknown:
+            return set()
+        self.refresh(storage, unknown)
+        with self._lock:
+            return {name for name in unknown if name not in self._names}
@@ -0,0 +1,69 @@
+# lib/compression.py
+
+import gzip
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Event streams are left alone: compressing them would hold events back until a block fills up.
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain')
+
+
+def choose_encoding(accept_encodings):
+    # Brotli gives smaller bodies for about the same CPU, so it wins whenever the client takes both.
+    if brotli is not None and accept_encodings['br']:
+        return 'br'
+    if accept_encodings['gzip']:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding, gzip_level, brotli_quality):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return gzip.compress(data, gzip_level)
+
+
+def compress_stream(chunks, encoding, gzip_level, brotli_quality):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=brotli_quality)
+        compress_chunk, finish = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        compress_chunk, finish = compressor.compress, compressor.flush
+
+    for chunk in chunks:
+        data = compress_chunk(chunk)
+        if data:
+            yield data
+    yield finish()
+
+
+def compress_response(response, accept_encodings, min_size, gzip_level, brotli_quality):
+    if (response.status_code < 200 or response.status_code in (204, 304) or response.direct_passthrough or
+            'Content-Encoding' in response.headers or response.mimetype not in COMPRESSIBLE_TYPES):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(accept_encodings)
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        # Streamed exports have no size up front; they are compressed on the fly as they're written.
+        response.response = compress_stream(response.iter_encoded(), encoding, gzip_level, brotli_quality)
+    else:
+        data = response.get_data()
+        if len(data) < min_size:
+            return response
+        response.set_data(compress(data, encoding, gzip_level, brotli_quality))
+
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body is a different byte sequence, so its ETag can only match weakly.
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
@@ -0,0 +1,78 @@
+# lib/ean_index.py
+
+import threading
+import time
+
+
+class EANIndex(object):
+    # The products carrying each EAN, so a lookup is answered from memory. Writes made by this worker are put in as
+    # they happen, and a listener puts in the ones other workers make. Without one, the products of an EAN are read
+    # from storage again once they've been kept for `ttl` seconds, which bounds how stale a lookup (stock included)
+    # can be. EANs nothing is known about are always looked up in storage, since another worker may have just added
+    # the product.
+
+    def __init__(self, ttl=None):
+        self.ttl = ttl
+        self._products = dict()
+        self._by_ean = dict()
+        self._loaded = dict()
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def warm(self, storage):
+        products = {product['brand'] + ' ' + product['model']: product for product in storage.query('products')}
+        now = time.monotonic()
+        with self._lock:
+            self._products = dict()
+            self._by_ean = dict()
+            for product_name, product in products.items():
+                self._put(product_name, product)
+            self._loaded = {ean: now for ean in self._by_ean}
+            self.ready = True
+
+    def _put(self, product_name, product):
+        self._remove(product_name)
+        self._products[product_name] = product
+        if product.get('ean'):
+            self._by_ean.setdefault(product['ean'], dict())[product_name] = product
+
+    def _remove(self, product_name):
+        product = self._products.pop(product_name, None)
+        if product is not None and product.get('ean'):
+            products = self._by_ean.get(product['ean'], {})
+            products.pop(product_name, None)
+            if not products:
+                self._by_ean.pop(product['ean'], None)
+                self._loaded.pop(product['ean'], None)
+
+    def _fresh(self, ean, now):
+        loaded = self._loaded.get(ean)
+        return ean in self._by_ean and (self.ttl is None or loaded is not None and now - loaded < self.ttl)
+
+    def put(self, product_name, product):
+        with self._lock:
+            self._put(product_name, dict(product))
+
+    def remove(self, product_name):
+        with self._lock:
+            self._remove(product_name)
+
+    def lookup(self, storage, ean):
+        return self.lookup_many(storage, [ean])[ean]
+
+    def lookup_many(self, storage, eans):
+        now = time.monotonic()
+        with self._lock:
+            output = {ean: list(self._by_ean[ean].values()) for ean in eans if self._fresh(ean, now)}
+
+        for ean in set(eans) - set(output):
+            products = list(storage.query('products', filters=[('ean', '==', ean)]))
+            with self._lock:
+                for product_name in list(self._by_ean.get(ean, {})):
+                    self._remove(product_name)
+                for product in products:
+                    self._put(product['brand'] + ' ' + product['model'], product)
+                if products:
+                    self._loaded[ean] = now
+            output[ean] = products
+        return output
@@ -0,0 +1,90 @@
+# lib/events.py
+
+import collections
+import queue
+import threading
+import uuid
+
+
+class Event(object):
+    def __init__(self, event_id, kind, data):
+        self.id = event_id
+        self.kind = kind
+        self.data = data
+
+
+class Subscription(object):
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.overflowed = False
+
+    def events(self, heartbeat):
+        # Yields None every `heartbeat` seconds without events so the caller can keep the connection alive.
+        while not self.overflowed:
+            try:
+                yield self.queue.get(timeout=heartbeat)
+            except queue.Empty:
+                yield None
+
+
+class EventBus(object):
+    def __init__(self, history, queue_size):
+        # Event ids carry a per-process token, so an id handed out by another worker is never resumed from.
+        self.token = uuid.uuid4().hex[:8]
+        self.queue_size = queue_size
+        self._next = 1
+        self._history = collections.deque(maxlen=history)
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+
+    def publish(self, kind, data):
+        with self._lock:
+            event = Event('{}-{}'.format(self.token, self._next), kind, data)
+            self._next += 1
+            self._history.append((self._next - 1, event))
+            subscriptions = list(self._subscriptions)
+
+        for subscription in subscriptions:
+            try:
+                subscription.queue.put_nowait(event)
+            except queue.Full:
+                # A client that can't keep up is cut off; it reconnects with Last-Event-ID and catches up
+                # from the history instead of holding events for everyone else.
+                subscription.overflowed = True
+                self.unsubscribe(subscription)
+
+    def _missed(self, last_event_id):
+        token, _, number = last_event_id.partition('-')
+        if token != self.token or not number.isdigit():
+            return None
+
+        number = int(number)
+        if self._history and self._history[0][0] > number + 1:
+            return None
+        return [event for event_number, event in self._history if event_number > number]
+
+    def subscribe(self, last_event_id=None):
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            if last_event_id:
+                # Clients too far behind are told to reload instead of being replayed a partial history.
+                missed = self._missed(last_event_id)
+                if missed is None or len(missed) > self.queue_size:
+                    missed = [Event(None, 'reset', {})]
+                for event in missed:
+                    subscription.queue.put_nowait(event)
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+
+def format_event(event, dumps):
+    lines = []
+    if event.id is not None:
+        lines.append('id: {}'.format(event.id))
+    lines.append('event: {}'.format(event.kind))
+    lines.append('data: {}'.format(dumps(event.data)))
+    return '\n'.join(lines) + '\n\n'
@@ -0,0 +1,327 @@
+# lib/fake_firestore.py
+
+import collections
+import operator
+import queue
+import random
+import threading
+import time
+import uuid
+
+from google.api_core.exceptions import NotFound
+from google.cloud.firestore_v1.transforms import Increment
+from google.cloud.firestore_v1.watch import ChangeType
+
+from lib.storage import FILTER_OPERATORS
+
+
+class FakeSnapshot(object):
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+
+class FakeChange(object):
+    def __init__(self, change_type, document):
+        self.type = change_type
+        self.document = document
+
+
+class FakeWatch(object):
+    def __init__(self, client, collection, callback):
+        self._client = client
+        self.collection = collection
+        self.callback = callback
+
+    def unsubscribe(self):
+        self._client._unwatch(self)
+
+
+class FakeDocumentReference(object):
+    def __init__(self, client, collection, key):
+        self._client = client
+        self.collection = collection
+        self.id = key
+
+    def get(self, field_paths=None, transaction=None):
+        self._client._rpc('get')
+        return FakeSnapshot(self, self._client._read(self.collection, self.id))
+
+    def set(self, data, merge=False):
+        self._client._rpc('set')
+        self._client._apply([('merge' if merge else 'set', self, data)])
+
+    def update(self, data):
+        self._client._rpc('update')
+        self._client._apply([('update', self, data)])
+
+    def delete(self):
+        self._client._rpc('delete')
+        self._client._apply([('delete', self, None)])
+
+
+class FakeQuery(object):
+    def __init__(self, client, collection, fields=None, filters=(), order_by=None, start_after=None, limit=None):
+        self._client = client
+        self._collection = collection
+        self._fields = fields
+        self._filters = filters
+        self._order_by = order_by
+        self._start_after = start_after
+        self._limit = limit
+
+    def _copy(self, **changes):
+        options = dict(fields=self._fields, filters=self._filters, order_by=self._order_by,
+                       start_after=self._start_after, limit=self._limit)
+        options.update(changes)
+        return FakeQuery(self._client, self._collection, **options)
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def where(self, field_path, op_string, value):
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path):
+        return self._copy(order_by=field_path)
+
+    def start_after(self, document_fields):
+        return self._copy(start_after=document_fields[self._order_by])
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def stream(self):
+        self._client._rpc('query')
+        # Like Firestore, results without an explicit order come back sorted by document id.
+        docs = sorted(self._client._scan(self._collection), key=operator.itemgetter(0))
+
+        for field, op, value in self._filters:
+            compare = FILTER_OPERATORS[op]
+            docs = [(key, doc) for key, doc in docs if doc.get(field) is not None and compare(doc[field], value)]
+        if self._order_by is not None:
+            docs = [(key, doc) for key, doc in docs if doc.get(self._order_by) is not None]
+            docs.sort(key=lambda item: item[1][self._order_by])
+            if self._start_after is not None:
+                docs = [(key, doc) for key, doc in docs if doc[self._order_by] > self._start_after]
+        if self._limit is not None:
+            docs = docs[:self._limit]
+
+        for key, doc in docs:
+            if self._fields:
+                doc = {field: doc[field] for field in self._fields if field in doc}
+            yield FakeSnapshot(FakeDocumentReference(self._client, self._collection, key), doc)
+
+    def get(self):
+        return self.stream()
+
+
+class FakeCollectionReference(FakeQuery):
+    def __init__(self, client, collection):
+        super(FakeCollectionReference, self).__init__(client, collection)
+        self.id = collection
+
+    def document(self, document_id=None):
+        return FakeDocumentReference(self._client, self._collection, document_id or uuid.uuid4().hex[:20])
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self._collection, callback)
+
+
+class FakeWriteBatch(object):
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(('merge' if merge else 'set', reference, data))
+
+    def update(self, reference, data):
+        self._writes.append(('update', reference, data))
+
+    def delete(self, reference):
+        self._writes.append(('delete', reference, None))
+
+    def commit(self):
+        self._client._rpc('commit')
+        self._client._apply(self._writes)
+        self._writes = []
+
+
+class FakeTransaction(FakeWriteBatch):
+    # Implements the private surface firestore.transactional drives. Transactions run one at a time instead of
+    # detecting conflicts, so they never abort; writes made outside a transaction don't wait for them.
+    def __init__(self, client, max_attempts=5):
+        super(FakeTransaction, self).__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._transaction_lock.acquire()
+        self._client._rpc('begin_transaction')
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        if self._id is None:
+            return
+        try:
+            self._client._rpc('rollback')
+        finally:
+            self._clean_up()
+            self._client._transaction_lock.release()
+
+    def _commit(self):
+        try:
+            self._client._rpc('commit')
+            self._client._apply(self._writes)
+        finally:
+            self._clean_up()
+            self._client._transaction_lock.release()
+
+
+class FakeClient(object):
+    """In-process stand-in for the parts of firestore.Client that FirestoreStorage uses.
+
+    Every call that would be a round trip to Firestore sleeps for `latency` seconds (plus up to `jitter`) and is
+    counted, both in total per operation and for the calling thread.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.calls = collections.Counter()
+        self._collections = collections.defaultdict(dict)
+        self._watches = collections.defaultdict(list)
+        self._changes = None
+        self._lock = threading.Lock()
+        self._transaction_lock = threading.Lock()
+        self._local = threading.local()
+
+    def _rpc(self, operation):
+        with self._lock:
+            self.calls[operation] += 1
+        self._local.calls = getattr(self._local, 'calls', 0) + 1
+        delay = self.latency + (random.random() * self.jitter if self.jitter else 0.0)
+        if delay:
+            time.sleep(delay)
+
+    def thread_calls(self):
+        # Calls made so far from the current thread; the difference around a request is its backend cost.
+        return getattr(self._local, 'calls', 0)
+
+    def reset_calls(self):
+        with self._lock:
+            self.calls.clear()
+
+    def load(self, collection, docs):
+        # Seeds documents directly, without latency or counting.
+        with self._lock:
+            for key, data in docs.items():
+                self._collections[collection][key] = dict(data)
+
+    def _read(self, collection, key):
+        with self._lock:
+            doc = self._collections[collection].get(key)
+            return dict(doc) if doc is not None else None
+
+    def _scan(self, collection):
+        with self._lock:
+            return [(key, dict(doc)) for key, doc in self._collections[collection].items()]
+
+    def _apply(self, writes):
+        # Checks every write before making any of them, so a batch either lands whole or not at all.
+        with self._lock:
+            for kind, reference, data in writes:
+                if kind == 'update' and reference.id not in self._collections[reference.collection]:
+                    raise NotFound('No document to update: {}/{}'.format(reference.collection, reference.id))
+
+            changed = []
+            for kind, reference, data in writes:
+                docs = self._collections[reference.collection]
+                if kind == 'delete':
+                    docs.pop(reference.id, None)
+                    if self._watches[reference.collection]:
+                        changed.append((reference, ChangeType.REMOVED, None))
+                    continue
+
+                change_type = ChangeType.MODIFIED if reference.id in docs else ChangeType.ADDED
+
+                doc = dict() if kind == 'set' else docs.get(reference.id, {})
+                for field, value in data.items():
+                    if isinstance(value, Increment):
+                        value = (doc.get(field) or 0) + value.value
+                    doc[field] = value
+                docs[reference.id] = doc
+                if self._watches[reference.collection]:
+                    changed.append((reference, change_type, dict(doc)))
+
+        if changed:
+            self._changes.put((None, changed))
+
+    def _watch(self, collection, callback):
+        watch = FakeWatch(self, collection, callback)
+        with self._lock:
+            self._watches[collection].append(watch)
+            if self._changes is None:
+                # Listeners are called from their own thread, as Firestore does, so their reads aren't
+                # charged to the request that made the change.
+                self._changes = queue.Queue()
+                threading.Thread(target=self._deliver, daemon=True).start()
+            # Like Firestore, the first snapshot lists every document as added.
+            initial = [(FakeDocumentReference(self, collection, key), ChangeType.ADDED, dict(doc))
+                       for key, doc in self._collections[collection].items()]
+            self._changes.put((watch, initial))
+        return watch
+
+    def _unwatch(self, watch):
+        with self._lock:
+            if watch in self._watches[watch.collection]:
+                self._watches[watch.collection].remove(watch)
+
+    def _deliver(self):
+        while True:
+            # `only` is the watch an initial snapshot is meant for; changes from writes go to every watch.
+            only, changed = self._changes.get()
+            if only is not None:
+                only.callback(None, [FakeChange(change_type, FakeSnapshot(reference, data))
+                                     for reference, change_type, data in changed], None)
+                continue
+
+            by_collection = collections.OrderedDict()
+            for reference, change_type, data in changed:
+                by_collection.setdefault(reference.collection, []).append(
+                    FakeChange(change_type, FakeSnapshot(reference, data)))
+
+            for collection, changes in by_collection.items():
+                with self._lock:
+                    watches = list(self._watches[collection])
+                for watch in watches:
+                    watch.callback(None, changes, None)
+
+    def collection(self, collection):
+        return FakeCollectionReference(self, collection)
+
+    def document(self, path):
+        collection, key = path.split('/', 1)
+        return FakeDocumentReference(self, collection, key)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        self._rpc('get_all')
+        for reference in references:
+            yield FakeSnapshot(reference, self._read(reference.collection, reference.id))
+
+    def batch(self):
+        return FakeWriteBatch(self)
+
+    def transaction(self, max_attempts=5):
+        return FakeTransaction(self, max_attempts)
@@ -0,0 +1,110 @@
+# lib/idempotency.py
+
+import hashlib
+import json
+import logging
+import threading
+import time
+
+from cachetools import TTLCache
+
+
+class KeyReused(Exception):
+    pass
+
+
+class KeyInProgress(Exception):
+    pass
+
+
+def scoped_key(*parts):
+    # Keys are only unique per client, so they're scoped to the user and the route. Hashing also makes them safe
+    # to use as document ids.
+    return hashlib.sha256('\n'.join(parts).encode('utf-8')).hexdigest()
+
+
+def fingerprint(*parts):
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(part if isinstance(part, bytes) else str(part).encode('utf-8'))
+        digest.update(b'\n')
+    return digest.hexdigest()
+
+
+class IdempotencyStore(object):
+    # Remembers the response to each write sent with an Idempotency-Key, so a retried request gets the same answer
+    # instead of being carried out again. Responses are kept `ttl` seconds in this process and, when `storage` is
+    # given, in the shared 'idempotency_keys' collection too, so a retry that lands on another worker is also
+    # answered from the first response.
+
+    def __init__(self, maxsize, ttl, storage=None):
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._storage = storage
+        self._in_flight = dict()
+        self._lock = threading.Lock()
+
+    def _load(self, key):
+        doc = self._storage.get('idempotency_keys', key)
+        if doc is None or doc['expires'] < time.time():
+            return None
+        return doc['fingerprint'], (doc['status'], json.loads(doc['headers']), doc['body'])
+
+    def _save(self, key, entry):
+        fingerprint, (status, headers, body) = entry
+        self._storage.set('idempotency_keys', key, {'fingerprint': fingerprint, 'status': status,
+                                                    'headers': json.dumps(headers), 'body': body,
+                                                    'expires': time.time() + self.ttl})
+
+    def _replay(self, entry, request_fingerprint, outcome):
+        if entry[0] != request_fingerprint:
+            raise KeyReused()
+        return entry[1], outcome
+
+    def run(self, key, request_fingerprint, execute, timeout):
+        # Returns the response and whether it was 'executed', 'replayed' or 'coalesced'. `execute` returns a
+        # (status, headers, body) response, which is kept unless it's a server error: those are worth retrying for
+        # real. A request that arrives while the same key is being carried out waits for that and gets its
+        # response.
+        outcome = 'replayed'
+        while True:
+            with self._lock:
+                entry = self._cache.get(key)
+                in_flight = self._in_flight.get(key)
+                leader = entry is None and in_flight is None
+                if leader:
+                    in_flight = self._in_flight[key] = threading.Event()
+
+            if entry is not None:
+                return self._replay(entry, request_fingerprint, outcome)
+            if leader:
+                break
+            if not in_flight.wait(timeout):
+                raise KeyInProgress()
+            outcome = 'coalesced'
+
+        try:
+            if self._storage is not None:
+                entry = self._load(key)
+                if entry is not None:
+                    with self._lock:
+                        self._cache[key] = entry
+                    return self._replay(entry, request_fingerprint, 'replayed')
+
+            response = execute()
+            if response[0] < 500:
+                entry = (request_fingerprint, response)
+                with self._lock:
+                    self._cache[key] = entry
+                if self._storage is not None:
+                    try:
+                        self._save(key, entry)
+                    except Exception:
+                        # The write itself went through, so it's still answered; only a retry that reaches
+                        # another worker could repeat it.
+                        logging.getLogger(__name__).exception('Could not save the response to %s', key)
+            return response, 'executed'
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+            in_flight.set()
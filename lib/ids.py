@@ -0,0 +1,66 @@
+# lib/ids.py
+
+import os
+import threading
+import time
+
+# Crockford's base32: no I, L, O or U, so ids read back over the counter can't be mistyped into another id.
+ALPHABET = '0123456789ABCDEFGHJKMNPQRSTVWXYZ'
+TYPO_FIXES = str.maketrans({'O': '0', 'I': '1', 'L': '1'})
+
+# An id is the second it was made in (counted from EPOCH), the number of the process that made it and a sequence
+# within that second, each written with a fixed number of characters so ids sort by the second they were made in.
+EPOCH = 1577836800  # 2020-01-01 UTC
+SECOND_LENGTH = 6
+PROCESS_LENGTH = 3
+SEQUENCE_LENGTH = 2
+ID_LENGTH = SECOND_LENGTH + PROCESS_LENGTH + SEQUENCE_LENGTH
+# Ids handed out from leased counter blocks; they all sort before the ones above, which start with the seconds.
+LEASED_ID_LENGTH = 7
+
+
+def encode(number, length=LEASED_ID_LENGTH):
+    digits = []
+    while number:
+        number, digit = divmod(number, len(ALPHABET))
+        digits.append(ALPHABET[digit])
+    return ''.join(reversed(digits)).rjust(length, ALPHABET[0])
+
+
+def normalize(case_id):
+    # Only base32 ids are fixed up; the six character ids handed out before them are matched exactly.
+    if len(case_id) not in (ID_LENGTH, LEASED_ID_LENGTH):
+        return case_id
+    return case_id.upper().translate(TYPO_FIXES)
+
+
+class CaseIdAllocator(object):
+    def __init__(self, storage, counter):
+        self.storage = storage
+        self.counter = counter
+        self._pid = None
+        self._process = None
+        self._second = -1
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self):
+        # Only the process number comes from storage, once per process, so allocating an id doesn't touch storage.
+        # Two processes never share a number among the last len(ALPHABET) ** PROCESS_LENGTH processes started, so
+        # their ids can't collide. A process that runs out of sequence numbers within a second moves on to the next
+        # one early, which keeps its ids unique and in order.
+        with self._lock:
+            if self._pid != os.getpid():
+                self._process = self.storage.increment_counter(self.counter, 1) % len(ALPHABET) ** PROCESS_LENGTH
+                self._pid = os.getpid()
+            second = max(int(time.time()) - EPOCH, self._second)
+            if second == self._second:
+                self._sequence += 1
+                if self._sequence == len(ALPHABET) ** SEQUENCE_LENGTH:
+                    second += 1
+                    self._sequence = 0
+            else:
+                self._sequence = 0
+            self._second = second
+            return (encode(second, SECOND_LENGTH) + encode(self._process, PROCESS_LENGTH) +
+                    encode(self._sequence, SEQUENCE_LENGTH))
@@ -0,0 +1,188 @@
+# lib/metrics.py
+
+import bisect
+import threading
+import time
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 500)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                          for name, value in zip(names, values)) + '}'
+
+
+class Counter(object):
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def value(self, *label_values):
+        with self._lock:
+            return self._values.get(label_values, 0)
+
+    def samples(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        for label_values, value in values:
+            yield self.name, format_labels(self.labels, label_values), value
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(object):
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.buckets = buckets
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        # Counts are kept per bucket and only made cumulative when scraped, to keep observe() cheap.
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._values.get(label_values)
+            if series is None:
+                series = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = sorted((label_values, (list(series[0]), series[1], series[2]))
+                            for label_values, series in self._values.items())
+        for label_values, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                yield (self.name + '_bucket', format_labels(self.labels + ('le',), label_values + (bound,)),
+                       cumulative)
+            yield self.name + '_sum', format_labels(self.labels, label_values), total
+            yield self.name + '_count', format_labels(self.labels, label_values), count
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labels=()):
+        return self.register(Counter(name, description, labels))
+
+    def gauge(self, name, description, labels=()):
+        return self.register(Gauge(name, description, labels))
+
+    def histogram(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        return self.register(Histogram(name, description, labels, buckets))
+
+    def exposition(self):
+        lines = []
+        for metric in self._metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_latency = registry.histogram('sukkiri_request_duration_seconds', 'Time spent handling a request.',
+                                     ('endpoint', 'method'))
+request_errors = registry.counter('sukkiri_request_errors_total', 'Requests answered with a 4xx or 5xx status.',
+                                  ('endpoint', 'method', 'status'))
+response_size = registry.histogram('sukkiri_response_size_bytes', 'Size of response bodies.',
+                                   ('endpoint', 'method'), SIZE_BUCKETS)
+backend_latency = registry.histogram('sukkiri_backend_duration_seconds', 'Time spent in storage backend calls.',
+                                     ('endpoint', 'operation'))
+backend_reads = registry.histogram('sukkiri_backend_reads_per_request', 'Storage reads made by one request.',
+                                   ('endpoint',), COUNT_BUCKETS)
+backend_writes = registry.histogram('sukkiri_backend_writes_per_request', 'Storage writes made by one request.',
+                                    ('endpoint',), COUNT_BUCKETS)
+idempotent_requests = registry.counter('sukkiri_idempotent_requests_total',
+                                       'Writes sent with an Idempotency-Key, by whether they were executed, replayed '
+                                       'from a stored response or coalesced onto one in flight.',
+                                       ('endpoint', 'outcome'))
+collapsed_calls = registry.counter('sukkiri_collapsed_calls_total',
+                                   'Lookups that shared a backend call already in flight instead of making their own.',
+                                   ('call',))
+startup_duration = registry.gauge('sukkiri_startup_duration_seconds',
+                                  'Time this worker spent importing the app and on each warm-up step.', ('step',))
+
+BACKEND_READS = ('get', 'get_many', 'query', 'get_counters')
+BACKEND_WRITES = ('set', 'set_many', 'update', 'update_many', 'increment', 'adjust', 'delete', 'increment_counter',
+                  'set_counters')
+
+
+def timed_iterator(iterator, observe):
+    # Only the time spent inside the backend's iterator is counted, not what the caller does between items.
+    elapsed = 0.0
+    try:
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                elapsed += time.perf_counter() - start
+            yield item
+    finally:
+        observe(elapsed)
+
+
+class InstrumentedStorage(object):
+    def __init__(self, storage, current_endpoint, request_counts):
+        self._storage = storage
+        self._current_endpoint = current_endpoint
+        self._request_counts = request_counts
+
+    def __getattr__(self, name):
+        attribute = getattr(self._storage, name)
+        if name not in BACKEND_READS and name not in BACKEND_WRITES:
+            return attribute
+
+        def timed(*args, **kwargs):
+            endpoint = self._current_endpoint()
+            counts = self._request_counts()
+            if counts is not None:
+                counts[0 if name in BACKEND_READS else 1] += 1
+
+            if name == 'query':
+                return timed_iterator(attribute(*args, **kwargs),
+                                      lambda elapsed: backend_latency.observe(elapsed, endpoint, name))
+
+            start = time.perf_counter()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                backend_latency.observe(time.perf_counter() - start, endpoint, name)
+
+        return timed
@@ -0,0 +1,79 @@
+# lib/passwords.py
+
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash, check_password_hash
+
+
+class HasherBusy(Exception):
+    pass
+
+
+class PasswordHasher(object):
+    def __init__(self, method='pbkdf2:sha256:150000', workers=0, per_user_limit=2, queue_timeout=5):
+        self._pool = None
+        self._pool_lock = threading.Lock()
+        self._users = dict()
+        self._users_lock = threading.Lock()
+        self.configure(method, workers, per_user_limit, queue_timeout)
+
+    def configure(self, method, workers, per_user_limit, queue_timeout):
+        self.method = method
+        self.workers = workers
+        self.per_user_limit = per_user_limit
+        self.queue_timeout = queue_timeout
+        # Lets a few hashes queue up behind the ones running before callers get turned away.
+        self._slots = threading.BoundedSemaphore(max(workers, 1) * 4)
+
+    def _executor(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def start(self):
+        # Forks the pool workers now, before the storage client starts any threads of its own.
+        if self.workers:
+            self._executor().submit(int).result()
+
+    def _run(self, function, *args):
+        if not self.workers:
+            return function(*args)
+
+        if not self._slots.acquire(timeout=self.queue_timeout):
+            raise HasherBusy()
+        try:
+            return self._executor().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method)
+
+    def verify(self, username, password_hash, password):
+        with self._users_lock:
+            running = self._users.get(username, 0)
+            if running >= self.per_user_limit:
+                raise HasherBusy()
+            self._users[username] = running + 1
+
+        try:
+            return self._run(check_password_hash, password_hash, password)
+        finally:
+            with self._users_lock:
+                self._users[username] -= 1
+                if not self._users[username]:
+                    del self._users[username]
+
+    def needs_rehash(self, password_hash):
+        return password_hash.split('$', 1)[0] != self.method
+
+    def shutdown(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.shutdown()
+                self._pool = None
+
+
+hasher = PasswordHasher()
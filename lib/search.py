@@ -0,0 +1,302 @@
+# lib/search.py
+
+import heapq
+import json
+import os
+import re
+import tempfile
+import threading
+import time
+import unicodedata
+
+# How much a match in each field counts towards a document's score.
+SEARCH_FIELDS = {
+    'products': {'brand': 2.0, 'model': 3.0, 'description': 1.0, 'ean': 4.0},
+    'rma_cases': {'serial_number': 4.0, 'brand': 2.0, 'model': 2.0, 'problem': 1.0},
+}
+# What a result carries, so a hit can be shown without reading the document.
+RESULT_FIELDS = {
+    'products': ('brand', 'model', 'description', 'ean', 'distribution_company'),
+    'rma_cases': ('id', 'brand', 'model', 'serial_number', 'status', 'distribution_company'),
+}
+# Codes are also indexed whole, so "SN-0042/B" is found as typed or as "sn0042b".
+CODE_FIELDS = ('ean', 'serial_number')
+
+EXACT, PREFIX, FUZZY = 1.0, 0.8, 0.5
+MAX_PREFIX_TERMS = 64
+SNAPSHOT_VERSION = 1
+
+WORD = re.compile(r'\w+')
+
+
+def normalize(text):
+    text = unicodedata.normalize('NFKD', str(text)).casefold()
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return WORD.findall(normalize(text))
+
+
+def document_terms(collection, doc):
+    terms = dict()
+    for field, weight in SEARCH_FIELDS[collection].items():
+        value = doc.get(field)
+        if not value:
+            continue
+        tokens = tokenize(value)
+        if field in CODE_FIELDS and len(tokens) > 1:
+            tokens.append(''.join(tokens))
+        for token in tokens:
+            if weight > terms.get(token, 0):
+                terms[token] = weight
+    return terms
+
+
+def entry(collection, doc):
+    return {field: doc.get(field) for field in RESULT_FIELDS[collection]}, document_terms(collection, doc)
+
+
+def max_typos(term):
+    # Short terms match too much of the vocabulary with a typo, so they have to be spelled right.
+    if len(term) < 4:
+        return 0
+    return 1 if len(term) < 8 else 2
+
+
+class SearchIndex(object):
+    def __init__(self):
+        self._documents = dict()
+        self._postings = dict()
+        # A character trie of every indexed term; '' marks the end of a term.
+        self._trie = dict()
+        self._lock = threading.Lock()
+        self.ready = False
+        # Counts the changes made, and how many of them the last snapshot holds.
+        self._changes = 0
+        self._saved = 0
+
+    @property
+    def dirty(self):
+        return self._changes != self._saved
+
+    def _add_term(self, term):
+        node = self._trie
+        for char in term:
+            node = node.setdefault(char, {})
+        node[''] = True
+
+    def _remove_term(self, term):
+        path = [self._trie]
+        for char in term:
+            node = path[-1].get(char)
+            if node is None:
+                return
+            path.append(node)
+        path[-1].pop('', None)
+        # Prune the branches that no longer lead to a term.
+        for depth in range(len(term), 0, -1):
+            if path[depth]:
+                break
+            del path[depth - 1][term[depth - 1]]
+
+    def _put(self, collection, key, result, terms):
+        self._remove(collection, key)
+        self._documents[(collection, key)] = (result, terms)
+        for term, weight in terms.items():
+            postings = self._postings.get(term)
+            if postings is None:
+                postings = self._postings[term] = dict()
+                self._add_term(term)
+            postings[(collection, key)] = weight
+
+    def _remove(self, collection, key):
+        document = self._documents.pop((collection, key), None)
+        if document is None:
+            return
+        for term in document[1]:
+            postings = self._postings.get(term, {})
+            postings.pop((collection, key), None)
+            if not postings:
+                self._postings.pop(term, None)
+                self._remove_term(term)
+
+    def put(self, collection, key, doc):
+        with self._lock:
+            self._put(collection, key, *entry(collection, doc))
+            self._changes += 1
+
+    def remove(self, collection, key):
+        with self._lock:
+            self._remove(collection, key)
+            self._changes += 1
+
+    def _load(self, entries):
+        with self._lock:
+            self._documents = dict()
+            self._postings = dict()
+            self._trie = dict()
+            for collection, key, result, terms in entries:
+                self._put(collection, key, result, terms)
+            self.ready = True
+
+    def warm(self, storage):
+        entries = []
+        for collection, fields in RESULT_FIELDS.items():
+            key_fields = ('brand', 'model') if collection == 'products' else ('id',)
+            selected = list(dict.fromkeys(key_fields + fields + tuple(SEARCH_FIELDS[collection])))
+            for doc in storage.query(collection, fields=selected):
+                key = doc['brand'] + ' ' + doc['model'] if collection == 'products' else doc['id']
+                entries.append((collection, key) + entry(collection, doc))
+        self._load(entries)
+        with self._lock:
+            self._changes += 1
+
+    def refresh(self, storage, collection, keys):
+        docs = storage.get_many(collection, keys)
+        with self._lock:
+            for key in keys:
+                if key in docs:
+                    self._put(collection, key, *entry(collection, docs[key]))
+                else:
+                    self._remove(collection, key)
+            self._changes += 1
+
+    def save(self, path):
+        with self._lock:
+            entries = [[collection, key, result, terms]
+                       for (collection, key), (result, terms) in self._documents.items()]
+            changes = self._changes
+
+        # Written next to the old snapshot and swapped in, so a crash never leaves half a file behind.
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.search-')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'version': SNAPSHOT_VERSION, 'saved_at': time.time(), 'entries': entries}, f)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+        # Only once the snapshot is in place, and only for the changes it holds: a failed save is tried again.
+        with self._lock:
+            self._saved = max(self._saved, changes)
+
+    def load(self, path, max_age):
+        # Snapshots only hold what this process saw, so old ones are thrown away instead of trusted. The file's
+        # modification time is when it was last known to be current: unchanged snapshots are touched, not rewritten.
+        try:
+            if time.time() - os.path.getmtime(path) > max_age:
+                return False
+            with open(path) as f:
+                snapshot = json.load(f)
+        except (OSError, ValueError):
+            return False
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            return False
+
+        self._load(snapshot['entries'])
+        return True
+
+    def _prefixed(self, prefix):
+        node = self._trie
+        for char in prefix:
+            node = node.get(char)
+            if node is None:
+                return []
+
+        terms = []
+        stack = [(node, prefix)]
+        while stack and len(terms) < MAX_PREFIX_TERMS:
+            node, term = stack.pop()
+            for char, child in node.items():
+                if char == '':
+                    terms.append(term)
+                else:
+                    stack.append((child, term + char))
+        return terms
+
+    def _similar(self, term, max_distance):
+        # Walks the trie with one row of the edit distance table per character, dropping every branch that is
+        # already too far from `term`. Typos in the first letter are rare, so only that branch is searched.
+        found = dict()
+        first = self._trie.get(term[0])
+        if first is None:
+            return found
+
+        stack = [(first, term[0], [1] + list(range(len(term))))]
+        while stack:
+            node, prefix, previous = stack.pop()
+            for char, child in node.items():
+                if char == '':
+                    continue
+                row = [previous[0] + 1]
+                for column in range(1, len(term) + 1):
+                    row.append(min(row[column - 1] + 1, previous[column] + 1,
+                                   previous[column - 1] + (term[column - 1] != char)))
+                if row[-1] <= max_distance and '' in child:
+                    found[prefix + char] = row[-1]
+                if min(row) <= max_distance:
+                    stack.append((child, prefix + char, row))
+        return found
+
+    def _matches(self, term, partial):
+        # Every indexed term `term` could stand for, with how much a hit on it is worth. Only a word still being
+        # typed (or one that isn't a whole word) is taken as a prefix.
+        matches = dict()
+        if term in self._postings:
+            matches[term] = EXACT
+        if partial or not matches:
+            for prefixed in self._prefixed(term):
+                matches.setdefault(prefixed, PREFIX)
+        if not matches and max_typos(term):
+            for similar, distance in self._similar(term, max_typos(term)).items():
+                matches[similar] = FUZZY / distance
+        return matches
+
+    def _scores(self, matches, collections):
+        scores = dict()
+        for match, factor in matches.items():
+            for doc_key, weight in self._postings[match].items():
+                if collections is not None and doc_key[0] not in collections:
+                    continue
+                if factor * weight > scores.get(doc_key, 0):
+                    scores[doc_key] = factor * weight
+        return scores
+
+    def search(self, query, collections=None, limit=20):
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            matched = []
+            for position, term in enumerate(terms):
+                matches = self._matches(term, position == len(terms) - 1)
+                if not matches:
+                    return []
+                matched.append((sum(len(self._postings[match]) for match in matches), matches))
+
+            # Every word in the query has to match something in the document. Starting from the rarest word keeps
+            # the candidates few, and common words are then only looked up for those candidates.
+            matched.sort(key=lambda item: item[0])
+            scores = self._scores(matched[0][1], collections)
+            for size, matches in matched[1:]:
+                if not scores:
+                    return []
+                if len(scores) * len(matches) < size:
+                    postings = [(self._postings[match], factor) for match, factor in matches.items()]
+                    term_scores = {doc_key: max(factor * documents.get(doc_key, 0) for documents, factor in postings)
+                                   for doc_key in scores}
+                else:
+                    term_scores = self._scores(matches, collections)
+                scores = {doc_key: score + term_scores[doc_key] for doc_key, score in scores.items()
+                          if term_scores.get(doc_key)}
+
+            best = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -len(item[0][1])))
+            return [(collection, key, score, dict(self._documents[(collection, key)][0]))
+                    for (collection, key), score in best]
+
+    def stats(self):
+        with self._lock:
+            return {'documents': len(self._documents), 'terms': len(self._postings), 'ready': self.ready}
@@ -0,0 +1,52 @@
+# lib/serialization.py
+
+import datetime
+
+from flask.json import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class ISOJSONEncoder(JSONEncoder):
+    # Dates go out as ISO 8601 / RFC 3339, the same as orjson writes them and as the list cursors take them, rather
+    # than as Flask's HTTP dates.
+    def default(self, o):
+        if isinstance(o, (datetime.date, datetime.datetime)):
+            return o.isoformat()
+        return super(ISOJSONEncoder, self).default(o)
+
+
+class JSONCodec(object):
+    def __init__(self, backend='auto', sort_keys=True, indent=False, dates='http'):
+        if backend == 'auto':
+            backend = 'orjson' if orjson is not None else 'stdlib'
+        if backend == 'orjson' and orjson is None:
+            raise ValueError('orjson is not installed')
+        if backend not in ('orjson', 'stdlib'):
+            raise ValueError('Unknown JSON encoder: {}'.format(backend))
+        if dates not in ('http', 'iso'):
+            raise ValueError('Unknown JSON date format: {}'.format(dates))
+
+        self.backend = backend
+        encoder = ISOJSONEncoder if dates == 'iso' else JSONEncoder
+        self._encoder = encoder(ensure_ascii=False, sort_keys=sort_keys, indent=2 if indent else None,
+                                separators=(', ', ': ') if indent else (',', ':'))
+        if backend == 'orjson':
+            # orjson writes NumPy values (and ISO dates) itself, without calling back into Python per value. HTTP
+            # dates are left to the encoder.
+            self._options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+            if dates == 'http':
+                self._options |= orjson.OPT_PASSTHROUGH_DATETIME
+            if sort_keys:
+                self._options |= orjson.OPT_SORT_KEYS
+            if indent:
+                self._options |= orjson.OPT_INDENT_2
+
+    def dumps(self, data):
+        # Returns UTF-8 encoded bytes.
+        if self.backend == 'orjson':
+            return orjson.dumps(data, default=self._encoder.default, option=self._options)
+        return self._encoder.encode(data).encode('utf-8')
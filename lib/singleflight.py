@@ -0,0 +1,46 @@
+# lib/singleflight.py
+
+import threading
+
+
+class _Call(object):
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    # Runs one call per key at a time: callers asking for a key that's already being loaded wait for that call and
+    # share its result (or its exception) instead of making their own.
+
+    def __init__(self):
+        self._calls = dict()
+        self._lock = threading.Lock()
+
+    def do(self, key, fn):
+        # Returns (result, shared), where `shared` says the result came from another caller's call.
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
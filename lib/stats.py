@@ -0,0 +1,188 @@
+# lib/stats.py
+
+import datetime
+import threading
+import time
+
+import numpy as np
+
+from lib.classes import RMACase
+from lib.storage import FILTER_OPERATORS
+
+DATE_FIELDS = RMACase.DATE_FIELDS
+GROUP_FIELDS = ('distribution_company', 'brand', 'status')
+STATUSES = ('to_be_revised', 'to_be_sent', 'sent', 'returned', 'resolved', 'unresolved')
+
+# Each stage is measured between two lifecycle timestamps of the same case.
+STAGES = (
+    ('revision', 'to_be_revised_date', 'to_be_sent_date'),
+    ('waiting_to_send', 'to_be_sent_date', 'sent_date'),
+    ('at_distributor', 'sent_date', 'returned_date'),
+    ('resolution', 'returned_date', 'resolved_date'),
+    ('total_resolved', 'to_be_revised_date', 'resolved_date'),
+    ('total_unresolved', 'to_be_revised_date', 'unresolved_date'),
+)
+PERCENTILES = (50, 90, 99)
+EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def epoch_seconds(value):
+    # Firestore hands dates back UTC-aware; naive ones are stored as UTC, so read them the same way.
+    if value is None:
+        return np.nan
+    if value.tzinfo is not None:
+        return value.timestamp()
+    return (value - EPOCH).total_seconds()
+
+
+# The only fields the stats read, so loading the cases can leave the rest out.
+FIELDS = ('id',) + GROUP_FIELDS + DATE_FIELDS
+
+
+class CaseColumns(object):
+    def __init__(self, groups, dates):
+        self.size = len(groups['status'])
+        self.groups = groups
+        self.dates = dates
+
+    @classmethod
+    def from_cases(cls, rma_cases):
+        # Column by column rather than case by case.
+        rma_cases = list(rma_cases)
+        return cls({field: np.array([rma_case.get(field) or '' for rma_case in rma_cases], dtype=object)
+                    for field in GROUP_FIELDS},
+                   {field: np.fromiter([epoch_seconds(rma_case.get(field)) for rma_case in rma_cases],
+                                       np.float64, len(rma_cases))
+                    for field in DATE_FIELDS})
+
+    def stage_hours(self):
+        # Missing timestamps are NaN, so stages a case hasn't reached drop out of the summaries.
+        return {name: (self.dates[end] - self.dates[start]) / 3600.0 for name, start, end in STAGES}
+
+
+class CaseColumnCache(object):
+    # The columns of every RMA case, kept between requests so stats don't scan the cases each time. Cases written
+    # through this process (or reported by a listener) are put in as they change; the rest of the columns are
+    # loaded again once they're `max_age` seconds old, which is how writes made by other processes get in without
+    # a listener.
+
+    def __init__(self, max_age):
+        self.max_age = max_age
+        self._rows = dict()
+        self._columns = CaseColumns.from_cases([])
+        self._loaded = None
+        # Cases put while a load is reading storage, which the load may have missed.
+        self._loading = None
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+
+    def load(self, storage):
+        with self._lock:
+            self._loading = dict()
+        try:
+            rma_cases = list(storage.query('rma_cases', fields=FIELDS))
+            columns = CaseColumns.from_cases(rma_cases)
+        except Exception:
+            with self._lock:
+                self._loading = None
+            raise
+
+        with self._lock:
+            self._rows = {str(rma_case['id']): row for row, rma_case in enumerate(rma_cases)}
+            self._columns = columns
+            self._loaded = time.monotonic()
+            for key, rma_case in self._loading.items():
+                self._put(key, rma_case)
+            self._loading = None
+
+    def _fresh(self):
+        return self._loaded is not None and time.monotonic() - self._loaded < self.max_age
+
+    def put(self, key, rma_case):
+        with self._lock:
+            if self._loading is not None:
+                self._loading[key] = rma_case
+            if self._loaded is not None:
+                self._put(key, rma_case)
+
+    def _put(self, key, rma_case):
+        columns = self._columns
+        row = self._rows.get(key)
+        if row is None:
+            row = self._rows[key] = columns.size
+            if row == len(columns.groups['status']):
+                # Grown by half its size at a time, so adding cases one by one doesn't copy the arrays each time.
+                extra = max(row // 2, 64)
+                for field in GROUP_FIELDS:
+                    columns.groups[field] = np.concatenate([columns.groups[field], np.full(extra, '', dtype=object)])
+                for field in DATE_FIELDS:
+                    columns.dates[field] = np.concatenate([columns.dates[field], np.full(extra, np.nan)])
+            columns.size += 1
+        for field in GROUP_FIELDS:
+            columns.groups[field][row] = rma_case.get(field) or ''
+        for field in DATE_FIELDS:
+            columns.dates[field][row] = epoch_seconds(rma_case.get(field))
+
+    def select(self, storage, filters):
+        # The columns of the cases matching `filters`, given as (field, op, value) storage filters on the group
+        # and date fields. Like storage queries, a filter never matches a case missing the field.
+        if not self._fresh():
+            with self._load_lock:
+                if not self._fresh():
+                    self.load(storage)
+
+        with self._lock:
+            columns = self._columns
+            size = columns.size
+            mask = np.ones(size, dtype=bool)
+            for field, op, value in filters:
+                if field in columns.dates:
+                    mask &= FILTER_OPERATORS[op](columns.dates[field][:size], epoch_seconds(value))
+                else:
+                    values = columns.groups[field][:size]
+                    mask &= (values != '') & FILTER_OPERATORS[op](values, value)
+            # Fancy indexing copies, so later writes don't change the arrays being summarized.
+            return CaseColumns({field: values[:size][mask] for field, values in columns.groups.items()},
+                               {field: values[:size][mask] for field, values in columns.dates.items()})
+
+
+def summarize(values):
+    values = values[~np.isnan(values)]
+    if not values.size:
+        return {'count': 0, 'mean': None, 'p50': None, 'p90': None, 'p99': None}
+
+    percentiles = np.percentile(values, PERCENTILES)
+    summary = {'count': int(values.size), 'mean': float(values.mean())}
+    for percentile, value in zip(PERCENTILES, percentiles):
+        summary['p{}'.format(percentile)] = float(value)
+    return summary
+
+
+def group_summary(columns, stage_hours, mask):
+    statuses = columns.groups['status'][mask]
+    return {
+        'cases': int(mask.sum()),
+        'statuses': {status: int((statuses == status).sum()) for status in STATUSES},
+        'stages': {name: summarize(hours[mask]) for name, hours in stage_hours.items()},
+    }
+
+
+def turnaround_stats(columns, group_by):
+    if group_by not in GROUP_FIELDS:
+        raise ValueError('Can only group by one of: {}'.format(', '.join(GROUP_FIELDS)))
+
+    stage_hours = columns.stage_hours()
+
+    keys, inverse = np.unique(columns.groups[group_by].astype(str), return_inverse=True)
+    groups = []
+    for index, key in enumerate(keys):
+        summary = group_summary(columns, stage_hours, inverse == index)
+        summary[group_by] = key
+        groups.append(summary)
+
+    return {
+        'group_by': group_by,
+        'unit': 'hours',
+        'overall': group_summary(columns, stage_hours, np.ones(columns.size, dtype=bool)),
+        'groups': groups,
+    }
@@ -0,0 +1,780 @@
+# lib/storage.py
+
+import collections
+import logging
+import operator
+import os
+import threading
+
+COLLECTIONS = ('users', 'rma_cases', 'companies', 'products', 'counters', 'idempotency_keys', 'revocations')
+
+# Firestore refuses write batches with more than 500 operations.
+MAX_BATCH_WRITES = 500
+
+FILTER_OPERATORS = {
+    '==': operator.eq,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+logger = logging.getLogger(__name__)
+
+
+# What a listener is told about each changed document: its key, whether it was 'added', 'modified' or 'removed', and
+# the document as it is now (None once it's removed).
+Change = collections.namedtuple('Change', ['key', 'kind', 'doc'])
+
+
+class NotFound(Exception):
+    pass
+
+
+class BelowMinimum(Exception):
+    def __init__(self, key, field):
+        super(BelowMinimum, self).__init__(key, field)
+        self.key = key
+        self.field = field
+
+
+class Changed(Exception):
+    # A document no longer holds the values a write expected it to.
+    def __init__(self, key):
+        super(Changed, self).__init__(key)
+        self.key = key
+
+
+def apply_adjustments(docs, adjustments, minimum):
+    # Works out the new field values in `docs` and returns them, without changing anything if one fails.
+    updates = dict()
+    for key, deltas in adjustments.items():
+        if key not in docs:
+            raise NotFound(key)
+        updates[key] = dict()
+        for field, delta in deltas.items():
+            value = (docs[key].get(field) or 0) + delta
+            if minimum is not None and value < minimum:
+                raise BelowMinimum(key, field)
+            updates[key][field] = value
+
+    for key, data in updates.items():
+        docs[key].update(data)
+    return updates
+
+
+def check_expected(docs, keys, expected):
+    # Fails with NotFound or Changed if a document is missing, or differs from `expected` ({key: {field: value}}).
+    for key in keys:
+        if key not in docs:
+            raise NotFound(key)
+        if any(docs[key].get(field) != value for field, value in expected.get(key, {}).items()):
+            raise Changed(key)
+
+
+class Storage(object):
+    # The write methods take an optional `counters` dict of {name: delta}, added to the named counters in the same
+    # atomic write as the documents. Updates also take `expected` field values (a dict for `update`, one per key for
+    # `update_many`): if a document holds others, the write fails with Changed and changes nothing, so counters
+    # worked out from a read stay right when another write lands in between.
+
+    def get(self, collection, key):
+        raise NotImplementedError
+
+    def get_many(self, collection, keys):
+        return {key: doc for key, doc in ((key, self.get(collection, key)) for key in keys) if doc is not None}
+
+    def set(self, collection, key, data, counters=None):
+        raise NotImplementedError
+
+    def set_many(self, collection, docs, counters=None):
+        raise NotImplementedError
+
+    def update(self, collection, key, data, counters=None, expected=None):
+        raise NotImplementedError
+
+    def update_many(self, collection, updates, counters=None, expected=None):
+        raise NotImplementedError
+
+    def delete(self, collection, key, counters=None):
+        raise NotImplementedError
+
+    def query(self, collection, filters=(), order_by=None, start_after=None, limit=None, fields=None):
+        raise NotImplementedError
+
+    def increment(self, collection, increments):
+        # Adds {key: {field: delta}} in one atomic write without reading the documents first.
+        raise NotImplementedError
+
+    def adjust(self, collection, adjustments, minimum):
+        # Like increment, but fails with BelowMinimum (and changes nothing) if any field would drop under
+        # `minimum`. Returns the adjusted documents.
+        raise NotImplementedError
+
+    def increment_counter(self, name, amount):
+        # Atomically adds `amount` to the named counter and returns its new value.
+        raise NotImplementedError
+
+    def get_counters(self, prefix):
+        # Returns {name: value} for every counter whose name starts with `prefix`.
+        raise NotImplementedError
+
+    def set_counters(self, prefix, values):
+        # Replaces every counter whose name starts with `prefix` by `values`.
+        raise NotImplementedError
+
+    def listen(self, collection, callback):
+        # Calls back with a list of Changes for the writes made to `collection` after this call, by any process.
+        # Backends without a change feed just never call back.
+        return None
+
+    def connect(self):
+        # Opens the connection to the backend ahead of the first request that needs it.
+        pass
+
+
+class FirestoreStorage(Storage):
+    def __init__(self, client=None):
+        self._client = client
+        self._pid = None
+        self._client_lock = threading.Lock()
+        self._listeners = dict()
+        self._watches = dict()
+        self._watches_lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Built on first use rather than on import, and again in a forked child: a gRPC channel can't be shared
+        # across a fork, so every worker has to open its own.
+        if self._pid != os.getpid():
+            with self._client_lock:
+                if self._pid != os.getpid():
+                    if self._client is None or self._pid is not None:
+                        from google.cloud import firestore
+                        self._client = firestore.Client()
+                    self._pid = os.getpid()
+                    # Watches opened before a fork belong to the parent's client.
+                    with self._watches_lock:
+                        self._listeners = dict()
+                        self._watches = dict()
+        return self._client
+
+    def connect(self):
+        # Reading a document that doesn't exist is the cheapest call that sets up credentials and the channel.
+        self.client.collection('counters').document('connect').get()
+
+    def get(self, collection, key):
+        return self.client.collection(collection).document(key).get().to_dict()
+
+    def get_many(self, collection, keys):
+        refs = [self.client.collection(collection).document(key) for key in keys]
+        if not refs:
+            return {}
+        return {snapshot.id: snapshot.to_dict() for snapshot in self.client.get_all(refs) if snapshot.exists}
+
+    def _add_counters(self, batch, counters):
+        from google.cloud import firestore
+
+        for name, delta in counters.items():
+            batch.set(self.client.collection('counters').document(name),
+                      {'name': name, 'value': firestore.Increment(delta)}, merge=True)
+
+    def _write(self, method, collection, key, *data, counters=None):
+        ref = self.client.collection(collection).document(key)
+        if not counters:
+            return getattr(ref, method)(*data)
+
+        batch = self.client.batch()
+        getattr(batch, method)(ref, *data)
+        self._add_counters(batch, counters)
+        batch.commit()
+
+    def set(self, collection, key, data, counters=None):
+        self._write('set', collection, key, data, counters=counters)
+
+    def update(self, collection, key, data, counters=None, expected=None):
+        from google.api_core.exceptions import NotFound as FirestoreNotFound
+
+        if expected is not None:
+            return self.update_many(collection, {key: data}, counters, {key: expected})
+        try:
+            self._write('update', collection, key, data, counters=counters)
+        except FirestoreNotFound:
+            raise NotFound(key)
+
+    def _commit_in_batches(self, collection, method, docs, counters=None):
+        items = list(docs.items())
+        if not items and not counters:
+            return
+
+        chunks = [items[start:start + MAX_BATCH_WRITES] for start in range(0, len(items), MAX_BATCH_WRITES)] or [[]]
+        for number, chunk in enumerate(chunks):
+            batch = self.client.batch()
+            for key, data in chunk:
+                getattr(batch, method)(self.client.collection(collection).document(key), data)
+            # Counters go with the last batch, so they only move once every document has been written.
+            if counters and number == len(chunks) - 1:
+                if len(chunk) + len(counters) > MAX_BATCH_WRITES:
+                    batch.commit()
+                    batch = self.client.batch()
+                self._add_counters(batch, counters)
+            batch.commit()
+
+    def set_many(self, collection, docs, counters=None):
+        self._commit_in_batches(collection, 'set', docs, counters)
+
+    def update_many(self, collection, updates, counters=None, expected=None):
+        from google.cloud import firestore
+
+        if expected is None:
+            return self._commit_in_batches(collection, 'update', updates, counters)
+        if len(updates) + len(counters or {}) > MAX_BATCH_WRITES:
+            raise ValueError('Can\'t check more than {} writes at once'.format(MAX_BATCH_WRITES))
+
+        # The documents are read in the transaction, so Firestore retries it if one changes before the commit.
+        refs = {key: self.client.collection(collection).document(key) for key in updates}
+
+        @firestore.transactional
+        def apply(transaction):
+            docs = {snapshot.id: snapshot.to_dict()
+                    for snapshot in self.client.get_all(list(refs.values()), transaction=transaction)
+                    if snapshot.exists}
+            check_expected(docs, updates, expected)
+            for key, data in updates.items():
+                transaction.update(refs[key], data)
+            if counters:
+                self._add_counters(transaction, counters)
+
+        apply(self.client.transaction())
+
+    def delete(self, collection, key, counters=None):
+        self._write('delete', collection, key, counters=counters)
+
+    def query(self, collection, filters=(), order_by=None, start_after=None, limit=None, fields=None):
+        query = self.client.collection(collection)
+        if fields:
+            query = query.select(fields)
+        for field, op, value in filters:
+            query = query.where(field, op, value)
+        if order_by is not None:
+            query = query.order_by(order_by)
+            if start_after is not None:
+                query = query.start_after({order_by: start_after})
+        if limit is not None:
+            query = query.limit(limit)
+
+        return (snapshot.to_dict() for snapshot in query.stream())
+
+    def increment(self, collection, increments):
+        from google.api_core.exceptions import NotFound as FirestoreNotFound
+        from google.cloud import firestore
+
+        if len(increments) > MAX_BATCH_WRITES:
+            raise ValueError('Can\'t increment more than {} documents at once'.format(MAX_BATCH_WRITES))
+
+        batch = self.client.batch()
+        for key, deltas in increments.items():
+            batch.update(self.client.collection(collection).document(key),
+                         {field: firestore.Increment(delta) for field, delta in deltas.items()})
+        try:
+            batch.commit()
+        except FirestoreNotFound:
+            raise NotFound(None)
+
+    def adjust(self, collection, adjustments, minimum):
+        from google.cloud import firestore
+
+        refs = {key: self.client.collection(collection).document(key) for key in adjustments}
+
+        @firestore.transactional
+        def apply(transaction):
+            docs = {snapshot.id: snapshot.to_dict()
+                    for snapshot in self.client.get_all(list(refs.values()), transaction=transaction)
+                    if snapshot.exists}
+            updates = apply_adjustments(docs, adjustments, minimum)
+            for key, data in updates.items():
+                transaction.update(refs[key], data)
+            return {key: docs[key] for key in adjustments}
+
+        return apply(self.client.transaction())
+
+    def increment_counter(self, name, amount):
+        from google.cloud import firestore
+
+        ref = self.client.collection('counters').document(name)
+
+        @firestore.transactional
+        def increment(transaction):
+            value = (ref.get(transaction=transaction).to_dict() or {}).get('value', 0) + amount
+            transaction.set(ref, {'value': value})
+            return value
+
+        return increment(self.client.transaction())
+
+    def get_counters(self, prefix):
+        query = self.client.collection('counters').where('name', '>=', prefix).where('name', '<', prefix + '\uf8ff')
+        return {snapshot.id: snapshot.to_dict().get('value', 0) for snapshot in query.stream()}
+
+    def set_counters(self, prefix, values):
+        refs = self.client.collection('counters')
+        writes = [(name, None) for name in self.get_counters(prefix) if name not in values]
+        writes += list(values.items())
+        for start in range(0, len(writes), MAX_BATCH_WRITES):
+            batch = self.client.batch()
+            for name, value in writes[start:start + MAX_BATCH_WRITES]:
+                if value is None:
+                    batch.delete(refs.document(name))
+                else:
+                    batch.set(refs.document(name), {'name': name, 'value': value})
+            batch.commit()
+
+    def listen(self, collection, callback):
+        # Every callback for a collection shares one Watch, since each Watch is a stream of its own carrying the same
+        # changes. Its first snapshot lists every document in the collection as added. Callers have just loaded
+        # what they need, so it's skipped and only the changes after it are passed on.
+        client = self.client
+        with self._watches_lock:
+            if collection in self._watches:
+                self._listeners[collection].append(callback)
+                return self._watches[collection]
+            callbacks = self._listeners[collection] = [callback]
+            initial = [True]
+
+            def on_snapshot(col_snapshot, changes, read_time):
+                if initial[0]:
+                    initial[0] = False
+                    return
+                changes = [Change(change.document.id, change.type.name.lower(),
+                                  change.document.to_dict() if change.type.name != 'REMOVED' else None)
+                           for change in changes]
+                with self._watches_lock:
+                    listeners = list(callbacks)
+                for listener in listeners:
+                    # One failing listener mustn't keep the changes from the others, or end the Watch.
+                    try:
+                        listener(changes)
+                    except Exception:
+                        logger.exception('Listener for %s failed', collection)
+
+            self._watches[collection] = client.collection(collection).on_snapshot(on_snapshot)
+            return self._watches[collection]
+
+
+class MemoryStorage(Storage):
+    def __init__(self):
+        self._collections = {collection: {} for collection in COLLECTIONS}
+        self._listeners = {collection: [] for collection in COLLECTIONS}
+        self._lock = threading.RLock()
+
+    def _notify(self, collection, key, kind):
+        with self._lock:
+            doc = self._collections[collection].get(key)
+            change = Change(key, kind, dict(doc) if doc is not None else None)
+        for callback in self._listeners[collection]:
+            callback([change])
+
+    def get(self, collection, key):
+        with self._lock:
+            doc = self._collections[collection].get(key)
+            return dict(doc) if doc is not None else None
+
+    def get_many(self, collection, keys):
+        with self._lock:
+            docs = self._collections[collection]
+            return {key: dict(docs[key]) for key in keys if key in docs}
+
+    def _increment_counters(self, counters):
+        docs = self._collections['counters']
+        for name, delta in (counters or {}).items():
+            counter = docs.setdefault(name, {'name': name, 'value': 0})
+            counter['value'] += delta
+
+    def set(self, collection, key, data, counters=None):
+        with self._lock:
+            kind = 'modified' if key in self._collections[collection] else 'added'
+            self._collections[collection][key] = dict(data)
+            self._increment_counters(counters)
+        self._notify(collection, key, kind)
+
+    def set_many(self, collection, docs, counters=None):
+        with self._lock:
+            kinds = {key: 'modified' if key in self._collections[collection] else 'added' for key in docs}
+            for key, data in docs.items():
+                self._collections[collection][key] = dict(data)
+            self._increment_counters(counters)
+        for key in docs:
+            self._notify(collection, key, kinds[key])
+
+    def update(self, collection, key, data, counters=None, expected=None):
+        self.update_many(collection, {key: data}, counters, {key: expected} if expected is not None else None)
+
+    def update_many(self, collection, updates, counters=None, expected=None):
+        with self._lock:
+            docs = self._collections[collection]
+            check_expected(docs, updates, expected or {})
+            for key, data in updates.items():
+                docs[key].update(data)
+            self._increment_counters(counters)
+        for key in updates:
+            self._notify(collection, key, 'modified')
+
+    def delete(self, collection, key, counters=None):
+        with self._lock:
+            self._collections[collection].pop(key, None)
+            self._increment_counters(counters)
+        self._notify(collection, key, 'removed')
+
+    def query(self, collection, filters=(), order_by=None, start_after=None, limit=None, fields=None):
+        with self._lock:
+            docs = [dict(doc) for doc in self._collections[collection].values()]
+
+        for field, op, value in filters:
+            compare = FILTER_OPERATORS[op]
+            docs = [doc for doc in docs if doc.get(field) is not None and compare(doc.get(field), value)]
+        if order_by is not None:
+            docs = [doc for doc in docs if doc.get(order_by) is not None]
+            docs.sort(key=operator.itemgetter(order_by))
+            if start_after is not None:
+                docs = [doc for doc in docs if doc[order_by] > start_after]
+        if limit is not None:
+            docs = docs[:limit]
+        if fields:
+            docs = [{field: doc[field] for field in fields if field in doc} for doc in docs]
+
+        return iter(docs)
+
+    def increment(self, collection, increments):
+        with self._lock:
+            docs = self._collections[collection]
+            for key in increments:
+                if key not in docs:
+                    raise NotFound(key)
+            for key, deltas in increments.items():
+                for field, delta in deltas.items():
+                    docs[key][field] = (docs[key].get(field) or 0) + delta
+        for key in increments:
+            self._notify(collection, key, 'modified')
+
+    def adjust(self, collection, adjustments, minimum):
+        with self._lock:
+            docs = self._collections[collection]
+            updates = apply_adjustments({key: dict(docs[key]) for key in adjustments if key in docs},
+                                        adjustments, minimum)
+            for key, data in updates.items():
+                docs[key].update(data)
+            adjusted = {key: dict(docs[key]) for key in adjustments}
+        for key in adjustments:
+            self._notify(collection, key, 'modified')
+        return adjusted
+
+    def increment_counter(self, name, amount):
+        with self._lock:
+            counter = self._collections['counters'].setdefault(name, {'value': 0})
+            counter['value'] += amount
+            return counter['value']
+
+    def get_counters(self, prefix):
+        with self._lock:
+            return {name: counter['value'] for name, counter in self._collections['counters'].items()
+                    if name.startswith(prefix)}
+
+    def set_counters(self, prefix, values):
+        with self._lock:
+            counters = self._collections['counters']
+            for name in [name for name in counters if name.startswith(prefix)]:
+                del counters[name]
+            for name, value in values.items():
+                counters[name] = {'name': name, 'value': value}
+
+    def listen(self, collection, callback):
+        with self._lock:
+            self._listeners[collection].append(callback)
+
+
+def sql_tables(metadata):
+    from sqlalchemy import Table, Column, String, Text, Integer, BigInteger, Boolean, DateTime, Float, LargeBinary
+
+    return {
+        'users': Table(
+            'users', metadata,
+            Column('public_id', String(36), primary_key=True),
+            Column('username', String(80), nullable=False, unique=True, index=True),
+            Column('password', String(255), nullable=False),
+            Column('email', String(255)),
+            Column('first_name', String(80)),
+            Column('last_name', String(80)),
+            Column('role', String(40))),
+        'companies': Table(
+            'companies', metadata,
+            Column('name', String(120), primary_key=True),
+            Column('email', String(255)),
+            Column('address', String(255)),
+            Column('hours', String(120)),
+            Column('contact_name', String(120)),
+            Column('phone', String(40))),
+        'products': Table(
+            'products', metadata,
+            Column('key', String(255), primary_key=True),
+            Column('brand', String(120), nullable=False),
+            Column('model', String(120), nullable=False),
+            Column('description', Text),
+            Column('stock', Integer, default=0),
+            Column('stock_under_control', Boolean, default=False),
+            Column('reserved', Integer, default=0),
+            Column('distribution_company', String(120), index=True),
+            Column('ean', String(20), index=True)),
+        'rma_cases': Table(
+            'rma_cases', metadata,
+            Column('id', String(20), primary_key=True),
+            Column('brand', String(120)),
+            Column('model', String(120)),
+            Column('problem', Text),
+            Column('serial_number', String(120)),
+            Column('distribution_company', String(120), index=True),
+            Column('status', String(20), index=True),
+            Column('to_be_revised_date', DateTime),
+            Column('to_be_sent_date', DateTime),
+            Column('sent_date', DateTime),
+            Column('returned_date', DateTime),
+            Column('resolved_date', DateTime),
+            Column('unresolved_date', DateTime),
+            Column('to_be_revised_by', String(160)),
+            Column('to_be_sent_by', String(160)),
+            Column('sent_by', String(160)),
+            Column('returned_by', String(160)),
+            Column('resolved_by', String(160)),
+            Column('unresolved_by', String(160))),
+        'counters': Table(
+            'counters', metadata,
+            Column('name', String(120), primary_key=True),
+            Column('value', BigInteger, nullable=False, default=0)),
+        'idempotency_keys': Table(
+            'idempotency_keys', metadata,
+            Column('key', String(64), primary_key=True),
+            Column('fingerprint', String(64), nullable=False),
+            Column('status', Integer, nullable=False),
+            Column('headers', Text),
+            Column('body', LargeBinary),
+            Column('expires', Float, index=True)),
+        'revocations': Table(
+            'revocations', metadata,
+            Column('key', String(80), primary_key=True),
+            Column('jti', String(32)),
+            Column('public_id', String(36)),
+            Column('access_before', Float),
+            Column('refresh_before', Float),
+            Column('expires', Float, index=True)),
+    }
+
+
+class SQLStorage(Storage):
+    def __init__(self, database_uri):
+        from sqlalchemy import create_engine, MetaData
+
+        self._engine = create_engine(database_uri, pool_pre_ping=True)
+        self._created = False
+        self._engine_lock = threading.Lock()
+        self.metadata = MetaData()
+        self.tables = sql_tables(self.metadata)
+
+    @property
+    def engine(self):
+        # Creating the tables connects to the database, so it's left to the first use rather than done on import.
+        if not self._created:
+            with self._engine_lock:
+                if not self._created:
+                    self.metadata.create_all(self._engine)
+                    self._created = True
+        return self._engine
+
+    def connect(self):
+        with self.engine.connect() as conn:
+            conn.execute('SELECT 1')
+
+    def _primary_key(self, collection):
+        return list(self.tables[collection].primary_key.columns)[0]
+
+    def _row(self, collection, data, key=None):
+        # Products are keyed on "<brand> <model>", which isn't one of their fields.
+        table = self.tables[collection]
+        row = {name: value for name, value in data.items() if name in table.c}
+        if key is not None:
+            row[self._primary_key(collection).name] = key
+        return row
+
+    def _doc(self, collection, row):
+        doc = dict(row)
+        if collection == 'products':
+            doc.pop('key', None)
+        return doc
+
+    def get(self, collection, key):
+        table = self.tables[collection]
+        with self.engine.connect() as conn:
+            row = conn.execute(table.select().where(self._primary_key(collection) == key)).first()
+        return self._doc(collection, row) if row is not None else None
+
+    def get_many(self, collection, keys):
+        table = self.tables[collection]
+        primary_key = self._primary_key(collection)
+        keys = list(keys)
+        if not keys:
+            return {}
+        with self.engine.connect() as conn:
+            rows = conn.execute(table.select().where(primary_key.in_(keys))).fetchall()
+        return {row[primary_key.name]: self._doc(collection, row) for row in rows}
+
+    def _write(self, write, counters=None):
+        from sqlalchemy.exc import IntegrityError
+
+        table = self.tables['counters']
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as conn:
+                    write(conn)
+                    for name, delta in (counters or {}).items():
+                        updated = conn.execute(table.update().where(table.c.name == name).values(
+                            value=table.c.value + delta))
+                        if updated.rowcount == 0:
+                            conn.execute(table.insert().values(name=name, value=delta))
+                return
+            except IntegrityError:
+                # Another process created one of the counters first; the retry will update it instead.
+                if attempt or not counters:
+                    raise
+
+    def set(self, collection, key, data, counters=None):
+        table = self.tables[collection]
+
+        def write(conn):
+            conn.execute(table.delete().where(self._primary_key(collection) == key))
+            conn.execute(table.insert().values(**self._row(collection, data, key)))
+
+        self._write(write, counters)
+
+    def set_many(self, collection, docs, counters=None):
+        table = self.tables[collection]
+
+        def write(conn):
+            if docs:
+                conn.execute(table.delete().where(self._primary_key(collection).in_(list(docs))))
+                conn.execute(table.insert(), [self._row(collection, data, key) for key, data in docs.items()])
+
+        if docs or counters:
+            self._write(write, counters)
+
+    def update(self, collection, key, data, counters=None, expected=None):
+        self.update_many(collection, {key: data}, counters, {key: expected} if expected is not None else None)
+
+    def update_many(self, collection, updates, counters=None, expected=None):
+        from sqlalchemy import and_
+
+        table = self.tables[collection]
+        primary_key = self._primary_key(collection)
+
+        def write(conn):
+            for key, data in updates.items():
+                where = [primary_key == key] + [table.c[field] == value
+                                                for field, value in (expected or {}).get(key, {}).items()]
+                row = self._row(collection, data)
+                if row:
+                    found = conn.execute(table.update().where(and_(*where)).values(**row)).rowcount
+                else:
+                    found = conn.execute(table.select().where(and_(*where))).first() is not None
+                if not found:
+                    # Rolled back with the rest of the transaction.
+                    if expected and conn.execute(table.select().where(primary_key == key)).first() is not None:
+                        raise Changed(key)
+                    raise NotFound(key)
+
+        self._write(write, counters)
+
+    def delete(self, collection, key, counters=None):
+        table = self.tables[collection]
+        self._write(lambda conn: conn.execute(table.delete().where(self._primary_key(collection) == key)), counters)
+
+    def query(self, collection, filters=(), order_by=None, start_after=None, limit=None, fields=None):
+        from sqlalchemy import select
+
+        table = self.tables[collection]
+        if fields:
+            statement = select([table.c[field] for field in fields])
+        else:
+            statement = table.select()
+        for field, op, value in filters:
+            statement = statement.where(FILTER_OPERATORS[op](table.c[field], value))
+        if order_by is not None:
+            statement = statement.order_by(table.c[order_by])
+            if start_after is not None:
+                statement = statement.where(table.c[order_by] > start_after)
+        if limit is not None:
+            statement = statement.limit(limit)
+
+        with self.engine.connect() as conn:
+            for row in conn.execution_options(stream_results=True).execute(statement):
+                yield self._doc(collection, row)
+
+    def increment(self, collection, increments):
+        from sqlalchemy import func
+
+        table = self.tables[collection]
+        primary_key = self._primary_key(collection)
+        with self.engine.begin() as conn:
+            for key, deltas in increments.items():
+                values = {field: func.coalesce(table.c[field], 0) + delta for field, delta in deltas.items()}
+                if conn.execute(table.update().where(primary_key == key).values(**values)).rowcount == 0:
+                    raise NotFound(key)
+
+    def adjust(self, collection, adjustments, minimum):
+        table = self.tables[collection]
+        primary_key = self._primary_key(collection)
+        with self.engine.begin() as conn:
+            rows = conn.execute(table.select().where(primary_key.in_(list(adjustments))).with_for_update())
+            docs = {row[primary_key.name]: self._doc(collection, row) for row in rows}
+            updates = apply_adjustments(docs, adjustments, minimum)
+            for key, data in updates.items():
+                conn.execute(table.update().where(primary_key == key).values(**data))
+        return {key: docs[key] for key in adjustments}
+
+    def increment_counter(self, name, amount):
+        from sqlalchemy import select
+        from sqlalchemy.exc import IntegrityError
+
+        table = self.tables['counters']
+        for attempt in range(2):
+            try:
+                with self.engine.begin() as conn:
+                    updated = conn.execute(table.update().where(table.c.name == name).values(
+                        value=table.c.value + amount))
+                    if updated.rowcount == 0:
+                        conn.execute(table.insert().values(name=name, value=amount))
+                    return conn.execute(select([table.c.value]).where(table.c.name == name)).scalar()
+            except IntegrityError:
+                # Another process created the counter first; the retry will update it instead.
+                if attempt:
+                    raise
+
+    def get_counters(self, prefix):
+        table = self.tables['counters']
+        with self.engine.connect() as conn:
+            rows = conn.execute(table.select().where(table.c.name.startswith(prefix, autoescape=True)))
+            return {row['name']: row['value'] for row in rows}
+
+    def set_counters(self, prefix, values):
+        table = self.tables['counters']
+        with self.engine.begin() as conn:
+            conn.execute(table.delete().where(table.c.name.startswith(prefix, autoescape=True)))
+            if values:
+                conn.execute(table.insert(), [{'name': name, 'value': value} for name, value in values.items()])
+
+
+def create_storage(backend, database_uri=None):
+    if backend == 'firestore':
+        return FirestoreStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    if backend == 'sql':
+        if not database_uri:
+            raise ValueError('The sql storage backend needs a database URI')
+        return SQLStorage(database_uri)
+    raise ValueError('Unknown storage backend: {}'.format(backend))
@@ -0,0 +1,102 @@
+# lib/summary.py
+
+import collections
+import random
+
+PREFIX = 'summary:'
+CLOSED_STATUSES = ('resolved', 'unresolved')
+
+
+def rma_case_counts(rma_case):
+    status = rma_case.get('status') or ''
+    counts = [('rma_cases_by_status', status)]
+    if status not in CLOSED_STATUSES:
+        counts.append(('open_rma_cases_by_company', rma_case.get('distribution_company') or ''))
+    return counts
+
+
+def product_counts(product):
+    return [('products_by_company', product.get('distribution_company') or '')]
+
+
+def company_counts(company):
+    return [('companies', 'total')]
+
+
+def changes(counts, before, after):
+    # What goes up and down when a document goes from `before` to `after` (either may be None).
+    deltas = collections.Counter()
+    if before is not None:
+        deltas.subtract(counts(before))
+    if after is not None:
+        deltas.update(counts(after))
+    return {counter: delta for counter, delta in deltas.items() if delta}
+
+
+class SummaryCounters(object):
+    # Counts kept up to date by the writes themselves, so the summary is a read of a handful of small documents
+    # instead of a scan. Each count is spread over `shards` documents, picked at random per write, so busy
+    # counts don't all contend for the same document.
+
+    def __init__(self, shards):
+        self.shards = shards
+
+    def counters(self, *deltas):
+        shard = random.randrange(self.shards)
+        counters = dict()
+        for changed in deltas:
+            for (metric, label), delta in changed.items():
+                name = '{}{}:{}:{}'.format(PREFIX, shard, metric, label)
+                counters[name] = counters.get(name, 0) + delta
+        return {name: delta for name, delta in counters.items() if delta}
+
+    def rma_case(self, before, after):
+        return self.counters(changes(rma_case_counts, before, after))
+
+    def rma_cases(self, pairs):
+        return self.counters(*(changes(rma_case_counts, before, after) for before, after in pairs))
+
+    def product(self, before, after):
+        return self.counters(changes(product_counts, before, after))
+
+    def products(self, pairs):
+        return self.counters(*(changes(product_counts, before, after) for before, after in pairs))
+
+    def company(self, before, after):
+        return self.counters(changes(company_counts, before, after))
+
+    def read(self, storage):
+        totals = collections.defaultdict(dict)
+        for name, value in storage.get_counters(PREFIX).items():
+            shard, metric, label = name[len(PREFIX):].split(':', 2)
+            totals[metric][label] = totals[metric].get(label, 0) + value
+
+        def nonzero(metric):
+            return {label: value for label, value in sorted(totals[metric].items()) if value}
+
+        by_status = nonzero('rma_cases_by_status')
+        open_by_company = nonzero('open_rma_cases_by_company')
+        by_company = nonzero('products_by_company')
+        return {
+            'rma_cases': {'total': sum(by_status.values()), 'open': sum(open_by_company.values()),
+                          'by_status': by_status, 'open_by_company': open_by_company},
+            'products': {'total': sum(by_company.values()), 'by_company': by_company},
+            'companies': {'total': totals['companies'].get('total', 0)},
+        }
+
+    def rebuild(self, storage):
+        # Recounts everything from the documents and replaces the counters, to repair any drift (from writes
+        # made before the counters existed, or by hand). Writes that land during the scan can still be missed,
+        # so it's best run when things are quiet.
+        deltas = collections.Counter()
+        for rma_case in storage.query('rma_cases', fields=['status', 'distribution_company']):
+            deltas.update(rma_case_counts(rma_case))
+        for product in storage.query('products', fields=['distribution_company']):
+            deltas.update(product_counts(product))
+        for company in storage.query('companies', fields=['name']):
+            deltas.update(company_counts(company))
+
+        values = {'{}0:{}:{}'.format(PREFIX, metric, label): value
+                  for (metric, label), value in deltas.items() if value}
+        storage.set_counters(PREFIX, values)
+        return self.read(storage)
@@ -0,0 +1,128 @@
+# lib/tokens.py
+
+import collections
+import threading
+import time
+import uuid
+
+import jwt
+
+ALGORITHM = 'HS256'
+LEGACY_KID = 'default'
+# The user fields an access token carries, so requests can be authorized without loading the user.
+CLAIM_FIELDS = ('public_id', 'role', 'first_name', 'last_name')
+
+
+class InvalidToken(Exception):
+    pass
+
+
+def parse_keys(spec):
+    # "kid:secret,kid:secret", newest first: tokens are signed with the first key and checked against any of them.
+    keys = collections.OrderedDict()
+    for item in (spec or '').split(','):
+        if item.strip():
+            kid, _, secret = item.strip().partition(':')
+            if not secret:
+                raise ValueError('JWT keys are given as kid:secret')
+            keys[kid] = secret
+    return keys
+
+
+class TokenSigner(object):
+    def __init__(self, keys, legacy_key, access_ttl, refresh_ttl):
+        # Without configured keys tokens are signed with `legacy_key` and carry no key id. Tokens without a key id
+        # are checked against `legacy_key`, so the ones handed out before the keys were configured keep working
+        # until they expire.
+        self.keys = keys
+        self.legacy_key = legacy_key
+        self.access_ttl = access_ttl
+        self.refresh_ttl = refresh_ttl
+
+    def _encode(self, claims):
+        if not self.keys:
+            return jwt.encode(claims, self.legacy_key, algorithm=ALGORITHM).decode('utf-8')
+        kid = next(iter(self.keys))
+        return jwt.encode(claims, self.keys[kid], algorithm=ALGORITHM, headers={'kid': kid}).decode('utf-8')
+
+    def _claims(self, user, token_type, ttl):
+        # iat keeps its fractions of a second so a token issued right after a revocation isn't caught by it.
+        now = time.time()
+        return {'public_id': user['public_id'], 'type': token_type, 'jti': uuid.uuid4().hex, 'iat': now,
+                'exp': int(now + ttl)}
+
+    def access_token(self, user):
+        claims = self._claims(user, 'access', self.access_ttl)
+        claims.update((field, user.get(field)) for field in CLAIM_FIELDS)
+        return self._encode(claims)
+
+    def refresh_token(self, user):
+        return self._encode(self._claims(user, 'refresh', self.refresh_ttl))
+
+    def legacy_token(self, user, ttl):
+        # Only the user id: every request loads the user to find out who it is. iat is still set, so revoking the
+        # user's tokens doesn't also catch the ones they're given afterwards.
+        now = time.time()
+        return self._encode({'public_id': user['public_id'], 'iat': now, 'exp': int(now + ttl)})
+
+    def decode(self, token, token_type='access'):
+        try:
+            kid = jwt.get_unverified_header(token).get('kid')
+            if kid in self.keys:
+                key = self.keys[kid]
+            else:
+                # Tokens signed with `legacy_key` used to be marked as the 'default' key.
+                key = self.legacy_key if kid in (None, LEGACY_KID) else None
+            if key is None:
+                raise InvalidToken('Unknown key: {}'.format(kid))
+            claims = jwt.decode(token, key, algorithms=[ALGORITHM])
+        except jwt.InvalidTokenError as e:
+            raise InvalidToken(str(e))
+
+        # Tokens without a type are the legacy ones, which are access tokens.
+        if claims.get('type', 'access') != token_type:
+            raise InvalidToken('Not an {} token'.format(token_type))
+        return claims
+
+
+class RevocationList(object):
+    # Revoked tokens and users, kept in memory so checking a token costs no storage call. Entries are stored as
+    # documents ('token:<jti>' and 'user:<public_id>') that every worker loads, and are dropped once every token
+    # they could match has expired.
+
+    def __init__(self):
+        self._tokens = dict()
+        self._users = dict()
+        self._lock = threading.Lock()
+
+    def put(self, doc):
+        with self._lock:
+            self._put(doc)
+
+    def _put(self, doc):
+        if doc.get('jti'):
+            self._tokens[doc['jti']] = doc['expires']
+        else:
+            self._users[doc['public_id']] = doc
+
+    def load(self, docs):
+        # Revocations are never taken back, so what's loaded is added to what's known, and only expired entries
+        # are let go.
+        now = time.time()
+        with self._lock:
+            for doc in docs:
+                self._put(doc)
+            self._tokens = {jti: expires for jti, expires in self._tokens.items() if expires > now}
+            self._users = {public_id: doc for public_id, doc in self._users.items() if doc['expires'] > now}
+
+    def is_revoked(self, claims):
+        # A user revocation covers every token of that type issued before it. Tokens handed out before they
+        # carried an iat are all covered.
+        with self._lock:
+            if claims.get('jti') in self._tokens:
+                return True
+            entry = self._users.get(claims['public_id'])
+        if entry is None:
+            return False
+        before = entry.get('refresh_before' if claims.get('type') == 'refresh' else 'access_before') or 0
+        return claims.get('iat') is None or claims['iat'] <= before
@@ -0,0 +1,43 @@
+# lib/versions.py
+
+import threading
+import time
+import uuid
+import zlib
+
+# Documents share a fixed number of version slots so memory stays bounded; a collision only costs a miss.
+DOCUMENT_SLOTS = 4096
+
+
+class VersionTracker(object):
+    def __init__(self, ttl):
+        # Versions only mean something inside this process, so the token keeps other workers' ETags apart.
+        self.token = uuid.uuid4().hex[:8]
+        self.ttl = ttl
+        self._collections = dict()
+        self._documents = dict()
+        self._lock = threading.Lock()
+
+    def bump(self, collection, key=None):
+        with self._lock:
+            self._collections[collection] = self._collections.get(collection, 0) + 1
+            if key is not None:
+                slots = self._documents.setdefault(collection, [0] * DOCUMENT_SLOTS)
+                slots[zlib.crc32(key.encode('utf-8')) % DOCUMENT_SLOTS] += 1
+
+    def _etag(self, version, variant):
+        # Writes made by other processes are only seen here through a listener, so every ETag also expires after
+        # `ttl` seconds.
+        return '{}-{}-{}-{:x}'.format(self.token, int(time.time() // self.ttl), version,
+                                      zlib.crc32(variant) if variant else 0)
+
+    def collection_etag(self, collection, variant=b''):
+        with self._lock:
+            version = self._collections.get(collection, 0)
+        return self._etag(version, variant)
+
+    def document_etag(self, collection, key, variant=b''):
+        with self._lock:
+            slots = self._documents.get(collection)
+            version = slots[zlib.crc32(key.encode('utf-8')) % DOCUMENT_SLOTS] if slots else 0
+        return self._etag(version, variant)
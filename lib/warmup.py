@@ -0,0 +1,86 @@
+# lib/warmup.py
+
+import collections
+import logging
+import threading
+import time
+
+
+class WarmUp(object):
+    # The startup work a worker does once, before it takes requests: opening connections and filling the
+    # in-memory indexes and caches. Steps run in the order they were added; a step that fails is tried again
+    # (after the ones that succeeded) on the next run.
+
+    def __init__(self, on_step=None):
+        self._steps = []
+        self._on_step = on_step
+        # Held for the whole run, so callers arriving meanwhile wait for it to finish.
+        self._run_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # Set whenever a run is over, whether it worked or not.
+        self._finished = threading.Event()
+        self.durations = collections.OrderedDict()
+        self.ready = False
+        self.running = False
+        self.error = None
+
+    def step(self, name):
+        def decorator(f):
+            self._steps.append((name, f))
+            return f
+
+        return decorator
+
+    def run(self):
+        with self._run_lock:
+            if self.ready:
+                return
+            with self._lock:
+                self.running = True
+            try:
+                for name, f in self._steps:
+                    if name in self.durations:
+                        continue
+                    start = time.perf_counter()
+                    f()
+                    duration = time.perf_counter() - start
+                    with self._lock:
+                        self.durations[name] = duration
+                    if self._on_step is not None:
+                        self._on_step(name, duration)
+                with self._lock:
+                    self.ready = True
+                    self.error = None
+            except Exception as e:
+                with self._lock:
+                    self.error = e
+                raise
+            finally:
+                with self._lock:
+                    self.running = False
+                self._finished.set()
+
+    def start(self):
+        # Runs it in the background, for callers that can't wait.
+        def run():
+            try:
+                self.run()
+            except Exception:
+                logging.getLogger(__name__).exception('Warm-up failed')
+
+        with self._lock:
+            if self.ready or self.running:
+                return
+            self.running = True
+            self._finished.clear()
+        threading.Thread(target=run, daemon=True).start()
+
+    def wait(self, timeout):
+        # Waits up to `timeout` seconds for the run started by start() and says whether it's done.
+        self._finished.wait(timeout)
+        return self.ready
+
+    def status(self):
+        with self._lock:
+            return {'ready': self.ready, 'running': self.running, 'steps': dict(self.durations),
+                    'error': repr(self.error) if self.error is not None else None}
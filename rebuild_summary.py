@@ -0,0 +1,12 @@
+import json
+import os
+
+from lib.storage import create_storage
+from lib.summary import SummaryCounters
+
+# Recounts the summary counters from the documents. Run it by hand (or from cron) when the counts have drifted.
+storage = create_storage(os.getenv('SUKKIRI_STORAGE', 'firestore'), os.getenv('SUKKIRI_DATABASE_URI'))
+summary = SummaryCounters(int(os.getenv('SUKKIRI_COUNTER_SHARDS', 4))).rebuild(storage)
+
+print(json.dumps(summary, indent=2, sort_keys=True))
+print("Summary rebuilt successfully!")
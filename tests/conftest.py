@@ -0,0 +1,48 @@
+import base64
+import os
+
+import pytest
+
+os.environ.setdefault('SUKKIRI_STORAGE', 'memory')
+os.environ.setdefault('SUKKIRI_SECRET_KEY', 'test')
+os.environ.setdefault('SUKKIRI_PASSWORD_WORKERS', '0')
+os.environ.setdefault('SUKKIRI_PASSWORD_METHOD', 'pbkdf2:sha256:1000')
+
+import api  # noqa: E402
+from lib.classes import User  # noqa: E402
+
+
+def add_user(username, role):
+    user = User(username=username, email=None, first_name=username, last_name='Test', password='pw', role=role)
+    api.storage.set('users', user.public_id, user.to_dict())
+    return user
+
+
+def login(client, username):
+    credentials = base64.b64encode('{}:pw'.format(username).encode('utf-8')).decode('ascii')
+    response = client.get('/api/auth', headers={'Authorization': 'Basic ' + credentials})
+    assert response.status_code == 200
+    return response.get_json()['token']
+
+
+def add_company(client, headers, name):
+    company = {'name': name, 'email': None, 'address': None, 'hours': None, 'contact_name': None, 'phone': None}
+    assert client.post('/api/dist_companies', json=company, headers=headers).get_json() == {
+        'message': 'Company added successfully!'}
+
+
+def add_product(client, headers, model, company=''):
+    product = {'brand': 'B', 'model': model, 'description': '', 'stock': 1, 'stock_under_control': False,
+               'distribution_company': company, 'ean': ''}
+    assert client.post('/api/products', json=product, headers=headers).get_json() == {
+        'message': 'Product added successfully!'}
+
+
+def add_rma_case(client, headers, company=''):
+    rma_case = {'brand': 'B', 'model': 'M', 'problem': 'P', 'serial_number': 'S', 'distribution_company': company}
+    return client.post('/api/rma_cases', json=rma_case, headers=headers).get_json()['id']
+
+
+@pytest.fixture
+def client():
+    return api.app.test_client()
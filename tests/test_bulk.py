@@ -0,0 +1,11 @@
+import io
+
+from lib.bulk import read_csv, read_ndjson
+
+
+def test_uploads_may_start_with_a_byte_order_mark():
+    rows = list(read_csv(io.BytesIO('\ufeffbrand,model\nB,Ünö\n'.encode('utf-8'))))
+    assert rows == [{'brand': 'B', 'model': 'Ünö'}]
+
+    lines = list(read_ndjson(io.BytesIO('\ufeff{"brand": "B"}\n'.encode('utf-8'))))
+    assert lines == [{'brand': 'B'}]
@@ -0,0 +1,35 @@
+from conftest import add_company, add_product, add_user, login
+from lib.companies import CompanyIndex
+from lib.storage import MemoryStorage
+
+
+def test_expired_names_are_checked_again():
+    storage = MemoryStorage()
+    storage.set('companies', 'Acme', {'name': 'Acme', 'email': ''})
+    storage.set('companies', 'Other', {'name': 'Other', 'email': ''})
+    kept = CompanyIndex()
+    expiring = CompanyIndex(ttl=0)
+    kept.warm(storage)
+    expiring.warm(storage)
+
+    # Another worker deletes a company.
+    storage.delete('companies', 'Acme')
+
+    assert kept.missing(storage, ['Acme', 'Other']) == set()
+    assert expiring.missing(storage, ['Acme', 'Other']) == {'Acme'}
+    assert expiring.exists(storage, 'Other')
+
+
+def test_companies_in_use_are_not_deleted(client):
+    add_user('deleter', 'admin')
+    headers = {'x-access-token': login(client, 'deleter')}
+    add_company(client, headers, 'Busy')
+    add_product(client, headers, 'Busy One', company='Busy')
+
+    response = client.delete('/api/dist_companies/Busy', headers=headers)
+    assert response.status_code == 409
+    assert client.get('/api/dist_companies/Busy', headers=headers).status_code == 200
+
+    client.delete('/api/products/B Busy One', headers=headers)
+    response = client.delete('/api/dist_companies/Busy', headers=headers)
+    assert response.get_json() == {'message': 'Distribution company deleted successfully!'}
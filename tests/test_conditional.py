@@ -0,0 +1,21 @@
+from conftest import add_company, add_user, login
+
+
+def test_unchanged_documents_answer_304(client):
+    add_user('etags', 'admin')
+    headers = {'x-access-token': login(client, 'etags')}
+    add_company(client, headers, 'Tagged')
+
+    response = client.get('/api/dist_companies/Tagged', headers=headers)
+    etag = response.headers['ETag']
+    assert response.status_code == 200
+
+    response = client.get('/api/dist_companies/Tagged', headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+
+    client.put('/api/dist_companies/Tagged', json={'email': 'tagged@example.com'}, headers=headers)
+    response = client.get('/api/dist_companies/Tagged', headers=dict(headers, **{'If-None-Match': etag}))
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+    assert response.get_json()['dist_company']['email'] == 'tagged@example.com'
@@ -0,0 +1,59 @@
+from lib.ean_index import EANIndex
+from lib.storage import MemoryStorage
+
+
+def product(brand, model, ean, stock=0):
+    return {'brand': brand, 'model': model, 'description': '', 'stock': stock, 'stock_under_control': False,
+            'distribution_company': '', 'ean': ean}
+
+
+class CountingStorage(MemoryStorage):
+    def __init__(self):
+        super(CountingStorage, self).__init__()
+        self.queries = 0
+
+    def query(self, collection, *args, **kwargs):
+        self.queries += 1
+        return super(CountingStorage, self).query(collection, *args, **kwargs)
+
+
+def test_hits_are_served_from_memory():
+    storage = CountingStorage()
+    storage.set('products', 'B One', product('B', 'One', '1', stock=5))
+    index = EANIndex()
+    index.warm(storage)
+    queries = storage.queries
+
+    index.put('B One', product('B', 'One', '1', stock=4))
+
+    assert index.lookup(storage, '1') == [product('B', 'One', '1', stock=4)]
+    assert storage.queries == queries
+
+
+def test_misses_are_looked_up_in_storage():
+    storage = MemoryStorage()
+    index = EANIndex()
+    index.warm(storage)
+
+    # A product another worker just added.
+    storage.set('products', 'B Two', product('B', 'Two', '2'))
+
+    assert index.lookup_many(storage, ['2', '3']) == {'2': [product('B', 'Two', '2')], '3': []}
+
+
+def test_products_expire_without_a_listener():
+    storage = MemoryStorage()
+    storage.set('products', 'B One', product('B', 'One', '1', stock=5))
+    storage.set('products', 'B Two', product('B', 'Two', '1'))
+    kept = EANIndex()
+    expiring = EANIndex(ttl=0)
+    kept.warm(storage)
+    expiring.warm(storage)
+
+    # Changes another worker made straight to storage.
+    storage.update('products', 'B One', {'stock': 2})
+    storage.update('products', 'B Two', {'ean': '2'})
+
+    assert kept.lookup(storage, '1') == [product('B', 'One', '1', stock=5), product('B', 'Two', '1')]
+    assert expiring.lookup_many(storage, ['1', '2']) == {'1': [product('B', 'One', '1', stock=2)],
+                                                         '2': [product('B', 'Two', '2')]}
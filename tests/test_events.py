@@ -0,0 +1,18 @@
+import api
+from conftest import add_user, login
+
+
+def test_event_stream_takes_token_from_query(client):
+    add_user('watcher', 'rma_technician')
+    token = login(client, 'watcher')
+
+    assert client.get('/api/rma_cases/events').status_code == 401
+    # Other endpoints still only take the header.
+    assert client.get('/api/summary?token=' + token).status_code == 401
+
+    response = client.get('/api/rma_cases/events?token=' + token)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert next(response.response) == b'retry: 3000\n\n'
+    response.close()
+    assert not api.events._subscriptions
@@ -0,0 +1,41 @@
+import api
+from conftest import add_user, login
+from lib.classes import DistributionCompany
+
+
+def add_company(name):
+    company = DistributionCompany(name=name, email='', address='', hours='', contact_name='', phone='')
+    api.storage.set('companies', company.name, company.to_dict())
+
+
+def test_failed_write_is_not_replayed(client, monkeypatch):
+    add_user('idempotent', 'admin')
+    add_company('Idempotent Co')
+    headers = {'x-access-token': login(client, 'idempotent'), 'Idempotency-Key': 'create-1'}
+    case = {'brand': 'B', 'model': 'M', 'problem': 'P', 'serial_number': 'S', 'distribution_company': 'Idempotent Co'}
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('storage is down')
+
+    with monkeypatch.context() as patch:
+        patch.setattr(api.storage, 'set', fail)
+        response = client.post('/api/rma_cases', json=case, headers=headers)
+    assert response.status_code == 500
+
+    response = client.post('/api/rma_cases', json=case, headers=headers)
+    assert response.status_code == 200
+    assert 'Idempotent-Replayed' not in response.headers
+    assert api.storage.get('rma_cases', response.get_json()['id']) is not None
+
+    replayed = client.post('/api/rma_cases', json=case, headers=headers)
+    assert replayed.headers['Idempotent-Replayed'] == 'true'
+    assert replayed.get_json() == response.get_json()
+
+
+def test_upload_refuses_key(client):
+    add_user('uploader', 'admin')
+    headers = {'x-access-token': login(client, 'uploader'), 'Idempotency-Key': 'import-1', 'Content-Type': 'text/csv'}
+
+    response = client.post('/api/products/import', data='brand,model\nB,M\n', headers=headers)
+    assert response.status_code == 400
+    assert api.storage.get('products', 'B M') is None
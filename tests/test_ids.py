@@ -0,0 +1,35 @@
+import time
+
+from lib.ids import ID_LENGTH, CaseIdAllocator, normalize
+from lib.storage import MemoryStorage
+
+
+def test_ids_sort_by_creation_time(monkeypatch):
+    storage = MemoryStorage()
+    first, second = CaseIdAllocator(storage, 'ids'), CaseIdAllocator(storage, 'ids')
+    now = [1700000000]
+    monkeypatch.setattr(time, 'time', lambda: now[0])
+
+    seconds = []
+    for _ in range(3):
+        seconds.append([first.next_id(), second.next_id(), first.next_id(), second.next_id()])
+        now[0] += 1
+
+    for earlier, later in zip(seconds, seconds[1:]):
+        assert max(earlier) < min(later)
+    ids = [case_id for ids in seconds for case_id in ids]
+    assert len(set(ids)) == len(ids)
+    assert all(len(case_id) == ID_LENGTH for case_id in ids)
+
+
+def test_ids_stay_in_order_past_the_sequence():
+    allocator = CaseIdAllocator(MemoryStorage(), 'ids')
+    ids = [allocator.next_id() for _ in range(3000)]
+    assert ids == sorted(ids)
+    assert len(set(ids)) == len(ids)
+
+
+def test_normalize_fixes_typos():
+    case_id = CaseIdAllocator(MemoryStorage(), 'ids').next_id()
+    assert normalize(case_id.lower().replace('0', 'o').replace('1', 'l')) == case_id
+    assert normalize('ab12cd') == 'ab12cd'
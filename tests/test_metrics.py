@@ -0,0 +1,12 @@
+from lib import metrics
+from lib.storage import MemoryStorage
+
+
+def test_counter_leases_are_counted_as_writes():
+    counts = [0, 0]
+    storage = metrics.InstrumentedStorage(MemoryStorage(), lambda: 'lease', lambda: counts)
+
+    assert storage.increment_counter('ids', 1) == 1
+    assert counts == [0, 1]
+    assert 'sukkiri_backend_duration_seconds_count{endpoint="lease",operation="increment_counter"} 1' in \
+        metrics.registry.exposition()
@@ -0,0 +1,80 @@
+import api
+from conftest import add_company, add_rma_case, add_user, login
+from lib.classes import RMACase
+
+
+def test_batch_reports_the_chunks_that_failed(client, monkeypatch):
+    add_user('batcher', 'admin')
+    headers = {'x-access-token': login(client, 'batcher')}
+    ids = ['B{:06d}'.format(n) for n in range(api.RMA_CASES_CHUNK + 10)]
+    api.storage.set_many('rma_cases', {case_id: RMACase(case_id=case_id, brand='B', model='M', problem='P',
+                                                        serial_number='S', distribution_company='',
+                                                        current_user='Batch Test').to_dict()
+                                       for case_id in ids})
+
+    update_many = api.storage.update_many
+    calls = []
+
+    def fail_second_chunk(collection, updates, counters=None, expected=None):
+        calls.append(updates)
+        if len(calls) == 2:
+            raise RuntimeError('storage is down')
+        update_many(collection, updates, counters=counters, expected=expected)
+
+    monkeypatch.setattr(api.storage, 'update_many', fail_second_chunk)
+    response = client.post('/api/rma_cases/batch/to_be_sent', json={'ids': ids}, headers=headers)
+
+    assert response.status_code == 500
+    modified = {result['id'] for result in response.get_json()['results'] if result['modified']}
+    assert modified == set(ids[:api.RMA_CASES_CHUNK])
+    statuses = {case_id: case['status'] for case_id, case in api.storage.get_many('rma_cases', ids).items()}
+    assert {case_id for case_id, status in statuses.items() if status == 'to_be_sent'} == modified
+
+
+def test_racing_transitions_are_counted_once(client, monkeypatch):
+    add_user('racer', 'admin')
+    headers = {'x-access-token': login(client, 'racer')}
+    case = RMACase(case_id='RACE001', brand='B', model='M', problem='P', serial_number='S',
+                   distribution_company='', current_user='Race Test').to_dict()
+    api.storage.set('rma_cases', 'RACE001', case, counters=api.summary.rma_case(None, case))
+    before = api.summary.read(api.storage)['rma_cases']['by_status']
+
+    # Another request moves the case on between this one's read and its write.
+    get = api.storage.get
+
+    def get_then_race(collection, key):
+        doc = get(collection, key)
+        if collection == 'rma_cases' and key == 'RACE001':
+            monkeypatch.setattr(api.storage, 'get', get)
+            assert client.post('/api/rma_cases/RACE001/to_be_sent', headers=headers).get_json() == {
+                'message': 'RMA case modified successfully!'}
+        return doc
+
+    monkeypatch.setattr(api.storage, 'get', get_then_race)
+    response = client.post('/api/rma_cases/RACE001/to_be_sent', headers=headers)
+
+    assert response.get_json() == {'message': 'Not a valid new status'}
+    after = api.summary.read(api.storage)['rma_cases']['by_status']
+    assert after.get('to_be_sent', 0) - before.get('to_be_sent', 0) == 1
+    assert after.get('to_be_revised', 0) - before.get('to_be_revised', 0) == -1
+
+
+def test_paging_walks_every_case_once(client):
+    add_user('pager', 'admin')
+    headers = {'x-access-token': login(client, 'pager')}
+    add_company(client, headers, 'Paged')
+    created = [add_rma_case(client, headers, company='Paged') for _ in range(5)]
+
+    seen = []
+    url = '/api/rma_cases?distribution_company=Paged&fields=id&limit=2'
+    page = client.get(url, headers=headers).get_json()
+    while True:
+        seen += [rma_case['id'] for rma_case in page['rma_cases']]
+        if len(seen) == 2:
+            # Created during the walk, so it comes after the cursor.
+            created.append(add_rma_case(client, headers, company='Paged'))
+        if page['next'] is None:
+            break
+        page = client.get(url + '&start_after=' + page['next'], headers=headers).get_json()
+
+    assert seen == created
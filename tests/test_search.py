@@ -0,0 +1,39 @@
+import os
+
+import pytest
+
+from lib.search import SearchIndex
+
+
+def product(model):
+    return {'brand': 'B', 'model': model, 'description': '', 'ean': '', 'distribution_company': ''}
+
+
+def test_dirty_until_a_save_succeeds(tmp_path):
+    index = SearchIndex()
+    index.put('products', 'B One', product('One'))
+
+    with pytest.raises(OSError):
+        index.save(str(tmp_path / 'missing' / 'search.json'))
+    assert index.dirty
+
+    index.save(str(tmp_path / 'search.json'))
+    assert not index.dirty
+    assert os.listdir(str(tmp_path)) == ['search.json']
+
+    index.put('products', 'B Two', product('Two'))
+    assert index.dirty
+
+
+def test_snapshots_expire_unless_touched(tmp_path):
+    path = str(tmp_path / 'search.json')
+    index = SearchIndex()
+    index.put('products', 'B One', product('One'))
+    index.save(path)
+
+    old = os.path.getmtime(path) - 600
+    os.utime(path, (old, old))
+    assert not SearchIndex().load(path, 300)
+
+    os.utime(path)
+    assert SearchIndex().load(path, 300)
@@ -0,0 +1,17 @@
+import datetime
+
+import pytest
+
+from lib.serialization import JSONCodec
+
+DATA = {'date': datetime.datetime(2019, 8, 1, 10, 0, 0, 123456)}
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'stdlib'])
+def test_http_dates_by_default(backend):
+    assert JSONCodec(backend).dumps(DATA) == b'{"date":"Thu, 01 Aug 2019 10:00:00 GMT"}'
+
+
+@pytest.mark.parametrize('backend', ['orjson', 'stdlib'])
+def test_iso_dates(backend):
+    assert JSONCodec(backend, dates='iso').dumps(DATA) == b'{"date":"2019-08-01T10:00:00.123456"}'
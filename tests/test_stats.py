@@ -0,0 +1,37 @@
+import datetime
+
+from lib.stats import DATE_FIELDS, CaseColumnCache, CaseColumns, turnaround_stats
+from lib.storage import MemoryStorage
+
+
+def rma_case(number, brand):
+    opened = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=number)
+    case = {'id': str(number), 'brand': brand, 'distribution_company': 'Acme', 'status': 'to_be_sent',
+            'to_be_revised_date': opened, 'to_be_sent_date': opened + datetime.timedelta(hours=number)}
+    case.update((field, None) for field in DATE_FIELDS if field not in case)
+    return case
+
+
+def test_cached_columns_match_a_query():
+    storage = MemoryStorage()
+    storage.set_many('rma_cases', {str(n): rma_case(n, 'B{}'.format(n % 3)) for n in range(30)})
+    cache = CaseColumnCache(max_age=300)
+    filters = [('brand', '==', 'B1'), ('to_be_revised_date', '>=', datetime.datetime(2020, 1, 10))]
+
+    expected = turnaround_stats(CaseColumns.from_cases(storage.query('rma_cases', filters=filters)), 'status')
+    assert turnaround_stats(cache.select(storage, filters), 'status') == expected
+
+
+def test_put_updates_the_cached_columns():
+    storage = MemoryStorage()
+    storage.set('rma_cases', '1', rma_case(1, 'B'))
+    cache = CaseColumnCache(max_age=300)
+    cache.select(storage, [])
+
+    # Written behind the cache's back, as another worker would; only what's put shows up before it's reloaded.
+    storage.set('rma_cases', '2', rma_case(2, 'B'))
+    cache.put('1', dict(rma_case(1, 'B'), brand='C'))
+    cache.put('3', rma_case(3, 'C'))
+
+    assert list(cache.select(storage, [('brand', '==', 'C')]).groups['brand']) == ['C', 'C']
+    assert cache.select(storage, []).size == 2
@@ -0,0 +1,18 @@
+import api
+from conftest import add_user, login
+
+
+def test_release_more_than_reserved(client):
+    add_user('stocker', 'admin')
+    headers = {'x-access-token': login(client, 'stocker')}
+    api.storage.set('products', 'S One', {'brand': 'S', 'model': 'One', 'description': '', 'stock': 5,
+                                          'reserved': 1, 'stock_under_control': False,
+                                          'distribution_company': '', 'ean': ''})
+
+    response = client.post('/api/products/S One/release', json={'quantity': 2}, headers=headers)
+    assert response.status_code == 409
+    assert response.get_json() == {'message': 'Not enough reserved stock for S One', 'product': 'S One',
+                                   'field': 'reserved'}
+
+    response = client.post('/api/products/S One/reserve', json={'quantity': 6}, headers=headers)
+    assert response.get_json()['message'] == 'Not enough stock for S One'
@@ -0,0 +1,67 @@
+import queue
+
+import pytest
+
+from lib.fake_firestore import FakeClient
+from lib.storage import Change, Changed, FirestoreStorage, MemoryStorage, SQLStorage
+
+
+def firestore_storage(docs):
+    client = FakeClient()
+    client.load('rma_cases', docs)
+    return FirestoreStorage(client)
+
+
+def memory_storage(docs):
+    storage = MemoryStorage()
+    storage.set_many('rma_cases', docs)
+    return storage
+
+
+@pytest.mark.parametrize('create_storage', [firestore_storage, memory_storage])
+def test_listen_passes_on_changes_after_the_call(create_storage):
+    storage = create_storage({'1': {'status': 'to_be_revised'}})
+    received = queue.Queue()
+    storage.listen('rma_cases', received.put)
+
+    storage.set('rma_cases', '2', {'status': 'to_be_revised'})
+    storage.update('rma_cases', '1', {'status': 'to_be_sent'})
+    storage.delete('rma_cases', '2')
+
+    changes = [received.get(timeout=1)[0] for _ in range(3)]
+    assert changes == [Change('2', 'added', {'status': 'to_be_revised'}),
+                       Change('1', 'modified', {'status': 'to_be_sent'}),
+                       Change('2', 'removed', None)]
+    assert received.empty()
+
+
+def test_listeners_share_one_watch_per_collection():
+    client = FakeClient()
+    storage = FirestoreStorage(client)
+    first, second = queue.Queue(), queue.Queue()
+    storage.listen('rma_cases', first.put)
+    storage.listen('rma_cases', second.put)
+
+    storage.set('rma_cases', '1', {'status': 'to_be_revised'})
+
+    assert len(client._watches['rma_cases']) == 1
+    assert first.get(timeout=1) == second.get(timeout=1) == [Change('1', 'added', {'status': 'to_be_revised'})]
+
+
+@pytest.mark.parametrize('backend', ['firestore', 'memory', 'sql'])
+def test_update_checks_expected_values(backend, tmp_path):
+    storage = {'firestore': lambda: FirestoreStorage(FakeClient()), 'memory': MemoryStorage,
+               'sql': lambda: SQLStorage('sqlite:///' + str(tmp_path / 'test.db'))}[backend]()
+    storage.set_many('rma_cases', {'1': {'id': '1', 'status': 'to_be_revised'}, '2': {'id': '2', 'status': 'sent'}})
+
+    with pytest.raises(Changed) as raised:
+        storage.update_many('rma_cases', {'1': {'status': 'to_be_sent'}, '2': {'status': 'returned'}},
+                            counters={'moved': 2}, expected={'1': {'status': 'to_be_revised'}, '2': {'status': 'x'}})
+    assert raised.value.key == '2'
+    assert storage.get('rma_cases', '1')['status'] == 'to_be_revised'
+    assert storage.get_counters('moved') == {}
+
+    storage.update('rma_cases', '1', {'status': 'to_be_sent'}, counters={'moved': 1},
+                   expected={'status': 'to_be_revised'})
+    assert storage.get('rma_cases', '1')['status'] == 'to_be_sent'
+    assert storage.get_counters('moved') == {'moved': 1}
@@ -0,0 +1,24 @@
+from conftest import add_company, add_product, add_rma_case, add_user, login
+
+
+def test_summary_follows_the_writes(client):
+    add_user('counter', 'admin')
+    headers = {'x-access-token': login(client, 'counter')}
+    before = client.get('/api/summary', headers=headers).get_json()['summary']
+
+    add_company(client, headers, 'Counted')
+    add_product(client, headers, 'Counted One', company='Counted')
+    add_product(client, headers, 'Counted Two', company='Counted')
+    client.delete('/api/products/B Counted Two', headers=headers)
+    rma_case_ids = [add_rma_case(client, headers, company='Counted') for _ in range(3)]
+    client.post('/api/rma_cases/{}/to_be_sent'.format(rma_case_ids[0]), headers=headers)
+    client.post('/api/rma_cases/{}/resolved'.format(rma_case_ids[1]), headers=headers)
+
+    after = client.get('/api/summary', headers=headers).get_json()['summary']
+    assert after['companies']['total'] - before['companies']['total'] == 1
+    assert after['products']['by_company']['Counted'] == 1
+    assert after['rma_cases']['open_by_company']['Counted'] == 2
+    changed = {status: count - before['rma_cases']['by_status'].get(status, 0)
+               for status, count in after['rma_cases']['by_status'].items()}
+    assert {status: count for status, count in changed.items() if count} == {
+        'to_be_revised': 1, 'to_be_sent': 1, 'resolved': 1}
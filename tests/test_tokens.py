@@ -0,0 +1,66 @@
+import jwt
+import pytest
+
+import api
+from conftest import add_user, login
+from lib.tokens import ALGORITHM, InvalidToken, TokenSigner, parse_keys
+
+
+def get_summary(client, token):
+    return client.get('/api/summary', headers={'x-access-token': token})
+
+
+@pytest.fixture(params=['legacy', 'claims'])
+def token_format(request):
+    previous = api.app.config['TOKEN_FORMAT']
+    api.app.config['TOKEN_FORMAT'] = request.param
+    yield request.param
+    api.app.config['TOKEN_FORMAT'] = previous
+
+
+def test_login_again_after_modify_user(client, token_format):
+    admin = add_user('admin-' + token_format, 'admin')
+    user = add_user('tech-' + token_format, 'rma_technician')
+    admin_token = login(client, admin.username)
+    old_token = login(client, user.username)
+
+    response = client.put('/api/users/' + user.public_id, json={'first_name': 'Renamed'},
+                          headers={'x-access-token': admin_token})
+    assert response.get_json() == {'message': 'User modified successfully!'}
+
+    assert get_summary(client, old_token).status_code == 401
+    assert get_summary(client, login(client, user.username)).status_code == 200
+
+
+def test_login_again_after_password_change(client, token_format):
+    admin = add_user('admin2-' + token_format, 'admin')
+    user = add_user('tech2-' + token_format, 'rma_technician')
+    admin_token = login(client, admin.username)
+    old_token = login(client, user.username)
+
+    client.put('/api/users/' + user.public_id, json={'password': 'pw'}, headers={'x-access-token': admin_token})
+
+    assert get_summary(client, old_token).status_code == 401
+    assert get_summary(client, login(client, user.username)).status_code == 200
+
+
+def test_tokens_outlive_configuring_keys():
+    user = {'public_id': 'p', 'role': 'admin', 'first_name': 'A', 'last_name': 'B'}
+    before = TokenSigner(parse_keys(None), 'secret', 900, 3600)
+    issued = [before.legacy_token(user, 3600), before.access_token(user)]
+    refresh = before.refresh_token(user)
+
+    after = TokenSigner(parse_keys('k2:new'), 'secret', 900, 3600)
+    for token in issued:
+        assert after.decode(token)['public_id'] == 'p'
+    assert after.decode(refresh, 'refresh')['public_id'] == 'p'
+
+    # A token from a key that was dropped is turned down.
+    rotated = TokenSigner(parse_keys('k3:newer'), 'secret', 900, 3600)
+    with pytest.raises(InvalidToken):
+        rotated.decode(after.access_token(user))
+
+
+def test_tokens_once_marked_default_still_verify():
+    token = jwt.encode({'public_id': 'p'}, 'secret', algorithm=ALGORITHM, headers={'kid': 'default'}).decode('utf-8')
+    assert TokenSigner(parse_keys('k2:new'), 'secret', 900, 3600).decode(token)['public_id'] == 'p'
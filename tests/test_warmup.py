@@ -0,0 +1,17 @@
+import threading
+
+from lib.warmup import WarmUp
+
+
+def test_wait_gives_up_and_the_run_goes_on():
+    release = threading.Event()
+    warm_up = WarmUp()
+    warm_up.step('slow')(release.wait)
+
+    warm_up.start()
+    assert not warm_up.wait(0.01)
+    assert warm_up.status()['running']
+
+    release.set()
+    assert warm_up.wait(1)
+    assert warm_up.status()['steps'].keys() == {'slow'}